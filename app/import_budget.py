@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+# Imported on first use only, they must never be pulled in by importing the app
+LAZY_MODULES = ("snowflake.core", "sentence_transformers", "torch", "geopy.geocoders", "redis")
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def measure_import(module: str = "app.test") -> Tuple[float, List[Tuple[int, int, str]]]:
+    """
+    Import a module in a fresh interpreter with an empty environment, as a uvicorn worker would
+    without credentials or a network.
+
+    :param module: str, default "app.test". The module to import.
+    :return: The wall-clock time of the interpreter run in seconds and the
+             (cumulative microseconds, depth, module) triples reported by `python -X importtime`,
+             in import order. Depth 1 is `module` itself, depth 2 its direct imports.
+    """
+    env = {"PATH": os.environ.get("PATH", ""), "HOME": os.environ.get("HOME", ""), "PYTHONPATH": str(ROOT)}
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        # Outside the repo, so the .env files next to it are not picked up
+        cwd=os.path.dirname(str(ROOT)), env=env, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed with an empty environment:\n{result.stderr[-2000:]}")
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) + 1) // 2
+        modules.append((int(cumulative), depth, name.strip()))
+    return elapsed, modules
+
+
+if __name__ == "__main__":
+    # Most of the budget is llama_index.core, snowflake.snowpark and fastapi themselves
+    budget = float(os.getenv("IMPORT_BUDGET_SECONDS", 6.0))
+    elapsed, modules = measure_import("app.test")
+    total = next(cumulative for cumulative, depth, name in modules if depth == 1 and name == "app.test") / 1e6
+
+    print(f"import app.test: {total:.2f} s (budget {budget:.2f} s), {elapsed:.2f} s with interpreter start-up")
+    print("Slowest direct imports:")
+    for cumulative, _, name in sorted((m for m in modules if m[1] == 2), reverse=True)[:8]:
+        print(f"  {cumulative / 1e6:6.2f} s  {name}")
+
+    eager = sorted({name for _, _, name in modules if name.startswith(LAZY_MODULES)})
+    if eager:
+        sys.exit(f"Modules meant to load on first use were imported: {eager}")
+    if total > budget:
+        sys.exit(f"Import time {total:.2f} s is over the {budget:.2f} s budget.")
@@ -1,96 +1,149 @@
 import os
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
 
-# Import RagoonBot from the correct path. Assuming it's in "core.llm.CustomLLM"
-from core.llm.CustomLLM import RagoonBot
-from core.rag.RAG import Rag
+from core.rag.PipelineRegistry import PipelineRegistry
 from core.handlers.requests import *
 from core.handlers.responses import CompletionResponse, RAGCompleteResponse
+from core.handlers.streaming import streaming_response
+from core.llm.CustomLLM import is_error
+from core.cache.SemanticCache import SemanticCache, SemanticCacheBackend, SQLiteSemanticBackend
+from core.memory.ChatSessionStore import get_chat_session_store
 from geo.utils import *
+from geo.itinerary import plan_itinerary
+from geo.spatial import estimate_eta, get_poi_index
 
 load_dotenv('../.env')
 # os.chdir("../")
 
 app = FastAPI(title="RagoonBot API", description="API for RagoonBot, a custom LLM model.", version="0.1a")
 
+# Repeated tourist questions are answered from this cache instead of re-running the RAG pipeline
+semantic_cache = SemanticCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92)),
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 24 * 3600)),
+    max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 2048)),
+    backend=SQLiteSemanticBackend(os.environ["SEMANTIC_CACHE_PATH"]) if os.getenv("SEMANTIC_CACHE_PATH") else SemanticCacheBackend()
+)
+# LLMs and RAG pipelines are built once per model and shared by every request
+pipelines = PipelineRegistry(semantic_cache=semantic_cache)
+# Chat histories kept server-side, so clients with a session_id only send their new message
+sessions = get_chat_session_store()
+
+async def load_history(session_id: Optional[str], history: Optional[List[dict]]) -> List[dict]:
+    """
+    The history of a chat request: the stored session if it names one, the history it carries otherwise.
+    """
+    if session_id is None:
+        return history if history else []
+    messages = await run_in_threadpool(sessions.get, session_id)
+    if messages is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired session {session_id}.")
+    return messages
+
+def chat_stream(http_request: Request, generator, prompt: str, history: List[dict], session_id: Optional[str]):
+    """
+    Stream a chat answer, storing the exchange in the session once the answer is complete.
+    A failed generation ends with an "error" event and leaves the session unchanged.
+    """
+    if session_id is None:
+        updated_history = history + [{"role": "User", "content": prompt}]
+        return streaming_response(http_request, generator, done={"updated_history": updated_history})
+
+    def store(text: str) -> None:
+        sessions.append(session_id, [{"role": "User", "content": prompt}, {"role": "Assistant", "content": text}])
+
+    return streaming_response(http_request, generator, done={"session_id": session_id}, on_done=store)
+
 @app.post("/complete", response_model=CompletionResponse)
-def complete_request(request: CompletionRequest):
+async def complete_request(request: CompletionRequest):
     try:
-        # Create a new instance of RagoonBot with the specified model
-        llm = RagoonBot(model=request.model)
+        llm = pipelines.llm(request.model)
         
-        response = llm.complete(prompt=request.prompt)
+        response = await llm.acomplete(prompt=request.prompt)
+        if is_error(response):
+            raise HTTPException(status_code=502, detail=response.additional_kwargs.get("error", response.text))
         return CompletionResponse(text=response.text, llm_model=request.model)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/stream_complete")
-def stream_complete_request(request: CompletionRequest):
+async def stream_complete_request(request: CompletionRequest, http_request: Request):
+    """
+    Stream a completion as Server-Sent Events, or NDJSON with `?format=ndjson`.
+
+    :param request: CompletionRequest containing the user prompt.
+    :return: A stream of {"delta"} events closed by a "done" event with the full text.
+    """
     try:
-        # Create a new instance of RagoonBot with the specified model
-        llm = RagoonBot(model=request.model)
+        llm = pipelines.llm(request.model)
         
-        generator = llm.stream_complete(prompt=request.prompt)
-        return {"stream": [resp.delta for resp in generator]}
+        generator = await llm.astream_complete(prompt=request.prompt)
+        return streaming_response(http_request, generator)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat")
-def chat_request(request: ChatRequest):
+async def chat_request(request: ChatRequest):
     """
     Interactive chat endpoint for RagoonBot.
 
-    :param request: CompletionRequest containing the user prompt and history.
-    :return: The chat response with updated history.
+    :param request: ChatRequest containing the user prompt and either the history or a session id.
+    :return: The chat response with the updated history, or the session id when the session holds it.
     """
+    history = await load_history(request.session_id, request.history)
     try:
-        # Create a new instance of RagoonBot with the specified model
-        llm = RagoonBot(model=request.model)
+        llm = pipelines.llm(request.model)
 
         # Generate the completion response
-        response = llm.complete(prompt=request.prompt, history=request.history)
+        response = await llm.acomplete(prompt=request.prompt, history=history)
+        if is_error(response):
+            # Not stored, or the failure would be part of every later prompt
+            raise HTTPException(status_code=502, detail=response.additional_kwargs.get("error", response.text))
 
-        # Append the current interaction to the history
-        updated_history = request.history if request.history else []
-        updated_history.append({"role": "User", "content": request.prompt})
-        updated_history.append({"role": "Assistant", "content": response.text})
+        exchange = [{"role": "User", "content": request.prompt}, {"role": "Assistant", "content": response.text}]
+        if request.session_id is not None:
+            try:
+                await run_in_threadpool(sessions.append, request.session_id, exchange)
+            except KeyError:
+                # Expired or deleted while the answer was generated
+                raise HTTPException(status_code=404, detail=f"Unknown or expired session {request.session_id}.")
+            return {"response": response.text, "session_id": request.session_id}
 
+        # Append the current interaction to the history
         return {
             "response": response.text,
-            "updated_history": updated_history
+            "updated_history": history + exchange
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/stream_chat")
-def stream_chat_request(request: ChatRequest):
+async def stream_chat_request(request: ChatRequest, http_request: Request):
     """
     Interactive chat endpoint for RagoonBot with streaming responses.
 
-    :param request: ChatRequest containing the user prompt and history.
-    :return: The chat response with updated history.
+    :param request: ChatRequest containing the user prompt and either the history or a session id.
+    :return: A stream of {"delta"} events closed by a "done" event with the full text and the updated history or session id.
     """
+    history = await load_history(request.session_id, request.history)
     try:
-        # Create a new instance of RagoonBot with the specified model
-        llm = RagoonBot(model=request.model)
+        llm = pipelines.llm(request.model)
 
         # Generate the completion response
-        generator = llm.stream_complete(prompt=request.prompt, history=request.history)
-
-        # Append the current interaction to the history
-        updated_history = request.history if request.history else []
-        updated_history.append({"role": "User", "content": request.prompt})
+        generator = await llm.astream_complete(prompt=request.prompt, history=history)
 
-        return {
-            "stream": [resp.delta for resp in generator],
-            "updated_history": updated_history
-        }
+        return chat_stream(http_request, generator, request.prompt, history, request.session_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.post("/rag", response_model=RAGCompleteResponse)
-def rag_complete_request(request: RAGCompleteRequest):
+async def rag_complete_request(request: RAGCompleteRequest):
     """
     Retrieve and generate a response using the RAG model.
 
@@ -98,42 +151,80 @@ def rag_complete_request(request: RAGCompleteRequest):
     :return: The RAG completion response.
     """
     try:
-        # Create a new instance of RagoonBot with the specified model
-        llm = RagoonBot(model=request.model)
-        rag = Rag(llm=llm)
+        rag = pipelines.rag(request.model)
 
         # Generate the completion response
-        response = rag.complete(prompts=request.prompt)
-
+        response = await rag.acomplete(prompts=request.prompt, location=request.current_location)
+        if response.startswith("Error:"):
+            raise HTTPException(status_code=502, detail=response[len("Error:"):].strip())
 
-        return RAGCompleteResponse(text=response.text, rag_model=request.model)
+        return RAGCompleteResponse(text=response, rag_model=request.model)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/stream_rag")
-def rag_stream_complete_request(request: RAGChatRequest):
+async def rag_stream_complete_request(request: RAGChatRequest, http_request: Request):
     """
     Retrieve and generate a streamed response using the RAG model.
 
-    :param request: RAGCompleteRequest containing the user prompt.
-    :return: The RAG completion response.
+    :param request: RAGChatRequest containing the user prompt and either the history or a session id.
+    :return: A stream of {"delta"} events closed by a "done" event with the full text and the updated history or session id.
     """
+    history = await load_history(request.session_id, request.history)
     try:
-        # Create a new instance of RagoonBot with the specified model
-        llm = RagoonBot(model=request.model)
-        rag = Rag(llm=llm)
-
-        # Generate the completion response
-        generator = rag.stream_complete(prompts=request.prompts, history=request.history)
+        rag = pipelines.rag(request.model)
 
-        updated_history = request.history if request.history else []
-        updated_history.append({"role": "User", "content": request.prompts})
+        # The stages overlap as in the streaming pipeline, every call awaited on the upstream limiter
+        generator = rag.astream_complete(prompts=request.prompts, history=history, location=request.current_location)
 
-        return {"stream": [resp.delta for resp in generator],
-                "updated_history": updated_history}
+        return chat_stream(http_request, generator, request.prompts, history, request.session_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/sessions")
+def create_session_request():
+    """
+    Start a server-side chat session. Pass its id to /chat, /stream_chat and /stream_rag
+    instead of the history.
+
+    :return: The session id.
+    """
+    return {"session_id": sessions.create()}
+
+@app.get("/sessions/{session_id}")
+def get_session_request(session_id: str):
+    """
+    Read the history of a chat session.
+
+    :param session_id: The session id.
+    :return: The session id and its messages.
+    """
+    history = sessions.get(session_id)
+    if history is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired session {session_id}.")
+    return {"session_id": session_id, "history": history}
+
+@app.delete("/sessions/{session_id}")
+def delete_session_request(session_id: str):
+    """
+    Delete a chat session and its history.
+
+    :param session_id: The session id.
+    """
+    sessions.delete(session_id)
+    return {"session_id": session_id, "deleted": True}
+
+@app.get("/cache/stats")
+def cache_stats_request():
+    """
+    Report the hit/miss metrics of the semantic answer cache.
+
+    :return: The cache statistics and the number of stored answers.
+    """
+    return {"semantic_cache": {**semantic_cache.stats.as_dict(), "entries": len(semantic_cache.backend)}}
+
 @app.post("/route")
 def route_request(request: RouteRequest):
     """
@@ -141,16 +232,16 @@ def route_request(request: RouteRequest):
 
     :param start_coords: The starting coordinates.
     :param end_coords: The destination coordinates.
-    :return: The route geometry and distance in kilometers.
+    :return: The route geometry, distance in kilometers and estimated travel time in hours.
     """
     try:
         start_coords = request.current_location
         end_coords = get_destination(destination=request.destination)
         if end_coords:
-            route, distance = calculate_route(start_coords, end_coords)
+            route, distance, eta = calculate_route(start_coords, end_coords)
             if route:
                 m = plot_route(route, start_coords, end_coords)
-                return {"route": route, "distance": distance, "map": m}
+                return {"route": route, "distance": distance, "eta": eta, "map": m}
             else:
                 raise HTTPException(status_code=500, detail="Error fetching route.")
         else:
@@ -159,6 +250,55 @@ def route_request(request: RouteRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/nearby")
+def nearby_request(request: NearbyRequest):
+    """
+    Find the places of the knowledge base closest to the user, without the LLM or a routing call.
+
+    :param request: NearbyRequest containing the current location and how many places to return.
+    :return: The places, closest first, with their distance (km) and estimated travel time (min).
+    """
+    index = get_poi_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="No points of interest are indexed, set POI_INDEX_PATH or POI_TABLE.")
+    location = tuple(request.current_location)
+    if request.radius_km is not None:
+        hits = index.within(location, request.radius_km)[:request.k]
+    else:
+        hits = index.nearest(location, k=request.k)
+
+    places = []
+    for i, distance in hits:
+        point = tuple(index.points[i].tolist())
+        _, hours = estimate_eta(location, point, vehicle=request.vehicle)
+        places.append({**index.rows[i], "distance": distance, "eta_minutes": hours * 60})
+    return {"places": places}
+
+@app.post("/itinerary")
+def itinerary_request(request: ItineraryRequest):
+    """
+    Order a list of places into the shortest tour and route every leg.
+
+    :param request: ItineraryRequest containing the stops, the starting point and the vehicle profile.
+    :return: The stops in visit order, the legs with their geometry, distance (km) and duration (s), and the totals.
+    """
+    names = ([] if request.current_location is None else ["Start"]) + request.stops
+    points = [] if request.current_location is None else [tuple(request.current_location)]
+    for stop in request.stops:
+        coords = get_destination(destination=stop)
+        if coords is None:
+            raise HTTPException(status_code=404, detail=f"Could not find the address {stop}.")
+        points.append(coords)
+    if len(points) < 2:
+        raise HTTPException(status_code=400, detail="An itinerary needs at least two stops.")
+
+    try:
+        plan = plan_itinerary(points, vehicle=request.vehicle, round_trip=request.round_trip)
+        plan["stops"] = [{"name": names[i], "location": points[i]} for i in plan["order"]]
+        return plan
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/asr")
 def asr_request(request: AudioRequest):
     """
@@ -168,9 +308,7 @@ def asr_request(request: AudioRequest):
     :return: The transcribed text.
     """
     try:
-        os.chdir("../")
-        response = query(request.audio_file)
-        os.chdir("app")
+        response = query(request.filepath)
         return {"transcription": response}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
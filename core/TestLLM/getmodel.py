@@ -2,53 +2,53 @@ import os
 from dotenv import load_dotenv
 from snowflake.snowpark import Session
 from snowflake.cortex import Summarize, Complete, ExtractAnswer, Sentiment, Translate
+from core.connection.SessionPool import get_session_pool
 
 # Load environment variables from .env
 load_dotenv()
 
-connection_params = {
-    "account": os.environ["SNOWFLAKE_ACCOUNT"],
-    "user": os.environ["SNOWFLAKE_USER"],
-    "password": os.environ["SNOWFLAKE_USER_PASSWORD"],
-}
-
-# Create a Snowflake session
-snowflake_session = Session.builder.configs(connection_params).create()
+# Sessions are checked out of the shared pool, so importing this module opens no connection
+session_pool = get_session_pool()
 
 
 # Define the LLM functions
 def summarize(user_text):
-    summary = Summarize(text=user_text, session=snowflake_session)
+    with session_pool.session() as snowflake_session:
+        summary = Summarize(text=user_text, session=snowflake_session)
     return summary
 
 
 def complete(user_text):
-    completion = Complete(
-        model="snowflake-arctic",
-        prompt=f"Provide 5 keywords from the following text: {user_text}",
-        session=snowflake_session,
-    )
+    with session_pool.session() as snowflake_session:
+        completion = Complete(
+            model="snowflake-arctic",
+            prompt=f"Provide 5 keywords from the following text: {user_text}",
+            session=snowflake_session,
+        )
     return completion
 
 
 def extract_answer(user_text):
-    answer = ExtractAnswer(
-        from_text=user_text,
-        question="What are some of the ethical concerns associated with the rapid development of AI?",
-        session=snowflake_session,
-    )
+    with session_pool.session() as snowflake_session:
+        answer = ExtractAnswer(
+            from_text=user_text,
+            question="What are some of the ethical concerns associated with the rapid development of AI?",
+            session=snowflake_session,
+        )
     return answer
 
 
 def sentiment(user_text):
-    sentiment = Sentiment(text=user_text, session=snowflake_session)
+    with session_pool.session() as snowflake_session:
+        sentiment = Sentiment(text=user_text, session=snowflake_session)
     return sentiment
 
 
 def translate(user_text):
-    translation = Translate(
-        text=user_text, from_language="en", to_language="de", session=snowflake_session
-    )
+    with session_pool.session() as snowflake_session:
+        translation = Translate(
+            text=user_text, from_language="en", to_language="de", session=snowflake_session
+        )
     return translation
 
 
@@ -91,9 +91,8 @@ def main():
         )
 
     finally:
-        if snowflake_session:
-            # Close the Snowflake session
-            snowflake_session.close()
+        # Close the pooled Snowflake sessions
+        session_pool.close()
 
 
 if __name__ == "__main__":
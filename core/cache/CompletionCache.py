@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from core.cache.SemanticCache import CacheStats
+
+
+class CompletionCache:
+    """
+    Exact-match cache of LLM completions.
+
+    Keys are hashes of (model, full prompt, temperature). Entries live in an
+    in-memory LRU of at most `max_entries` items, expire after `ttl` seconds and
+    can optionally be persisted to a SQLite file that is read through on a memory miss.
+
+    :param max_entries: int, default 1024. Maximum number of completions kept in memory.
+    :param ttl: float, default 600. Seconds a completion stays valid. None disables expiry.
+    :param path: str, default None. SQLite file for persistence. In-memory only if None.
+    """
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 ttl: Optional[float] = 600.0,
+                 path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completion_cache (key TEXT PRIMARY KEY, value TEXT, created_at REAL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, temperature: Optional[float] = None) -> str:
+        """
+        Hash the inputs that determine a completion.
+
+        :param model: The model name.
+        :param prompt: The full prompt sent to the model, history included.
+        :param temperature: The sampling temperature, if any.
+        :return: The cache key.
+        """
+        payload = json.dumps([model, prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the cached completion, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM completion_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1])
+                    self._entries[key] = entry
+
+            if entry is not None and self._is_expired(entry[1]):
+                self._delete(key)
+                self.stats.record(expirations=1)
+                entry = None
+
+            if entry is None:
+                self.stats.record(misses=1)
+                return None
+
+            self._entries.move_to_end(key)
+            self._trim()
+            self.stats.record(hits=1, exact_hits=1)
+            return entry[0]
+
+    def put(self, key: str, value: str) -> None:
+        """
+        Store a completion.
+        """
+        created_at = time.time()
+        with self._lock:
+            self._entries[key] = (value, created_at)
+            self._entries.move_to_end(key)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO completion_cache VALUES (?, ?, ?)", (key, value, created_at)
+                )
+                if self.ttl is not None:
+                    self._conn.execute("DELETE FROM completion_cache WHERE created_at < ?", (created_at - self.ttl,))
+                self._conn.commit()
+            self._trim()
+        self.stats.record(stores=1)
+
+    def _trim(self) -> None:
+        # Caller holds the lock. The SQLite copy is only bounded by the TTL.
+        overflow = len(self._entries) - self.max_entries
+        for _ in range(max(0, overflow)):
+            self._entries.popitem(last=False)
+        if overflow > 0:
+            self.stats.record(evictions=overflow)
+
+    def _delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM completion_cache")
+                self._conn.commit()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_cache: Optional[CompletionCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """
+    Return the process-wide completion cache, or None unless it is enabled
+    with the COMPLETION_CACHE_ENABLED environment variable.
+
+    COMPLETION_CACHE_MAX_ENTRIES, COMPLETION_CACHE_TTL and COMPLETION_CACHE_PATH configure it.
+    """
+    global _default_cache
+    if os.getenv("COMPLETION_CACHE_ENABLED", "").lower() not in ("1", "true", "yes"):
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = CompletionCache(
+                    max_entries=int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", 1024)),
+                    ttl=float(os.getenv("COMPLETION_CACHE_TTL", 600)),
+                    path=os.getenv("COMPLETION_CACHE_PATH"),
+                )
+    return _default_cache
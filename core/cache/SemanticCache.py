@@ -0,0 +1,395 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.embedding.Embedder import CortexEmbedder, normalize_rows
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize a query so trivially different phrasings share a cache key.
+
+    :param text: The raw user query.
+    :return: The lower-cased query with collapsed whitespace and no trailing punctuation.
+    """
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.strip(" ?!.,;:")
+
+
+class CacheStats:
+    """
+    Hit/miss counters of a cache. Safe to update from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+        self.lookup_seconds = 0.0
+
+    def record(self, **counts: float) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "hits": self.hits,
+            "exact_hits": self.exact_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "errors": self.errors,
+            "avg_lookup_ms": round(1000 * self.lookup_seconds / self.lookups, 3) if self.lookups else 0.0,
+        }
+
+
+class SemanticCacheBackend:
+    """
+    In-memory storage for semantic cache entries.
+
+    Entries are kept in least-recently-used order and their embeddings in one
+    normalized matrix, so a lookup is a single matrix-vector product.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # key -> (namespace, embedding, answer, created_at)
+        self._entries: "OrderedDict[str, Tuple[str, np.ndarray, str, float]]" = OrderedDict()
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[str] = []
+        self._matrix_namespaces: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Tuple[str, np.ndarray, str, float]]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, namespace: str, embedding: np.ndarray, answer: str, created_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (namespace, embedding, answer, created_at)
+            self._entries.move_to_end(key)
+            self._matrix = None
+
+    def touch(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._matrix = None
+
+    def oldest(self, n: int) -> List[str]:
+        """Return the `n` least recently used keys."""
+        with self._lock:
+            return [key for key, _ in zip(self._entries, range(n))]
+
+    def expired(self, cutoff: float) -> List[str]:
+        """Return the keys created before `cutoff`."""
+        with self._lock:
+            return [key for key, entry in self._entries.items() if entry[3] < cutoff]
+
+    def nearest(self, namespace: str, embedding: np.ndarray) -> Optional[Tuple[str, float]]:
+        """
+        Find the most similar stored entry in the namespace.
+
+        :param namespace: Only entries stored under this namespace are considered.
+        :param embedding: A unit-length query embedding.
+        :return: (key, cosine similarity) of the best entry, or None if the namespace is empty.
+        """
+        with self._lock:
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._matrix_keys = list(self._entries)
+                self._matrix = np.stack([self._entries[k][1] for k in self._matrix_keys])
+                self._matrix_namespaces = np.array([self._entries[k][0] for k in self._matrix_keys])
+            matrix, keys, namespaces = self._matrix, self._matrix_keys, self._matrix_namespaces
+
+        if matrix.shape[1] != embedding.shape[0]:
+            return None
+        scores = matrix @ embedding
+        scores[namespaces != namespace] = -np.inf
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            return None
+        return keys[best], float(scores[best])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+
+class SQLiteSemanticBackend(SemanticCacheBackend):
+    """
+    Semantic cache storage persisted to a SQLite file, so answers survive restarts
+    and can be shared by several worker processes on the same host.
+    Lookups still run against the in-memory matrix, which is loaded on start-up.
+    On a key miss, the rows other processes added since are loaded before the
+    similarity search; entries they delete are only dropped here once they expire.
+
+    :param path: str. Path of the SQLite database file.
+    """
+
+    def __init__(self, path: str = "semantic_cache.sqlite3"):
+        super().__init__()
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            "key TEXT PRIMARY KEY, namespace TEXT, embedding BLOB, answer TEXT, "
+            "created_at REAL, last_access REAL)"
+        )
+        self._conn.commit()
+        self._last_rowid = 0
+        rows = self._conn.execute(
+            "SELECT rowid, key, namespace, embedding, answer, created_at FROM semantic_cache ORDER BY last_access"
+        ).fetchall()
+        for rowid, key, namespace, blob, answer, created_at in rows:
+            super().put(key, namespace, np.frombuffer(blob, dtype=np.float32), answer, created_at)
+            self._last_rowid = max(self._last_rowid, rowid)
+
+    def _load_new(self) -> None:
+        """Load the rows written since the last load, by this or another process."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, key, namespace, embedding, answer, created_at FROM semantic_cache "
+                "WHERE rowid > ? ORDER BY rowid",
+                (self._last_rowid,)
+            ).fetchall()
+            for rowid, key, namespace, blob, answer, created_at in rows:
+                self._last_rowid = max(self._last_rowid, rowid)
+                current = self._entries.get(key)
+                if current is not None and current[3] == created_at:
+                    continue  # written by this process
+                super().put(key, namespace, np.frombuffer(blob, dtype=np.float32), answer, created_at)
+
+    def get(self, key: str) -> Optional[Tuple[str, np.ndarray, str, float]]:
+        entry = super().get(key)
+        if entry is None:
+            self._load_new()
+            entry = super().get(key)
+        return entry
+
+    def put(self, key: str, namespace: str, embedding: np.ndarray, answer: str, created_at: float) -> None:
+        super().put(key, namespace, embedding, answer, created_at)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO semantic_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, namespace, np.asarray(embedding, dtype=np.float32).tobytes(), answer, created_at, time.time())
+            )
+            self._conn.commit()
+
+    def touch(self, key: str) -> None:
+        super().touch(key)
+        with self._lock:
+            self._conn.execute("UPDATE semantic_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        super().delete(key)
+        with self._lock:
+            self._conn.execute("DELETE FROM semantic_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        super().clear()
+        with self._lock:
+            self._conn.execute("DELETE FROM semantic_cache")
+            self._conn.commit()
+
+
+class SemanticCache:
+    """
+    Answer cache keyed on query meaning rather than exact text.
+
+    A query is first looked up by its normalized text. Otherwise it is embedded and
+    the stored answer of the most similar earlier query is served if their cosine
+    similarity reaches `threshold`. Entries expire after `ttl` seconds and the least
+    recently used ones are evicted beyond `max_entries`.
+
+    The embeddings of recent misses are kept, so storing the answer afterwards does not
+    embed the query a second time. A failing embedding call or backend never fails the
+    request: a lookup error counts as a miss and a store error is only reported.
+
+    :param embed_fn: callable, default None. Maps a string to an embedding vector.
+                     If None, Cortex `EmbedText768` is used.
+    :param threshold: float, default 0.92. Minimum cosine similarity for a hit.
+    :param ttl: float, default 86400. Seconds an answer stays valid. None disables expiry.
+    :param max_entries: int, default 2048. Maximum number of stored answers.
+    :param backend: SemanticCacheBackend, default None. Storage backend, in-memory if None.
+    """
+
+    def __init__(self,
+                 embed_fn: Optional[Callable[[str], Any]] = None,
+                 threshold: float = 0.92,
+                 ttl: Optional[float] = 24 * 3600.0,
+                 max_entries: int = 2048,
+                 backend: Optional[SemanticCacheBackend] = None):
+        self.embed_fn = embed_fn or CortexEmbedder()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend if backend is not None else SemanticCacheBackend()
+        self.stats = CacheStats()
+        # normalized query -> embedding, for the misses whose answer is still being computed
+        self._pending: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._max_pending = 256
+
+    @staticmethod
+    def _key(namespace: str, normalized: str) -> str:
+        return hashlib.sha256(f"{namespace}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def _embed(self, normalized: str) -> np.ndarray:
+        return normalize_rows(np.asarray(self.embed_fn(normalized), dtype=np.float32).reshape(1, -1))[0]
+
+    def _remember(self, normalized: str, embedding: np.ndarray) -> None:
+        with self._pending_lock:
+            self._pending[normalized] = embedding
+            self._pending.move_to_end(normalized)
+            while len(self._pending) > self._max_pending:
+                self._pending.popitem(last=False)
+
+    def _embedding_for(self, normalized: str) -> np.ndarray:
+        with self._pending_lock:
+            embedding = self._pending.pop(normalized, None)
+        return embedding if embedding is not None else self._embed(normalized)
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def lookup(self, query: str, namespace: str = "") -> Optional[str]:
+        """
+        Return the cached answer for a query, or None on a miss.
+
+        :param query: The user query.
+        :param namespace: Cache partition, e.g. the model and pipeline that produced the answers.
+        :return: The stored answer if an equivalent query was answered before.
+        """
+        start = time.perf_counter()
+        normalized = normalize_query(query)
+        key = self._key(namespace, normalized)
+
+        answer, exact = None, False
+        try:
+            entry = self.backend.get(key)
+            if entry is not None:
+                answer, exact = self._serve(key, entry), True
+            if answer is None:
+                embedding = self._embed(normalized)
+                self._remember(normalized, embedding)
+                match = self.backend.nearest(namespace, embedding)
+                if match is not None and match[1] >= self.threshold:
+                    entry = self.backend.get(match[0])
+                    if entry is not None:
+                        answer = self._serve(match[0], entry)
+        except Exception as e:
+            print(f"Semantic cache lookup failed, treating it as a miss: {e}")
+            self.stats.record(errors=1)
+            answer, exact = None, False
+
+        elapsed = time.perf_counter() - start
+        if answer is None:
+            self.stats.record(misses=1, lookup_seconds=elapsed)
+        else:
+            self.stats.record(hits=1, exact_hits=int(exact), lookup_seconds=elapsed)
+        return answer
+
+    def _serve(self, key: str, entry: Tuple[str, np.ndarray, str, float]) -> Optional[str]:
+        if self._is_expired(entry[3]):
+            self.backend.delete(key)
+            self.stats.record(expirations=1)
+            return None
+        self.backend.touch(key)
+        return entry[2]
+
+    def store(self, query: str, answer: str, namespace: str = "") -> None:
+        """
+        Remember the answer to a query.
+
+        :param query: The user query.
+        :param answer: The answer to serve for this and similar queries.
+        :param namespace: Cache partition, see `lookup`.
+        """
+        normalized = normalize_query(query)
+        try:
+            embedding = self._embedding_for(normalized)
+            self.backend.put(self._key(namespace, normalized), namespace, embedding, answer, time.time())
+            self.stats.record(stores=1)
+            self._evict()
+        except Exception as e:
+            print(f"Semantic cache store failed: {e}")
+            self.stats.record(errors=1)
+
+    def get_or_compute(self, query: str, compute: Callable[[], str], namespace: str = "") -> str:
+        """
+        Serve a cached answer or compute and store a new one.
+
+        :param query: The user query.
+        :param compute: Called without arguments on a miss to produce the answer.
+        :param namespace: Cache partition, see `lookup`.
+        :return: The cached or freshly computed answer.
+        """
+        answer = self.lookup(query, namespace=namespace)
+        if answer is None:
+            answer = compute()
+            if answer and not answer.startswith("Error:"):
+                self.store(query, answer, namespace=namespace)
+        return answer
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            expired = self.backend.expired(time.time() - self.ttl)
+            for key in expired:
+                self.backend.delete(key)
+            if expired:
+                self.stats.record(expirations=len(expired))
+
+        overflow = len(self.backend) - self.max_entries
+        if overflow > 0:
+            for key in self.backend.oldest(overflow):
+                self.backend.delete(key)
+            self.stats.record(evictions=overflow)
+
+    def clear(self) -> None:
+        self.backend.clear()
+        with self._pending_lock:
+            self._pending.clear()
+
+
+if __name__ == "__main__":
+    from core.embedding.Embedder import HashingEmbedder
+
+    cache = SemanticCache(embed_fn=HashingEmbedder(), threshold=0.8)
+    cache.store("Where should I eat in Hanoi?", "Try the pho on Bat Dan street.")
+    print(cache.lookup("where should i eat in hanoi"))
+    print(cache.lookup("Where should I eat in Hanoi, Vietnam?"))
+    print(cache.lookup("How do I get from Hanoi to Ha Long Bay?"))
+    print(cache.stats.as_dict())
@@ -0,0 +1,361 @@
+import asyncio
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional
+
+# Upstreams whose calls check a session out of the Snowflake pool ("rerank" runs LLM
+# transforms and rerankers). Together they hold at most one slot per pooled session.
+SESSION_UPSTREAMS = ("cortex_complete", "cortex_search", "embed", "rerank")
+SHARED_BUDGET = "snowflake_sessions"
+
+# Share of the Snowflake session pool each of them may hold on its own. The shares
+# overlap, so an idle upstream's sessions serve the busy ones, and the shared budget
+# keeps the sum within the pool.
+POOL_SHARES: Dict[str, float] = {
+    "cortex_complete": 0.75,
+    "cortex_search": 0.5,
+    "embed": 0.25,
+    "rerank": 0.25,
+}
+
+DEFAULT_POOL_SIZE = 32
+
+
+def pool_size_from_env() -> int:
+    """
+    The maximum size of the Snowflake session pool, SNOWFLAKE_POOL_MAX_SIZE (default 32).
+    """
+    return int(os.getenv("SNOWFLAKE_POOL_MAX_SIZE", DEFAULT_POOL_SIZE))
+
+
+def default_limits(pool_size: Optional[int] = None) -> Dict[str, int]:
+    """
+    Per-upstream limits for a Snowflake session pool of the given size.
+
+    :param pool_size: int, default None. Maximum size of the session pool.
+                      Read from SNOWFLAKE_POOL_MAX_SIZE (default 32) if None.
+    :return: The maximum number of concurrent calls per upstream name.
+    """
+    if pool_size is None:
+        pool_size = pool_size_from_env()
+    return {name: max(1, int(pool_size * share)) for name, share in POOL_SHARES.items()}
+
+
+# Limits for the default pool of 32 sessions: 24 completions, 16 searches, 8 embeddings and 8 reranks
+DEFAULT_LIMITS: Dict[str, int] = default_limits(DEFAULT_POOL_SIZE)
+
+
+class UpstreamLimiter:
+    """
+    Bounds the number of concurrent calls to every upstream service from async code.
+
+    Each upstream gets a semaphore and a thread pool of the same size. Blocking
+    clients (Snowpark, Cortex) run on that pool, so hundreds of in-flight requests
+    only hold coroutines while waiting, and a burst towards one upstream neither
+    exhausts the event loop's default executor nor starves the other upstreams.
+    The `shared_upstreams` also take a slot of a budget of `shared_limit`, the
+    Snowflake sessions they check out, so calls wait here rather than on a
+    blocked checkout in a worker thread.
+
+    A slot is held until the blocking call returns, even if the awaiting task is
+    cancelled, e.g. by a timeout, since the worker thread keeps running.
+
+    :param limits: dict, default None. Maximum concurrent calls per upstream name.
+                   Missing names fall back to `DEFAULT_LIMITS`, then to `default_limit`.
+                   Use `default_limits(pool_size)` for a session pool of another size.
+    :param default_limit: int, default 8. Limit of upstreams not listed anywhere.
+    :param shared_limit: int, default None. Slots shared by the `shared_upstreams`. Unbounded if None.
+    :param shared_upstreams: The upstreams drawing on the shared budget, default `SESSION_UPSTREAMS`.
+    """
+
+    def __init__(self,
+                 limits: Optional[Dict[str, int]] = None,
+                 default_limit: int = 8,
+                 shared_limit: Optional[int] = None,
+                 shared_upstreams: Iterable[str] = SESSION_UPSTREAMS):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.default_limit = default_limit
+        self.shared_limit = shared_limit
+        self.shared_upstreams = frozenset(shared_upstreams)
+        self._lock = threading.Lock()
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        # Semaphores belong to the loop that first waits on them
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.in_flight: Dict[str, int] = {}
+
+    def limit_of(self, upstream: str) -> int:
+        return max(1, self.limits.get(upstream, self.default_limit))
+
+    def _semaphores_of(self, upstream: str) -> List[asyncio.Semaphore]:
+        semaphores = self._semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(upstream)
+        if semaphore is None:
+            semaphore = semaphores[upstream] = asyncio.Semaphore(self.limit_of(upstream))
+        if self.shared_limit is None or upstream not in self.shared_upstreams:
+            return [semaphore]
+        shared = semaphores.get(SHARED_BUDGET)
+        if shared is None:
+            shared = semaphores[SHARED_BUDGET] = asyncio.Semaphore(max(1, self.shared_limit))
+        return [semaphore, shared]
+
+    async def _acquire(self, upstream: str) -> Callable[[], None]:
+        # Always the upstream's semaphore first, then the shared budget
+        acquired: List[asyncio.Semaphore] = []
+        try:
+            for semaphore in self._semaphores_of(upstream):
+                await semaphore.acquire()
+                acquired.append(semaphore)
+        except BaseException:
+            for semaphore in acquired:
+                semaphore.release()
+            raise
+        self.in_flight[upstream] = self.in_flight.get(upstream, 0) + 1
+
+        def release() -> None:
+            self.in_flight[upstream] -= 1
+            for semaphore in acquired:
+                semaphore.release()
+
+        return release
+
+    def executor(self, upstream: str) -> ThreadPoolExecutor:
+        """
+        The thread pool blocking calls to `upstream` run on.
+        """
+        executor = self._executors.get(upstream)
+        if executor is None:
+            with self._lock:
+                executor = self._executors.get(upstream)
+                if executor is None:
+                    executor = ThreadPoolExecutor(
+                        max_workers=self.limit_of(upstream),
+                        thread_name_prefix=f"upstream-{upstream}"
+                    )
+                    self._executors[upstream] = executor
+        return executor
+
+    @asynccontextmanager
+    async def limit(self, upstream: str) -> AsyncIterator[None]:
+        """
+        Hold one of the upstream's slots for the duration of the block.
+        """
+        release = await self._acquire(upstream)
+        try:
+            yield
+        finally:
+            release()
+
+    async def call(self, upstream: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a blocking call on the upstream's thread pool without holding a slot.
+        For use inside `limit`.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor(upstream), partial(fn, *args, **kwargs))
+
+    async def run(self, upstream: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Wait for a slot, then run a blocking call to `upstream` on its thread pool.
+
+        :param upstream: The upstream name, e.g. "cortex_complete".
+        :param fn: The blocking callable.
+        :return: Whatever `fn` returns.
+        """
+        release = await self._acquire(upstream)
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.executor(upstream), partial(fn, *args, **kwargs))
+        except BaseException:
+            release()
+            raise
+        def done(finished: asyncio.Future) -> None:
+            release()
+            if not finished.cancelled():
+                # Marks the exception retrieved when the caller was cancelled before it
+                finished.exception()
+
+        # Released when the thread is done, not when a cancelled caller stops waiting
+        future.add_done_callback(done)
+        return await asyncio.shield(future)
+
+    def close(self) -> None:
+        with self._lock:
+            for executor in self._executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+            self._executors.clear()
+
+
+_default_limiter: Optional[UpstreamLimiter] = None
+_default_limiter_lock = threading.Lock()
+
+
+def limits_from_env() -> Dict[str, int]:
+    """
+    Read per-upstream limits from UPSTREAM_LIMIT_<NAME> variables, e.g. UPSTREAM_LIMIT_CORTEX_COMPLETE=32.
+    """
+    prefix = "UPSTREAM_LIMIT_"
+    return {
+        name[len(prefix):].lower(): int(value)
+        for name, value in os.environ.items()
+        if name.startswith(prefix) and value
+    }
+
+
+def get_limiter() -> UpstreamLimiter:
+    """
+    Return the process-wide upstream limiter, creating it on first use.
+
+    The limits are split from SNOWFLAKE_POOL_MAX_SIZE with `default_limits`, and the
+    session upstreams share a budget of SNOWFLAKE_POOL_MAX_SIZE slots, since every
+    in-flight Cortex call holds a pooled session. Both can be overridden with
+    UPSTREAM_LIMIT_<NAME>, e.g. UPSTREAM_LIMIT_SNOWFLAKE_SESSIONS for the budget.
+
+    :return: The shared UpstreamLimiter.
+    """
+    global _default_limiter
+    if _default_limiter is None:
+        with _default_limiter_lock:
+            if _default_limiter is None:
+                pool_size = pool_size_from_env()
+                limits = {**default_limits(pool_size), **limits_from_env()}
+                shared_limit = limits.pop(SHARED_BUDGET, pool_size)
+                _default_limiter = UpstreamLimiter(limits, shared_limit=shared_limit)
+    return _default_limiter
+
+
+if __name__ == "__main__":
+    # Run with `python -m core.concurrency.Limiter`. Load test of the async request path with the
+    # shipped limits and session pool size, against local stand-ins for Cortex Complete, Search and
+    # EmbedText that hold a pooled session for a fixed time, as the real calls do.
+    import time
+
+    from core.cache.SemanticCache import SemanticCache
+    from core.connection.SessionPool import SessionPool, set_session_pool
+    from core.embedding.Embedder import HashingEmbedder
+    from core.llm import CustomLLM
+    from core.rag.RAG import Rag
+    from core.retrieval.BaseRetriever import BaseRetriever
+
+    ROUTE, DECOMPOSE, HYDE, SEARCH, EMBED = 0.2, 0.4, 0.3, 0.08, 0.03
+    FIRST_TOKEN, TOKEN, TOKENS = 0.3, 0.01, 50
+
+    class FakeSession:
+        def close(self):
+            pass
+
+    pool = SessionPool(connection_params={}, max_size=pool_size_from_env(), session_factory=lambda params: FakeSession())
+    set_session_pool(pool)
+    peak = {"sessions": 0}
+
+    def hold(seconds: float) -> None:
+        with pool.session():
+            peak["sessions"] = max(peak["sessions"], pool.size - pool.idle)
+            time.sleep(seconds)
+
+    def fake_complete(model, prompt, options=None, session=None, stream=False):
+        peak["sessions"] = max(peak["sessions"], pool.size - pool.idle)
+        if "break down the question" in prompt:
+            lines = ["Sub-queries:\n", "Where to eat in Hanoi?\n", "How to reach Ha Long Bay?\n", "What to see in Hue?"]
+
+            def decomposition():
+                for line in lines:
+                    time.sleep(DECOMPOSE / len(lines))
+                    yield line
+            return decomposition() if stream else "".join(decomposition())
+        if "Decide how the user query" in prompt:
+            time.sleep(ROUTE)
+            return "TRANSFORM"
+        if "write a passage to answer" in prompt:
+            time.sleep(HYDE)
+            text = "A hypothetical passage about the question."
+            return iter([text]) if stream else text
+
+        def tokens():
+            time.sleep(FIRST_TOKEN)
+            for i in range(TOKENS):
+                if i:
+                    time.sleep(TOKEN)
+                yield f"token{i} "
+        return tokens() if stream else "".join(tokens())
+
+    class FakeSearch(BaseRetriever):
+        upstream = "cortex_search"
+
+        def retrieve(self, query, limit=None):
+            hold(SEARCH)
+            return [f"Passage {i} about {query}" for i in range(4)]
+
+    def fake_embed(text):
+        hold(EMBED)
+        return HashingEmbedder()(text)
+
+    CustomLLM.Complete = fake_complete
+    limiter = get_limiter()
+    llm = CustomLLM.get_llm()
+    # A threshold above 1 never serves a similar query, so every chat embeds on lookup and store
+    rag = Rag(llm=llm, retriever=FakeSearch(), semantic_cache=SemanticCache(embed_fn=fake_embed, threshold=1.01),
+              stream_min_contexts=4)
+    question = "Plan a trip: where to eat in Hanoi, how to reach Ha Long Bay and what to see in Hue? (traveller {})"
+
+    def report(name: str, latencies: List[float], elapsed: float) -> None:
+        latencies = sorted(latencies)
+        print(f"{name}: {len(latencies)} in {elapsed:.1f} s, p50 = {latencies[len(latencies) // 2] * 1000:,.0f} ms, "
+              f"p99 = {latencies[int(len(latencies) * 0.99)] * 1000:,.0f} ms, peak sessions = {peak['sessions']}/{pool.max_size}")
+        peak["sessions"] = 0
+
+    async def timed(coroutine) -> float:
+        start = time.perf_counter()
+        await coroutine
+        return time.perf_counter() - start
+
+    async def rag_chats(chats: int) -> None:
+        # /rag: cache lookup, decomposition, three HyDE documents and searches, generation, cache store
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(timed(rag.acomplete(question.format(i))) for i in range(chats)))
+        report("/rag chats", latencies, time.perf_counter() - start)
+
+    async def stream_rag_ttft(chats: int, pipeline: bool) -> None:
+        async def first_token(i: int) -> float:
+            start = time.perf_counter()
+            responses = rag.astream_complete(question.format(f"s{pipeline}{i}"), pipeline=pipeline)
+            try:
+                async for response in responses:
+                    if response.delta:
+                        return time.perf_counter() - start
+            finally:
+                await responses.aclose()
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(first_token(i) for i in range(chats)))
+        report(f"/stream_rag time to first token, {'overlapped' if pipeline else 'sequential'}",
+               latencies, time.perf_counter() - start)
+
+    async def slow_readers(readers: int, completions: int) -> None:
+        # /stream_chat clients reading one delta every 100 ms, while /complete calls arrive
+        async def read_slowly() -> None:
+            async for _ in await llm.astream_complete("Tell me about Hoi An."):
+                await asyncio.sleep(0.1)
+
+        streams = [asyncio.ensure_future(read_slowly()) for _ in range(readers)]
+        await asyncio.sleep(1.0)
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(timed(llm.acomplete(f"Hello {i}")) for i in range(completions)))
+        report(f"/complete next to {readers} slow /stream_chat readers", latencies, time.perf_counter() - start)
+        print(f"  cortex_complete slots held by the slow readers meanwhile: {limiter.in_flight.get('cortex_complete', 0)}")
+        await asyncio.gather(*streams)
+
+    async def main() -> None:
+        print(f"Limits: {limiter.limits}, shared session budget {limiter.shared_limit}")
+        await rag_chats(200)
+        await stream_rag_ttft(20, pipeline=False)
+        await stream_rag_ttft(20, pipeline=True)
+        await slow_readers(50, 50)
+
+    asyncio.run(main())
+    limiter.close()
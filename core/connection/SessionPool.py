@@ -0,0 +1,345 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from snowflake.snowpark import Session
+
+# Connector error codes raised when the session or its master token has expired
+SESSION_EXPIRED_ERRNOS = {390111, 390112, 390114}
+
+# Callbacks notified with every session the pools close, e.g. to drop cached handles
+_discard_listeners: List[Callable[[Session], None]] = []
+
+
+def is_session_expired(error: Exception) -> bool:
+    """
+    Check whether an exception was caused by an expired Snowflake session.
+
+    :param error: The exception raised by a Snowflake call.
+    :return: True if the session (or its token) has expired.
+    """
+    if getattr(error, "errno", None) in SESSION_EXPIRED_ERRNOS:
+        return True
+    message = str(error).lower()
+    return "session" in message and ("expired" in message or "no longer exists" in message)
+
+
+def is_connection_error(error: Exception) -> bool:
+    """
+    Check whether an exception means the session can no longer be used.
+
+    :param error: The exception raised by a Snowflake call.
+    :return: True if the session should be discarded rather than returned to the pool.
+    """
+    if is_session_expired(error):
+        return True
+    message = str(error).lower()
+    return "connection is closed" in message or "session is closed" in message or "connection reset" in message
+
+
+def register_discard_listener(callback: Callable[[Session], None]) -> None:
+    """
+    Register a callback that is invoked with every session a pool closes.
+
+    :param callback: Callable taking the discarded session.
+    """
+    if callback not in _discard_listeners:
+        _discard_listeners.append(callback)
+
+
+def connection_params_from_env() -> Dict[str, str]:
+    """
+    Read the Snowflake connection parameters from the environment (and the repo's .env file).
+
+    :return: The parameters accepted by `Session.builder.configs`.
+    """
+    load_dotenv(Path(__file__).resolve().parents[2] / ".env")
+    load_dotenv()
+
+    params = {
+        "account": os.environ["SNOWFLAKE_ACCOUNT"],
+        "user": os.environ["SNOWFLAKE_USER"],
+        "password": os.environ["SNOWFLAKE_USER_PASSWORD"],
+    }
+    optional = {
+        "role": "SNOWFLAKE_ROLE",
+        "database": "SNOWFLAKE_DATABASE",
+        "schema": "SNOWFLAKE_SCHEMA",
+        "warehouse": "SNOWFLAKE_WAREHOUSE",
+    }
+    for key, env_var in optional.items():
+        if os.getenv(env_var):
+            params[key] = os.environ[env_var]
+    return params
+
+
+class _PooledSession:
+    __slots__ = ("session", "last_used", "last_checked")
+
+    def __init__(self, session: Session):
+        now = time.monotonic()
+        self.session = session
+        self.last_used = now
+        self.last_checked = now
+
+
+class SessionPool:
+    """
+    Thread-safe pool of Snowpark sessions shared by the LLM, RAG and transforms.
+
+    Sessions are opened lazily, up to `max_size` at once. Idle sessions above
+    `min_size` are closed after `idle_timeout` seconds, and a session that has been
+    idle for more than `probe_interval` seconds is probed with `SELECT 1` before it
+    is handed out. Dead sessions are closed and replaced transparently.
+
+    :param connection_params: dict, default None. Parameters for `Session.builder.configs`.
+                              If None, they are read from the environment on first use.
+    :param min_size: int, default 1. Number of idle sessions kept open.
+    :param max_size: int, default 8. Maximum number of open sessions.
+    :param idle_timeout: float, default 300. Seconds after which an idle session is closed.
+    :param probe_interval: float, default 60. Seconds of idleness after which a session is probed.
+    :param checkout_timeout: float, default 30. Seconds to wait for a free session.
+    :param session_factory: callable, default None. Creates a session from the connection parameters.
+    """
+
+    def __init__(self,
+                 connection_params: Optional[Dict[str, str]] = None,
+                 min_size: int = 1,
+                 max_size: int = 8,
+                 idle_timeout: float = 300.0,
+                 probe_interval: float = 60.0,
+                 checkout_timeout: float = 30.0,
+                 session_factory: Optional[Callable[[Dict[str, str]], Session]] = None):
+        assert max_size >= 1, "max_size must be at least 1."
+        assert 0 <= min_size <= max_size, "min_size must be between 0 and max_size."
+
+        self._connection_params = connection_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.probe_interval = probe_interval
+        self.checkout_timeout = checkout_timeout
+        self._session_factory = session_factory or (lambda params: Session.builder.configs(params).create())
+
+        self._idle: deque = deque()
+        self._in_use: Dict[int, _PooledSession] = {}
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def connection_params(self) -> Dict[str, str]:
+        if self._connection_params is None:
+            self._connection_params = connection_params_from_env()
+        return self._connection_params
+
+    @property
+    def size(self) -> int:
+        """Number of open sessions, idle or checked out."""
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        """Number of idle sessions."""
+        return len(self._idle)
+
+    def warm(self) -> None:
+        """
+        Open sessions until `min_size` sessions are idle.
+        """
+        sessions = [self.checkout() for _ in range(max(0, self.min_size - self.idle))]
+        for session in sessions:
+            self.checkin(session)
+
+    def checkout(self, timeout: Optional[float] = None) -> Session:
+        """
+        Take a healthy session from the pool, opening a new one if needed.
+
+        :param timeout: Seconds to wait for a free session. Defaults to `checkout_timeout`.
+        :return: A Snowpark session. Return it with `checkin`.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            to_close = []
+            candidate = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Session pool is closed.")
+                to_close = self._evict_idle()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No Snowpark session became available within {timeout}s.")
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise RuntimeError("Session pool is closed.")
+                if self._idle:
+                    candidate = self._idle.pop()
+                else:
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+                    create = True
+
+            self._close_sessions(to_close)
+
+            if create:
+                try:
+                    candidate = _PooledSession(self._session_factory(self.connection_params))
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif time.monotonic() - candidate.last_checked > self.probe_interval and not self._is_alive(candidate.session):
+                self._discard(candidate)
+                continue
+
+            candidate.last_checked = time.monotonic()
+            with self._cond:
+                self._in_use[id(candidate.session)] = candidate
+            return candidate.session
+
+    def checkin(self, session: Session, discard: bool = False) -> None:
+        """
+        Return a session to the pool.
+
+        :param session: The session obtained from `checkout`.
+        :param discard: If True, close the session instead of reusing it.
+        """
+        with self._cond:
+            pooled = self._in_use.pop(id(session), None)
+            if pooled is None:
+                return
+            if not discard and not self._closed:
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+                self._cond.notify()
+                return
+
+        self._discard(pooled)
+
+    @contextmanager
+    def session(self, timeout: Optional[float] = None) -> Iterator[Session]:
+        """
+        Check out a session for the duration of a `with` block.
+
+        The session is discarded instead of returned if the block fails with a
+        connection or expiry error, so the next checkout reconnects.
+        """
+        session = self.checkout(timeout=timeout)
+        discard = False
+        try:
+            yield session
+        except Exception as e:
+            discard = is_connection_error(e)
+            raise
+        finally:
+            self.checkin(session, discard=discard)
+
+    def close(self) -> None:
+        """
+        Close every idle session and refuse further checkouts.
+        Checked-out sessions are closed when they are checked in.
+        """
+        with self._cond:
+            self._closed = True
+            to_close = list(self._idle)
+            self._idle.clear()
+            self._size -= len(to_close)
+            self._cond.notify_all()
+        self._close_sessions(to_close)
+
+    def _evict_idle(self) -> List[_PooledSession]:
+        # Caller holds the lock. Oldest idle sessions sit at the left of the deque.
+        evicted = []
+        now = time.monotonic()
+        while (self._idle
+               and self._size - len(evicted) > self.min_size
+               and now - self._idle[0].last_used > self.idle_timeout):
+            evicted.append(self._idle.popleft())
+        self._size -= len(evicted)
+        return evicted
+
+    def _discard(self, pooled: _PooledSession) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close_sessions([pooled])
+
+    @staticmethod
+    def _close_sessions(pooled_sessions: List[_PooledSession]) -> None:
+        for pooled in pooled_sessions:
+            for listener in _discard_listeners:
+                try:
+                    listener(pooled.session)
+                except Exception as e:
+                    print(f"Error notifying session discard listener: {e}")
+            try:
+                pooled.session.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_alive(session: Session) -> bool:
+        try:
+            connection = getattr(getattr(session, "_conn", None), "_conn", None)
+            if connection is not None and connection.is_closed():
+                return False
+            session.sql("SELECT 1").collect()
+            return True
+        except Exception as e:
+            print(f"Snowpark session failed liveness probe: {e}")
+            return False
+
+
+_default_pool: Optional[SessionPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_session_pool() -> SessionPool:
+    """
+    Return the process-wide session pool, creating it on first use.
+    No session is opened until the first checkout.
+
+    SNOWFLAKE_POOL_MAX_SIZE (default 32) also sizes the upstream limiter's budget,
+    see `core.concurrency.Limiter.default_limits`.
+
+    :return: The shared SessionPool.
+    """
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = SessionPool(
+                    min_size=int(os.getenv("SNOWFLAKE_POOL_MIN_SIZE", 1)),
+                    max_size=int(os.getenv("SNOWFLAKE_POOL_MAX_SIZE", 32)),
+                    idle_timeout=float(os.getenv("SNOWFLAKE_POOL_IDLE_TIMEOUT", 300)),
+                )
+    return _default_pool
+
+
+def set_session_pool(pool: SessionPool) -> None:
+    """
+    Replace the process-wide session pool, e.g. with one built from explicit parameters.
+
+    :param pool: The SessionPool to share.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        _default_pool = pool
+
+
+if __name__ == "__main__":
+    pool = SessionPool(min_size=1, max_size=2)
+    with pool.session() as session:
+        print(session.sql("SELECT CURRENT_VERSION()").collect())
+    print(f"Open sessions: {pool.size}, idle: {pool.idle}")
+    pool.close()
@@ -0,0 +1,113 @@
+import hashlib
+import re
+from typing import List, Optional
+
+import numpy as np
+
+from core.connection.SessionPool import SessionPool, get_session_pool
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scale every row to unit length so that dot products are cosine similarities.
+
+    :param matrix: 2D array of embeddings.
+    :return: The row-normalized float32 array.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class CortexEmbedder:
+    """
+    Embeds text with Snowflake Cortex `EmbedText768` on a pooled session.
+
+    :param model: str, default "snowflake-arctic-embed-m". The Cortex embedding model.
+    :param session_pool: SessionPool, default None. If None, the process-wide pool is used.
+    """
+
+    dimension = 768
+
+    def __init__(self,
+                 model: str = "snowflake-arctic-embed-m",
+                 session_pool: Optional[SessionPool] = None):
+        self.model = model
+        self._session_pool = session_pool
+
+    def __call__(self, text: str) -> np.ndarray:
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed several texts on one session.
+
+        :param texts: The texts to embed.
+        :return: A (len(texts), 768) array of unit-length embeddings.
+        """
+        from snowflake.cortex import EmbedText768
+
+        pool = self._session_pool or get_session_pool()
+        with pool.session() as session:
+            vectors = [EmbedText768(self.model, text, session=session) for text in texts]
+        return normalize_rows(np.array(vectors, dtype=np.float32).reshape(len(texts), self.dimension))
+
+
+class HashingEmbedder:
+    """
+    Local, dependency-free embedder based on the hashing trick over word unigrams,
+    word bigrams and character trigrams. It needs no network round trip, which makes
+    it suitable for offline development and for near-exact query matching.
+
+    :param dimension: int, default 512. Size of the embedding vectors.
+    """
+
+    def __init__(self, dimension: int = 512):
+        self.dimension = dimension
+
+    def _features(self, text: str) -> List[str]:
+        words = TOKEN_PATTERN.findall(text.lower())
+        features = list(words)
+        features += [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        return features
+
+    def __call__(self, text: str) -> np.ndarray:
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed several texts.
+
+        :param texts: The texts to embed.
+        :return: A (len(texts), dimension) array of unit-length embeddings.
+        """
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                sign = 1.0 if value & 1 else -1.0
+                matrix[row, (value >> 1) % self.dimension] += sign
+        return normalize_rows(matrix)
+
+
+def embedder_from_meta(meta: dict, session_pool: Optional[SessionPool] = None):
+    """
+    Build the embedder an index was written with, from the description saved next to it.
+
+    :param meta: dict with the "embedder" class name, and its "model" or "dimension".
+    :param session_pool: SessionPool, default None. The pool a CortexEmbedder embeds on.
+    :return: A CortexEmbedder or HashingEmbedder matching the index.
+    """
+    name = meta.get("embedder")
+    if name == "CortexEmbedder":
+        return CortexEmbedder(model=meta.get("model", "snowflake-arctic-embed-m"), session_pool=session_pool)
+    if name == "HashingEmbedder":
+        return HashingEmbedder(dimension=int(meta.get("dimension", 512)))
+    raise ValueError(f"Unknown embedder {name!r}. Choose from 'CortexEmbedder' and 'HashingEmbedder'.")
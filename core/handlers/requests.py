@@ -1,27 +1,45 @@
 from pydantic import BaseModel, Field
 from typing import Optional, List, Tuple
 
+from geo.itinerary import Vehicle
+
 class CompletionRequest(BaseModel):
     prompt: str
     model: Optional[str] = Field("mistral-large2", description="The model name to use.")
 
 class ChatRequest(BaseModel):
     prompt: str
-    history: Optional[List[dict]] = Field([], description="The history of previous interactions.")
+    history: Optional[List[dict]] = Field([], description="The history of previous interactions. Ignored when session_id is set.")
+    session_id: Optional[str] = Field(None, description="The server-side chat session holding the history, from POST /sessions.")
     model: Optional[str] = Field("mistral-large2", description="The model name to use.")
 
 class RAGCompleteRequest(BaseModel):
     prompt: str
     model: Optional[str] = Field("mistral-large2", description="The model name to use.")
+    current_location: Optional[Tuple[float, float]] = Field(None, description="The user's coordinates, to only use information about nearby places.")
 
 class RAGChatRequest(BaseModel):
     prompts: str
-    history: Optional[List[dict]] = Field([], description="The history of previous interactions.")
+    history: Optional[List[dict]] = Field([], description="The history of previous interactions. Ignored when session_id is set.")
+    session_id: Optional[str] = Field(None, description="The server-side chat session holding the history, from POST /sessions.")
     model: Optional[str] = Field("mistral-large2", description="The model name to use.")
+    current_location: Optional[Tuple[float, float]] = Field(None, description="The user's coordinates, to only use information about nearby places.")
 
 class RouteRequest(BaseModel):
     destination: str
     current_location: Tuple[float, float] = Field(None, description="The current location coordinates.")
 
+class ItineraryRequest(BaseModel):
+    stops: List[str] = Field(..., description="The places to visit, as addresses or landmark names.")
+    current_location: Optional[Tuple[float, float]] = Field(None, description="The starting coordinates. The first stop if not given.")
+    vehicle: Vehicle = Field("foot-walking", description="The OpenRouteService profile: driving-car, foot-walking or cycling-regular.")
+    round_trip: Optional[bool] = Field(False, description="Whether to come back to the starting point.")
+
+class NearbyRequest(BaseModel):
+    current_location: Tuple[float, float] = Field(..., description="The current location coordinates.")
+    k: Optional[int] = Field(5, description="The number of places to return.")
+    radius_km: Optional[float] = Field(None, description="Only return places within this distance, in kilometers.")
+    vehicle: Vehicle = Field("foot-walking", description="The profile travel times are estimated for: driving-car, foot-walking or cycling-regular.")
+
 class AudioRequest(BaseModel):
     filepath: str = Field(..., description="The path to the audio file.")
\ No newline at end of file
@@ -0,0 +1,296 @@
+import json
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
+
+import anyio
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from llama_index.core.llms import CompletionResponse
+from starlette.concurrency import run_in_threadpool
+
+SSE_MEDIA_TYPE = "text/event-stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class ChunkCoalescer:
+    """
+    Merges small deltas into larger chunks.
+
+    A chunk is emitted once it holds `min_chars` characters or `max_delay` seconds
+    have passed since the previous one, so fast token streams are not sent one
+    character at a time while slow ones still reach the client promptly.
+
+    :param min_chars: int, default 32. Characters after which a chunk is flushed.
+    :param max_delay: float, default 0.05. Seconds after which a non-empty chunk is flushed.
+    """
+
+    def __init__(self, min_chars: int = 32, max_delay: float = 0.05):
+        self.min_chars = min_chars
+        self.max_delay = max_delay
+        self._parts: List[str] = []
+        self._buffer: List[str] = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def push(self, delta: str) -> Optional[str]:
+        """
+        Add a delta, returning a chunk if one is due.
+        """
+        if not delta:
+            return None
+        self._parts.append(delta)
+        self._buffer.append(delta)
+        self._buffered += len(delta)
+        if self._buffered >= self.min_chars or time.monotonic() - self._last_flush >= self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """
+        Return whatever is buffered, or None if nothing is.
+        """
+        if not self._buffer:
+            return None
+        chunk = "".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        self._last_flush = time.monotonic()
+        return chunk
+
+    @property
+    def text(self) -> str:
+        """
+        Everything pushed so far.
+        """
+        return "".join(self._parts)
+
+
+def _collect(response: CompletionResponse, final: Optional[Dict[str, Any]]) -> bool:
+    """
+    Record the `additional_kwargs` of a streamed response in `final`.
+
+    :return: True if the response reports a failure, whose message is then `final["error"]`.
+    """
+    info = response.additional_kwargs or {}
+    if "error" in info:
+        if final is None:
+            raise RuntimeError(info["error"])
+        final["error"] = info["error"]
+        return True
+    if final is not None and info:
+        final.setdefault("additional_kwargs", {}).update(info)
+    return False
+
+
+def coalesce(responses: Iterator[CompletionResponse],
+             min_chars: int = 32,
+             max_delay: float = 0.05,
+             final: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    Merge the deltas of a completion stream with a `ChunkCoalescer`.
+
+    :param responses: The streamed CompletionResponses.
+    :param final: dict, default None. Filled with the full text once the stream is exhausted,
+                  and with the `additional_kwargs` of the responses, e.g. the pipeline timings.
+                  If a response carries an "error", the stream stops and only the error is set.
+    :yield: The coalesced text chunks.
+    """
+    coalescer = ChunkCoalescer(min_chars=min_chars, max_delay=max_delay)
+    for response in responses:
+        if _collect(response, final):
+            break
+        chunk = coalescer.push(response.delta)
+        if chunk is not None:
+            yield chunk
+    chunk = coalescer.flush()
+    if chunk is not None:
+        yield chunk
+    if final is not None and "error" not in final:
+        final["text"] = coalescer.text
+
+
+def format_event(data: Dict[str, Any], media_type: str = SSE_MEDIA_TYPE, event: Optional[str] = None) -> str:
+    """
+    Serialize one stream event as an SSE message or an NDJSON line.
+    """
+    payload = json.dumps(data, ensure_ascii=False)
+    if media_type == NDJSON_MEDIA_TYPE:
+        return payload + "\n"
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {payload}\n\n"
+
+
+def negotiate_media_type(request: Request) -> str:
+    """
+    NDJSON if the client asks for it with `?format=ndjson` or its Accept header, SSE otherwise.
+    """
+    if request.query_params.get("format") == "ndjson" or NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return NDJSON_MEDIA_TYPE
+    return SSE_MEDIA_TYPE
+
+
+async def _relay_blocking(request: Request,
+                          responses: Iterator[CompletionResponse],
+                          final: Dict[str, Any],
+                          min_chars: int,
+                          max_delay: float) -> AsyncIterator[str]:
+    # The next chunk is only pulled, in a worker thread, once the previous one was sent
+    chunks = coalesce(responses, min_chars=min_chars, max_delay=max_delay, final=final)
+    try:
+        while not await request.is_disconnected():
+            chunk = await run_in_threadpool(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+        print("Client disconnected, stopping the stream.")
+    finally:
+        # Also runs when the server cancels the response on disconnect
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(chunks.close)
+            if hasattr(responses, "close"):
+                await run_in_threadpool(responses.close)
+
+
+async def _relay_async(request: Request,
+                       responses: AsyncIterator[CompletionResponse],
+                       final: Dict[str, Any],
+                       min_chars: int,
+                       max_delay: float) -> AsyncIterator[str]:
+    coalescer = ChunkCoalescer(min_chars=min_chars, max_delay=max_delay)
+    try:
+        async for response in responses:
+            if await request.is_disconnected():
+                print("Client disconnected, stopping the stream.")
+                return
+            if _collect(response, final):
+                break
+            chunk = coalescer.push(response.delta)
+            if chunk is not None:
+                yield chunk
+        chunk = coalescer.flush()
+        if chunk is not None:
+            yield chunk
+        if "error" not in final:
+            final["text"] = coalescer.text
+    finally:
+        with anyio.CancelScope(shield=True):
+            if hasattr(responses, "aclose"):
+                await responses.aclose()
+
+
+async def stream_events(request: Request,
+                        responses: Union[Iterator[CompletionResponse], AsyncIterator[CompletionResponse]],
+                        media_type: str = SSE_MEDIA_TYPE,
+                        done: Optional[Dict[str, Any]] = None,
+                        on_done: Optional[Callable[[str], Any]] = None,
+                        min_chars: int = 32,
+                        max_delay: float = 0.05) -> AsyncIterator[str]:
+    """
+    Relay a completion stream to an ASGI response.
+
+    Chunks are only pulled from `responses` after the previous one was handed to
+    the server, so a slow client slows a blocking upstream stream down instead of
+    piling chunks up in memory. RagoonBot's async streams are drained by their
+    worker regardless, so a slow client holds neither a session nor a limiter
+    slot, only the answer text. When the client goes away the upstream generator is
+    closed, which stops the LLM call and returns its pooled session. Blocking
+    generators are iterated in a worker thread. A failure, raised or reported by an
+    `error_response`, closes the stream with an "error" event instead of "done".
+
+    :param request: The incoming request, polled for client disconnects.
+    :param responses: The streamed CompletionResponses, a generator or an async generator.
+    :param media_type: SSE or NDJSON.
+    :param done: dict, default None. Extra fields for the closing "done" event. The `additional_kwargs`
+                 of the responses, e.g. the pipeline's "timings" and "packing", are added to it too.
+    :param on_done: Callable, default None. Called in a worker thread with the full text
+                    once the stream completed successfully, e.g. to store the answer in a chat session.
+    :yield: The serialized events.
+    """
+    final: Dict[str, Any] = {}
+    relay = _relay_async if hasattr(responses, "__anext__") else _relay_blocking
+    chunks = relay(request, responses, final, min_chars, max_delay)
+    try:
+        async for chunk in chunks:
+            yield format_event({"delta": chunk}, media_type)
+        if "error" in final:
+            yield format_event({"error": final["error"], "done": True}, media_type, event="error")
+        elif "text" in final:
+            if on_done is not None:
+                await run_in_threadpool(on_done, final["text"])
+            info = final.get("additional_kwargs", {})
+            yield format_event({**info, **(done or {}), "text": final["text"], "done": True}, media_type, event="done")
+    except Exception as e:
+        yield format_event({"error": str(e), "done": True}, media_type, event="error")
+    finally:
+        with anyio.CancelScope(shield=True):
+            await chunks.aclose()
+
+
+def streaming_response(request: Request,
+                       responses: Union[Iterator[CompletionResponse], AsyncIterator[CompletionResponse]],
+                       done: Optional[Dict[str, Any]] = None,
+                       on_done: Optional[Callable[[str], Any]] = None) -> StreamingResponse:
+    """
+    Build the StreamingResponse for a completion stream in the format the client asked for.
+
+    :param request: The incoming request.
+    :param responses: The streamed CompletionResponses.
+    :param done: dict, default None. Extra fields for the closing "done" event, e.g. the updated history.
+    :param on_done: Callable, default None. Called with the full text once the stream completed.
+    :return: The StreamingResponse.
+    """
+    media_type = negotiate_media_type(request)
+    return StreamingResponse(
+        stream_events(request, responses, media_type=media_type, done=done, on_done=on_done),
+        media_type=media_type,
+        # Stop reverse proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+if __name__ == "__main__":
+    # Run with `python -m core.handlers.streaming`, as a script requests.py next to this file shadows requests
+    import asyncio
+
+    from core.connection.SessionPool import SessionPool
+    from core.llm import CustomLLM
+
+    # A local stand-in for Cortex: the first token after 300 ms, then one token every 10 ms
+    FIRST_TOKEN_DELAY, TOKEN_DELAY, TOKENS = 0.3, 0.01, 100
+
+    def fake_complete(model, prompt, options=None, session=None, stream=False):
+        def tokens():
+            time.sleep(FIRST_TOKEN_DELAY)
+            for i in range(TOKENS):
+                if i:
+                    time.sleep(TOKEN_DELAY)
+                yield f"token{i} "
+        return tokens() if stream else "".join(tokens())
+
+    class FakeSession:
+        def close(self):
+            pass
+
+    class FakeRequest:
+        async def is_disconnected(self):
+            return False
+
+    CustomLLM.Complete = fake_complete
+    llm = CustomLLM.RagoonBot(session_pool=SessionPool(connection_params={}, session_factory=lambda params: FakeSession()))
+
+    def buffered():
+        # What stream_complete did before: wait for the whole answer, then replay it
+        text = llm.complete("Where should I eat in Hanoi?").text
+        for i in range(len(text)):
+            yield CompletionResponse(text=text[:i + 1], delta=text[i])
+
+    async def measure(responses):
+        start = time.perf_counter()
+        first = None
+        async for event in stream_events(FakeRequest(), responses):
+            if first is None:
+                first = time.perf_counter() - start
+        return first, time.perf_counter() - start
+
+    for name, responses in (("buffered", buffered), ("streamed", lambda: llm.stream_complete("Where should I eat in Hanoi?"))):
+        ttft, total = asyncio.run(measure(responses()))
+        print(f"{name}: time to first token {ttft * 1000:.0f} ms, full answer {total * 1000:.0f} ms")
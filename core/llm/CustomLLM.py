@@ -1,69 +1,179 @@
 import os
-from typing import Any, List, Optional
+import threading
+import asyncio
+from typing import Any, Dict, Iterator, List, Optional
 
-from dotenv import load_dotenv
 from snowflake.snowpark import Session
-from snowflake.cortex import Complete
+from snowflake.cortex import Complete, CompleteOptions
 from llama_index.core.llms import (
     CustomLLM,
     CompletionResponse,
+    CompletionResponseAsyncGen,
     CompletionResponseGen,
     LLMMetadata,
 )
 from llama_index.core.llms.callbacks import llm_completion_callback
+from pydantic import PrivateAttr
+from core.connection.SessionPool import SessionPool, get_session_pool, is_connection_error
+from core.cache.CompletionCache import CompletionCache, get_completion_cache
+from core.concurrency.Limiter import get_limiter
+from core.memory.HistoryManager import HistoryManager, get_history_manager
 
-load_dotenv('../../.env')
+def build_prompt(user_text: str, history: Optional[List[dict]] = None) -> str:
+    """
+    Combine the history and the user text into the prompt sent to Complete.
+
+    :param user_text: The input prompt for the model.
+    :param history: Optional history of previous interactions.
+    :return: The full prompt.
+    """
+    history_text = ""
+    if history:
+        history_text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in history])
+
+    return f"{history_text}\nUser: {user_text}\nAssistant:"
+
+def complete_options(temperature: Optional[float] = None) -> Optional[CompleteOptions]:
+    """
+    Build the Complete options for the given sampling settings.
+
+    :param temperature: Optional sampling temperature. If None, the model default is used.
+    :return: The options to pass to Complete, or None when every setting is the default.
+    """
+    if temperature is None:
+        return None
+    return CompleteOptions(temperature=temperature)
+
+def error_response(error: Any, **info: Any) -> CompletionResponse:
+    """
+    The closing response of a failed completion.
 
-connection_params = {
-    "account": os.environ["SNOWFLAKE_ACCOUNT"],
-    "user": os.environ["SNOWFLAKE_USER"],
-    "password": os.environ["SNOWFLAKE_USER_PASSWORD"],
-}
+    Its text keeps the "Error: ..." form callers check for, and `additional_kwargs["error"]`
+    marks it as a failure, so streaming relays do not pass it on as an answer.
 
-snowflake_session = Session.builder.configs(connection_params).create()
+    :param error: The exception or message.
+    :param info: Further `additional_kwargs`, e.g. the cache info or pipeline timings.
+    :return: A CompletionResponse with an empty delta.
+    """
+    message = str(error)
+    return CompletionResponse(text=f"Error: {message}", delta="", additional_kwargs={**info, "error": message})
+
+def is_error(response: CompletionResponse) -> bool:
+    """
+    Whether a response reports a failed completion rather than an answer.
+    """
+    return "error" in (response.additional_kwargs or {}) or (response.text or "").startswith("Error:")
 
 def complete(user_text: str,
              model: str = "mistral-large2",
-             history: Optional[List[dict]] = None) -> str:
+             history: Optional[List[dict]] = None,
+             session: Optional[Session] = None,
+             cache: Optional[CompletionCache] = None,
+             temperature: Optional[float] = None) -> str:
     """
     Perform a completion using Snowflake's Complete API.
 
     :param user_text: The input prompt for the model.
     :param model: The model to use for completion.
     :param history: Optional history of previous interactions.
+    :param session: Optional Snowpark session. If None, one is checked out of the shared pool.
+    :param cache: Optional completion cache. A cached answer is returned without calling Complete.
+    :param temperature: Optional sampling temperature sent to Complete, part of the cache key.
     :return: The generated completion text.
     """
-    # Combine history with the user prompt
-    history_text = ""
-    if history:
-        history_text = "\n".join([f"{entry['role']}: {entry['content']}" for entry in history])
-
     # Create the full prompt
-    full_prompt = f"{history_text}\nUser: {user_text}\nAssistant:"
+    full_prompt = build_prompt(user_text, history)
+
+    if cache is not None:
+        key = cache.make_key(model, full_prompt, temperature)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        completion = complete(user_text, model=model, history=history, session=session, temperature=temperature)
+        if not completion.startswith("Error:"):
+            cache.put(key, completion)
+        return completion
+
+    if session is None:
+        with get_session_pool().session() as pooled_session:
+            return complete(user_text, model=model, history=history, session=pooled_session, temperature=temperature)
 
     # Perform the completion
     try:
         completion = Complete(
             model=model,
             prompt=full_prompt,
-            session=snowflake_session
+            options=complete_options(temperature),
+            session=session
         )
         return completion
     except Exception as e:
+        if is_connection_error(e):
+            # Let the session pool discard the dead session
+            raise
         return f"Error: {e}"
 
+def stream_complete(user_text: str,
+                    model: str = "mistral-large2",
+                    history: Optional[List[dict]] = None,
+                    session: Optional[Session] = None,
+                    temperature: Optional[float] = None,
+                    raise_errors: bool = False) -> Iterator[str]:
+    """
+    Perform a streamed completion using Snowflake's Complete API.
+
+    :param user_text: The input prompt for the model.
+    :param model: The model to use for completion.
+    :param history: Optional history of previous interactions.
+    :param session: Optional Snowpark session. If None, one is checked out of the shared pool
+                    and held until the stream is exhausted or closed.
+    :param temperature: Optional sampling temperature sent to Complete.
+    :param raise_errors: bool, default False. Raise failures instead of yielding them as an "Error: ..." delta.
+    :yield: The text deltas as Cortex produces them.
+    """
+    if session is None:
+        with get_session_pool().session() as pooled_session:
+            yield from stream_complete(
+                user_text, model=model, history=history, session=pooled_session, temperature=temperature,
+                raise_errors=raise_errors
+            )
+        return
+
+    try:
+        prompt = build_prompt(user_text, history)
+        options = complete_options(temperature)
+        for delta in Complete(model=model, prompt=prompt, options=options, session=session, stream=True):
+            yield delta
+    except Exception as e:
+        if raise_errors or is_connection_error(e):
+            # The session pool discards a dead session
+            raise
+        yield f"Error: {e}"
+
 class RagoonBot(CustomLLM):
     """
     RagoonBot is a custom LLM model that uses Snowflake's Complete API to generate text completions.
 
     :param model: str, default "mistral-large2". The model name to use.
     :param context_window: int, default 3900. The context window size.
+    :param session_pool: SessionPool, default None. The Snowpark session pool to use.
+                         If None, the process-wide pool is used.
+    :param completion_cache: CompletionCache, default None. Opt-in cache of completions
+                             keyed on (model, full prompt, temperature).
+    :param history_manager: HistoryManager, default None. Compacts long histories before they are
+                            put in the prompt. If None, the process-wide manager is used.
     """
     model: str = "mistral-large2"
+    _session_pool: Optional[SessionPool] = PrivateAttr(default=None)
+    _completion_cache: Optional[CompletionCache] = PrivateAttr(default=None)
+    _history_manager: Optional[HistoryManager] = PrivateAttr(default=None)
 
     def __init__(
         self, 
         model: str = "mistral-large2",
+        session_pool: Optional[SessionPool] = None,
+        completion_cache: Optional[CompletionCache] = None,
+        history_manager: Optional[HistoryManager] = None,
         **kwargs: Any
     ):
         """
@@ -71,12 +181,92 @@ class RagoonBot(CustomLLM):
 
         :param model: The model name to use for completions.
         :param context_window: The context window size.
+        :param session_pool: The Snowpark session pool to check sessions out of.
+        :param completion_cache: Optional cache of completions.
+        :param history_manager: Optional history manager.
         :param kwargs: Additional keyword arguments.
         """
         super().__init__(**kwargs)
         self.model = model
+        self._session_pool = session_pool
+        self._completion_cache = completion_cache
+        self._history_manager = history_manager
         print(f"RagoonBot initialized with model: {self.model}")
 
+    @property
+    def session_pool(self) -> SessionPool:
+        """
+        The Snowpark session pool used for completions.
+        """
+        return self._session_pool or get_session_pool()
+
+    @property
+    def completion_cache(self) -> Optional[CompletionCache]:
+        return self._completion_cache
+
+    @property
+    def history_manager(self) -> HistoryManager:
+        return self._history_manager or get_history_manager()
+
+    def _cache_key(self, prompt: str, history: Optional[List[dict]], **kwargs: Any) -> Optional[str]:
+        if self._completion_cache is None:
+            return None
+        return self._completion_cache.make_key(self.model, build_prompt(prompt, history), kwargs.get("temperature"))
+
+    def _cache_info(self, hit: bool) -> dict:
+        # Reported in the response's additional_kwargs, which llama_index hands to callback handlers
+        if self._completion_cache is None:
+            return {}
+        return {"cache_hit": hit, "cache_stats": self._completion_cache.stats.as_dict()}
+
+    def _pooled_complete(self,
+                         prompt: str,
+                         history: Optional[List[dict]] = None,
+                         temperature: Optional[float] = None) -> str:
+        """
+        Run a completion on a pooled session, reconnecting once if the session died.
+        """
+        for attempt in range(2):
+            try:
+                with self.session_pool.session() as session:
+                    return complete(
+                        user_text=prompt,
+                        model=self.model,
+                        history=history,
+                        session=session,
+                        temperature=temperature
+                    )
+            except Exception as e:
+                if attempt or not is_connection_error(e):
+                    raise
+
+    def _pooled_stream(self,
+                       prompt: str,
+                       history: Optional[List[dict]] = None,
+                       temperature: Optional[float] = None) -> Iterator[str]:
+        """
+        Stream a completion on a pooled session, reconnecting once if the session
+        died before the first delta arrived.
+        """
+        for attempt in range(2):
+            started = False
+            try:
+                with self.session_pool.session() as session:
+                    for delta in stream_complete(
+                        user_text=prompt,
+                        model=self.model,
+                        history=history,
+                        session=session,
+                        temperature=temperature,
+                        raise_errors=True
+                    ):
+                        started = True
+                        yield delta
+                return
+            except Exception as e:
+                if started or attempt or not is_connection_error(e):
+                    raise
+
     @property
     def metadata(self) -> LLMMetadata:
         """
@@ -101,18 +291,35 @@ class RagoonBot(CustomLLM):
 
         :param prompt: The input text prompt.
         :param history: Optional history of previous interactions.
+        :param temperature: Optional sampling temperature sent to Complete.
         :return: A CompletionResponse containing the generated text.
         """
+        return self._complete_response(prompt, history=history, **kwargs)
+
+    def _complete_response(
+        self,
+        prompt: str,
+        history: Optional[List[dict]] = None,
+        **kwargs: Any
+    ) -> CompletionResponse:
+        history = self.history_manager.compact(history)
+        key = self._cache_key(prompt, history, **kwargs)
+        if key is not None:
+            cached = self._completion_cache.get(key)
+            if cached is not None:
+                return CompletionResponse(text=cached, additional_kwargs=self._cache_info(hit=True))
+
         try:
-            response_text = complete(
-                user_text=prompt,
-                model=self.model,
-                history=history
-            )
+            response_text = self._pooled_complete(prompt, history=history, temperature=kwargs.get("temperature"))
         except Exception as e:
             response_text = f"Error: {e}"
 
-        return CompletionResponse(text=response_text)
+        if response_text.startswith("Error:"):
+            return error_response(response_text[len("Error:"):].strip(), **self._cache_info(hit=False))
+        if key is not None:
+            self._completion_cache.put(key, response_text)
+
+        return CompletionResponse(text=response_text, additional_kwargs=self._cache_info(hit=False))
 
     @llm_completion_callback()
     def stream_complete(
@@ -124,24 +331,149 @@ class RagoonBot(CustomLLM):
         """
         Generate a streamed completion for the given prompt.
 
+        Deltas are yielded as Cortex produces them. To avoid rebuilding the growing
+        answer for every delta, the intermediate responses carry only the `delta`;
+        a final response with an empty delta carries the full `text`. A failure ends
+        the stream with an `error_response`.
+
         :param prompt: The input text prompt.
         :param history: Optional history of previous interactions.
+        :param temperature: Optional sampling temperature sent to Complete.
         :yield: Partial CompletionResponses as text is generated.
         """
+        yield from self._stream_responses(prompt, history=history, **kwargs)
+
+    def _stream_responses(
+        self,
+        prompt: str,
+        history: Optional[List[dict]] = None,
+        **kwargs: Any
+    ) -> CompletionResponseGen:
+        history = self.history_manager.compact(history)
+        key = self._cache_key(prompt, history, **kwargs)
+        cached = self._completion_cache.get(key) if key is not None else None
+        if cached is not None:
+            yield CompletionResponse(text=cached, delta=cached, additional_kwargs=self._cache_info(hit=True))
+            return
+
+        parts: List[str] = []
         try:
-            full_response = complete(
-                user_text=prompt,
-                model=self.model,
-                history=history
-            )
+            for delta in self._pooled_stream(prompt, history=history, temperature=kwargs.get("temperature")):
+                if delta:
+                    parts.append(delta)
+                    yield CompletionResponse(text="", delta=delta)
         except Exception as e:
-            yield CompletionResponse(text="", delta=f"Error: {e}")
+            yield error_response(e, **self._cache_info(hit=False))
             return
 
-        accumulated_text = ""
-        for char in full_response:
-            accumulated_text += char
-            yield CompletionResponse(text=accumulated_text, delta=char)
+        full_response = "".join(parts)
+        if key is not None and full_response:
+            self._completion_cache.put(key, full_response)
+        yield CompletionResponse(text=full_response, delta="", additional_kwargs=self._cache_info(hit=False))
+
+    @llm_completion_callback()
+    async def acomplete(
+        self,
+        prompt: str,
+        history: Optional[List[dict]] = None,
+        **kwargs: Any
+    ) -> CompletionResponse:
+        """
+        Generate a completion without blocking the event loop.
+
+        The blocking Cortex call runs on the "cortex_complete" pool of the shared
+        UpstreamLimiter, which also bounds how many run at once.
+
+        :param prompt: The input text prompt.
+        :param history: Optional history of previous interactions.
+        :return: A CompletionResponse containing the generated text.
+        """
+        return await get_limiter().run("cortex_complete", self._complete_response, prompt, history=history, **kwargs)
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self,
+        prompt: str,
+        history: Optional[List[dict]] = None,
+        **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        """
+        Async version of `stream_complete`.
+
+        The Cortex stream is read on the "cortex_complete" pool of the shared
+        UpstreamLimiter as fast as Cortex writes it, and the responses are queued
+        for the consumer. A slow reader therefore holds neither a limiter slot nor
+        a pooled session, only the answer's text. Closing the generator stops the
+        Cortex stream.
+
+        :param prompt: The input text prompt.
+        :param history: Optional history of previous interactions.
+        :return: An async generator of partial CompletionResponses.
+        """
+        limiter = get_limiter()
+
+        async def gen() -> CompletionResponseAsyncGen:
+            loop = asyncio.get_running_loop()
+            queue: "asyncio.Queue[Optional[CompletionResponse]]" = asyncio.Queue()
+            stop = threading.Event()
+
+            def put(response: Optional[CompletionResponse]) -> None:
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, response)
+                except RuntimeError:
+                    # The event loop is gone, nobody is reading any more
+                    stop.set()
+
+            def drain() -> None:
+                if stop.is_set():
+                    return
+                responses = self._stream_responses(prompt, history=history, **kwargs)
+                try:
+                    for response in responses:
+                        put(response)
+                        if stop.is_set():
+                            break
+                finally:
+                    # Stops the Cortex stream and returns its session
+                    responses.close()
+
+            producer = asyncio.ensure_future(limiter.run("cortex_complete", drain))
+            # Queued after every response, which the worker thread scheduled before returning
+            producer.add_done_callback(lambda _: queue.put_nowait(None))
+            try:
+                while True:
+                    response = await queue.get()
+                    if response is None:
+                        break
+                    yield response
+                # Raises if the stream could not be read
+                await producer
+            finally:
+                stop.set()
+                producer.cancel()
+
+        return gen()
+
+_llms: Dict[str, RagoonBot] = {}
+_llms_lock = threading.Lock()
+
+
+def get_llm(model: str = "mistral-large2") -> RagoonBot:
+    """
+    Return the shared RagoonBot for the given model, creating it on first use.
+    It uses the process-wide completion cache when COMPLETION_CACHE_ENABLED is set.
+
+    :param model: The model name to use for completions.
+    :return: The RagoonBot instance shared by every caller asking for this model.
+    """
+    llm = _llms.get(model)
+    if llm is None:
+        with _llms_lock:
+            llm = _llms.get(model)
+            if llm is None:
+                llm = RagoonBot(model=model, completion_cache=get_completion_cache())
+                _llms[model] = llm
+    return llm
 
 if __name__ == "__main__":
     llm = RagoonBot(model="mistral-large2")
@@ -0,0 +1,362 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+class SQLiteSessionBackend:
+    """
+    Durable, append-only storage of chat messages in a SQLite file.
+
+    Messages are only ever inserted; a session is read back ordered by its
+    sequence number and expires as a whole `ttl` seconds after its last message.
+    Messages are only inserted into sessions that exist and are still live.
+
+    :param path: str. The SQLite file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (session_id TEXT PRIMARY KEY, created_at REAL, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                session_id TEXT, seq INTEGER, role TEXT, content TEXT, created_at REAL,
+                PRIMARY KEY (session_id, seq)
+            );
+        """)
+        self._conn.commit()
+
+    def create(self, session_id: str, now: float) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO chat_sessions VALUES (?, ?, ?)", (session_id, now, now))
+            self._conn.commit()
+
+    def updated_at(self, session_id: str) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated_at FROM chat_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, session_id: str) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM chat_messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append(self, session_id: str, messages: List[dict], now: float, not_before: float) -> bool:
+        """
+        Append messages to a session last updated at or after `not_before`.
+
+        :return: False, and nothing is written, if the session does not exist or expired.
+        """
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE chat_sessions SET updated_at = ? WHERE session_id = ? AND updated_at >= ?",
+                (now, session_id, not_before)
+            ).rowcount
+            if not updated:
+                self._conn.rollback()
+                return False
+            start = self._conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM chat_messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            self._conn.executemany(
+                "INSERT INTO chat_messages VALUES (?, ?, ?, ?, ?)",
+                [(session_id, start + i, m["role"], m["content"], now) for i, m in enumerate(messages)]
+            )
+            self._conn.commit()
+        return True
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def purge(self, older_than: float) -> int:
+        """
+        Delete the sessions whose last message is older than the given timestamp.
+        """
+        with self._lock:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT session_id FROM chat_sessions WHERE updated_at < ?", (older_than,)
+            ).fetchall()]
+            self._conn.executemany("DELETE FROM chat_messages WHERE session_id = ?", [(s,) for s in expired])
+            self._conn.executemany("DELETE FROM chat_sessions WHERE session_id = ?", [(s,) for s in expired])
+            self._conn.commit()
+        return len(expired)
+
+
+class RedisSessionBackend:
+    """
+    Append-only storage of chat messages in Redis lists, expired by Redis itself.
+    Messages are only appended while the session's ":meta" key exists, checked
+    atomically in a Lua script, so an expired session is never recreated.
+
+    :param url: str. The Redis URL, e.g. redis://localhost:6379/0.
+    :param ttl: float. Seconds a session lives after its last message.
+    :param prefix: str, default "ragoon:session:". Key prefix.
+    """
+
+    def __init__(self, url: str, ttl: float, prefix: str = "ragoon:session:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("redis is required for the Redis session backend: pip install redis") from e
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        # KEYS: messages, meta. ARGV: ttl, now, messages...
+        self._append = self._redis.register_script("""
+            if redis.call('EXISTS', KEYS[2]) == 0 then return 0 end
+            redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+            redis.call('EXPIRE', KEYS[1], ARGV[1])
+            redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[1])
+            return 1
+        """)
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def create(self, session_id: str, now: float) -> None:
+        # An empty list does not exist in Redis, so a marker message-less key is kept alongside
+        self._redis.set(self._key(session_id) + ":meta", repr(now), ex=self.ttl)
+
+    def updated_at(self, session_id: str) -> Optional[float]:
+        value = self._redis.get(self._key(session_id) + ":meta")
+        return None if value is None else float(value)
+
+    def load(self, session_id: str) -> List[dict]:
+        return [json.loads(m) for m in self._redis.lrange(self._key(session_id), 0, -1)]
+
+    def append(self, session_id: str, messages: List[dict], now: float, not_before: float) -> bool:
+        # Redis expires the meta key itself, so `not_before` needs no check here
+        key = self._key(session_id)
+        payload = [json.dumps(m, ensure_ascii=False) for m in messages]
+        return bool(self._append(keys=[key, key + ":meta"], args=[self.ttl, repr(now), *payload]))
+
+    def delete(self, session_id: str) -> None:
+        self._redis.delete(self._key(session_id), self._key(session_id) + ":meta")
+
+    def purge(self, older_than: float) -> int:
+        return 0
+
+
+class ChatSessionStore:
+    """
+    Server-side chat histories, so clients send only their new message.
+
+    Recently used sessions live in an in-memory LRU of at most `max_sessions`
+    entries in front of an optional durable backend (SQLite or Redis). With a
+    backend, every read checks the session's last update there first and reloads
+    the messages if another worker appended to it, so several processes can share
+    the sessions. Writes only append messages, and only to live sessions. A session
+    expires `ttl` seconds after its last message.
+
+    :param backend: SQLiteSessionBackend or RedisSessionBackend, default None. In-memory only if None.
+    :param max_sessions: int, default 1024. Number of sessions kept in memory.
+    :param ttl: float, default 86400. Seconds a session lives after its last message. None disables expiry.
+    """
+
+    def __init__(self,
+                 backend: Optional[object] = None,
+                 max_sessions: int = 1024,
+                 ttl: Optional[float] = 24 * 3600.0):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # session id -> (messages, last update)
+        self._sessions: "OrderedDict[str, Tuple[List[dict], float]]" = OrderedDict()
+        self._last_purge = time.time()
+
+    def _is_expired(self, updated_at: float) -> bool:
+        return self.ttl is not None and time.time() - updated_at > self.ttl
+
+    def _remember(self, session_id: str, messages: List[dict], updated_at: float) -> None:
+        # Caller holds the lock
+        self._sessions[session_id] = (messages, updated_at)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def create(self) -> str:
+        """
+        Start a new session.
+
+        :return: The session id.
+        """
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        if self.backend is not None:
+            self.backend.create(session_id, now)
+        with self._lock:
+            self._remember(session_id, [], now)
+        return session_id
+
+    def get(self, session_id: str) -> Optional[List[dict]]:
+        """
+        Return a copy of the session's messages, or None if it does not exist or expired.
+        """
+        if self.backend is None:
+            with self._lock:
+                entry = self._sessions.get(session_id)
+                if entry is None:
+                    return None
+                if self._is_expired(entry[1]):
+                    del self._sessions[session_id]
+                    return None
+                self._sessions.move_to_end(session_id)
+                return list(entry[0])
+
+        updated_at = self.backend.updated_at(session_id)
+        if updated_at is None or self._is_expired(updated_at):
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            return None
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None and entry[1] == updated_at:
+                # Nobody appended since it was cached
+                self._sessions.move_to_end(session_id)
+                return list(entry[0])
+        messages = self.backend.load(session_id)
+        with self._lock:
+            self._remember(session_id, messages, updated_at)
+        return list(messages)
+
+    def exists(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def append(self, session_id: str, messages: List[dict]) -> None:
+        """
+        Append messages to a session, e.g. one user message and its answer.
+
+        :raises KeyError: If the session does not exist or expired. Nothing is written then.
+        """
+        messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+        if not messages:
+            return
+        now = time.time()
+        not_before = now - self.ttl if self.ttl is not None else float("-inf")
+        if self.backend is not None:
+            if not self.backend.append(session_id, messages, now, not_before):
+                with self._lock:
+                    self._sessions.pop(session_id, None)
+                raise KeyError(f"Unknown or expired session {session_id}.")
+            with self._lock:
+                # Another worker may have appended too, the next read reloads the session then
+                self._sessions.pop(session_id, None)
+        else:
+            with self._lock:
+                entry = self._sessions.get(session_id)
+                if entry is None or self._is_expired(entry[1]):
+                    self._sessions.pop(session_id, None)
+                    raise KeyError(f"Unknown or expired session {session_id}.")
+                # The cached list is only ever extended, readers get copies
+                entry[0].extend(messages)
+                self._remember(session_id, entry[0], now)
+        self._maybe_purge()
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+
+    def _maybe_purge(self) -> None:
+        # Expired sessions are removed from the durable backend at most once a minute
+        if self.ttl is None or self.backend is None or time.time() - self._last_purge < 60:
+            return
+        self._last_purge = time.time()
+        self.backend.purge(time.time() - self.ttl)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+_default_store: Optional[ChatSessionStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_chat_session_store() -> ChatSessionStore:
+    """
+    Return the process-wide chat session store.
+
+    CHAT_SESSION_REDIS_URL selects the Redis backend and CHAT_SESSION_PATH the SQLite one;
+    without either, sessions live in memory only. CHAT_SESSION_TTL and
+    CHAT_SESSION_MAX_ENTRIES configure expiry and the in-memory LRU.
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                ttl = float(os.getenv("CHAT_SESSION_TTL", 24 * 3600))
+                backend = None
+                if os.getenv("CHAT_SESSION_REDIS_URL"):
+                    backend = RedisSessionBackend(os.environ["CHAT_SESSION_REDIS_URL"], ttl=ttl)
+                elif os.getenv("CHAT_SESSION_PATH"):
+                    backend = SQLiteSessionBackend(os.environ["CHAT_SESSION_PATH"])
+                _default_store = ChatSessionStore(
+                    backend=backend,
+                    max_sessions=int(os.getenv("CHAT_SESSION_MAX_ENTRIES", 1024)),
+                    ttl=ttl,
+                )
+    return _default_store
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    turns = 50
+    answer = "The Temple of Literature is open from 8am to 5pm and tickets cost 70,000 VND. " * 4
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = ChatSessionStore(backend=SQLiteSessionBackend(os.path.join(directory, "sessions.db")))
+        session_id = store.create()
+
+        history, full_bytes, session_bytes = [], 0, 0
+        start = time.perf_counter()
+        for turn in range(turns):
+            prompt = f"Question {turn}: what else should I see near Hoan Kiem lake?"
+            # What the client uploads per request with and without a session
+            full_bytes += len(json.dumps({"prompt": prompt, "history": history}))
+            session_bytes += len(json.dumps({"prompt": prompt, "session_id": session_id}))
+
+            messages = store.get(session_id)
+            assert messages == history
+            exchange = [{"role": "User", "content": prompt}, {"role": "Assistant", "content": answer}]
+            store.append(session_id, exchange)
+            history = history + exchange
+        elapsed = time.perf_counter() - start
+
+        print(f"Request payload over {turns} turns: {full_bytes / 1024:,.0f} KiB with the full history, "
+              f"{session_bytes / 1024:,.1f} KiB with a session id")
+        print(f"Store round trip: {elapsed / turns * 1000:.2f} ms/turn (SQLite append + revalidated read)")
+
+        # A second worker on the same file sees the first one's appends
+        other = ChatSessionStore(backend=SQLiteSessionBackend(os.path.join(directory, "sessions.db")))
+        assert other.get(session_id) == history
+        store.append(session_id, [{"role": "User", "content": "And tomorrow?"}])
+        assert other.get(session_id) == store.get(session_id) == history + [{"role": "User", "content": "And tomorrow?"}]
+        history = store.get(session_id)
+
+        # Appending to an unknown session writes nothing
+        try:
+            store.append("unknown", [{"role": "User", "content": "Hello?"}])
+        except KeyError as e:
+            print(f"Rejected: {e}")
+
+        # A fresh store on the same file reads the session back
+        reopened = ChatSessionStore(backend=SQLiteSessionBackend(os.path.join(directory, "sessions.db")))
+        start = time.perf_counter()
+        assert reopened.get(session_id) == history
+        print(f"Cold read of {len(history)} messages from SQLite: {(time.perf_counter() - start) * 1000:.2f} ms")
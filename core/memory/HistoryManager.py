@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+# Summarizer signature: (previous summary, messages to fold in) -> new summary
+Summarizer = Callable[[str, List[dict]], str]
+
+SUMMARY_PROMPT = """
+    You maintain a running summary of a conversation between a tourist and Ragoon, a travel assistant.
+    Update the summary with the new messages. Keep destinations, dates, budget, preferences and
+    open questions; drop greetings and small talk. Answer with the updated summary only, at most 120 words.
+
+    Current summary: {summary}
+
+    New messages:
+    {messages}
+"""
+
+
+def format_messages(messages: List[dict]) -> str:
+    return "\n".join(f"{entry['role']}: {entry['content']}" for entry in messages)
+
+
+def llm_summarizer(model: str = "mistral-large2") -> Summarizer:
+    """
+    Summarizer backed by the shared RagoonBot of `model`.
+    """
+    def summarize(summary: str, messages: List[dict]) -> str:
+        from core.llm.CustomLLM import get_llm
+
+        response = get_llm(model).complete(
+            SUMMARY_PROMPT.format(summary=summary or "None", messages=format_messages(messages)),
+            temperature=0.0
+        )
+        if response.text.startswith("Error:"):
+            raise RuntimeError(response.text)
+        return response.text.strip()
+
+    return summarize
+
+
+class HistoryManager:
+    """
+    Keeps the prompt size of long chats flat.
+
+    A history within `max_tokens` is used as is. Beyond it, the last `keep_turns`
+    messages are kept verbatim and everything older is folded into a running
+    summary. Summaries are cached by a hash of the conversation prefix they cover,
+    so each message is summarized once when it ages out, not on every request.
+    The compacted history is then trimmed to `max_tokens`.
+
+    With `background`, a missing summary is written on a worker thread and the
+    request goes on with the latest cached one; the messages it does not cover yet
+    are left out of that prompt and folded in by the next turn.
+
+    :param summarizer: Callable (summary, messages) -> summary, default None. The shared LLM if None.
+    :param keep_turns: int, default 6. Messages (one user or assistant entry each) kept verbatim.
+    :param max_tokens: int, default 1500. Token budget of the compacted history.
+    :param max_cached: int, default 4096. Number of prefix summaries kept.
+    :param tokenizer: Callable returning the tokens of a text, default None. llama_index's tokenizer if None.
+    :param background: bool, default True. Summarize off the request path.
+    """
+
+    def __init__(self,
+                 summarizer: Optional[Summarizer] = None,
+                 keep_turns: int = 6,
+                 max_tokens: int = 1500,
+                 max_cached: int = 4096,
+                 tokenizer: Optional[Callable[[str], List]] = None,
+                 background: bool = True):
+        self.summarizer = summarizer or llm_summarizer()
+        self.keep_turns = max(1, keep_turns)
+        self.max_tokens = max_tokens
+        self.max_cached = max_cached
+        self._tokenizer = tokenizer
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.summarizer_calls = 0
+        self.background = background
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Prefix keys whose summary is being written in the background
+        self._pending: set = set()
+
+    @property
+    def tokenizer(self) -> Callable[[str], List]:
+        if self._tokenizer is None:
+            from llama_index.core.utils import get_tokenizer
+
+            self._tokenizer = get_tokenizer()
+        return self._tokenizer
+
+    def count_tokens(self, messages: List[dict]) -> int:
+        return len(self.tokenizer(format_messages(messages))) if messages else 0
+
+    @staticmethod
+    def _prefix_keys(messages: List[dict]) -> List[str]:
+        # keys[i] identifies messages[:i + 1], so a conversation shares keys with its own past
+        keys, digest = [], b""
+        for entry in messages:
+            digest = hashlib.sha256(digest + json.dumps([entry.get("role"), entry.get("content")]).encode("utf-8")).digest()
+            keys.append(digest.hex())
+        return keys
+
+    def _cached(self, key: str) -> Optional[str]:
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+            return summary
+
+    def _store(self, key: str, summary: str) -> None:
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_cached:
+                self._summaries.popitem(last=False)
+
+    def _latest(self, keys: List[str]) -> Tuple[int, str]:
+        # Number of messages covered by the longest cached prefix summary, and that summary
+        for i in range(len(keys) - 1, -1, -1):
+            cached = self._cached(keys[i])
+            if cached is not None:
+                return i + 1, cached
+        return 0, ""
+
+    def _extend(self, key: str, summary: str, messages: List[dict]) -> str:
+        try:
+            with self._lock:
+                self.summarizer_calls += 1
+            summary = self.summarizer(summary, messages)
+        except Exception as e:
+            # Keep the last good summary, the messages are retried next turn
+            print(f"Error summarizing the conversation history: {e}")
+            return summary
+        self._store(key, summary)
+        return summary
+
+    def _extend_in_background(self, key: str, summary: str, messages: List[dict]) -> None:
+        try:
+            self._extend(key, summary, messages)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def summarize(self, messages: List[dict], wait: bool = True) -> Tuple[str, int]:
+        """
+        Summary of `messages`, extending the longest already summarized prefix.
+
+        :param messages: The older part of the conversation.
+        :param wait: bool, default True. If False, extend the summary on a worker thread
+                     and return the latest cached one right away.
+        :return: The summary ("" if there is none) and the number of leading messages it covers.
+        """
+        if not messages:
+            return "", 0
+        keys = self._prefix_keys(messages)
+        start, summary = self._latest(keys)
+        if start == len(messages):
+            return summary, start
+        if wait:
+            return self._extend(keys[-1], summary, messages[start:]), len(messages)
+
+        with self._lock:
+            if keys[-1] in self._pending:
+                return summary, start
+            self._pending.add(keys[-1])
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+        self._executor.submit(self._extend_in_background, keys[-1], summary, messages[start:])
+        return summary, start
+
+    def compact(self, history: Optional[List[dict]]) -> Optional[List[dict]]:
+        """
+        Return the history to put in the prompt.
+
+        :param history: The full conversation, oldest first.
+        :return: A summary message followed by the recent messages, within the token budget.
+        """
+        if not history or self.count_tokens(history) <= self.max_tokens:
+            return history
+
+        split = max(0, len(history) - self.keep_turns)
+        recent = history[split:]
+        # Fold recent messages into the summary until the rest fits the budget
+        while len(recent) > 1 and self.count_tokens(recent) > self.max_tokens:
+            split += 1
+            recent = history[split:]
+
+        summary, covered = self.summarize(history[:split], wait=not self.background)
+        if covered < split:
+            # Not summarized yet: keep the newest of those messages that still fit
+            budget = self.max_tokens - self.count_tokens(recent) - len(self.tokenizer(summary))
+            while split > covered:
+                budget -= self.count_tokens([history[split - 1]])
+                if budget < 0:
+                    break
+                split -= 1
+            recent = history[split:]
+        if not summary:
+            return recent
+        summary_tokens = self.tokenizer(summary)
+        budget = max(0, self.max_tokens - self.count_tokens(recent))
+        if len(summary_tokens) > budget:
+            summary = summary[:len(summary) * budget // len(summary_tokens)]
+        return [{"role": "System", "content": f"Summary of the earlier conversation: {summary}"}] + recent
+
+
+_default_manager: Optional[HistoryManager] = None
+_default_manager_lock = threading.Lock()
+
+
+def get_history_manager() -> HistoryManager:
+    """
+    Return the process-wide history manager, creating it on first use.
+    HISTORY_KEEP_TURNS and HISTORY_MAX_TOKENS configure it.
+
+    :return: The shared HistoryManager.
+    """
+    global _default_manager
+    if _default_manager is None:
+        with _default_manager_lock:
+            if _default_manager is None:
+                _default_manager = HistoryManager(
+                    keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", 6)),
+                    max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", 1500)),
+                )
+    return _default_manager
+
+
+if __name__ == "__main__":
+    import time
+
+    def fake_summarizer(summary: str, messages: List[dict]) -> str:
+        # Stands in for the LLM: a 200 ms call keeping the first words of every folded message,
+        # bounded like a real summary
+        time.sleep(0.2)
+        words = (summary + " " + " ".join(entry["content"].split(".")[0] for entry in messages)).split()
+        return " ".join(words[-120:])
+
+    for background in (False, True):
+        manager = HistoryManager(summarizer=fake_summarizer, keep_turns=6, max_tokens=600, background=background)
+        manager.count_tokens([{"role": "User", "content": "warm up the tokenizer"}])
+        history: List[dict] = []
+        elapsed = 0.0
+        print(f"Summarizing {'in the background' if background else 'on the request path'}:")
+        for turn in range(1, 101):
+            history.append({"role": "User", "content": f"Turn {turn}: what else should I see in Hanoi on day {turn % 5 + 1}? "
+                                                       f"I like food, temples and walking tours."})
+            start = time.perf_counter()
+            prompt_history = manager.compact(history)
+            elapsed += time.perf_counter() - start
+            if turn in (1, 10, 25, 50, 100):
+                print(f"  turn {turn:3d}: full history {manager.count_tokens(history):6,d} tokens, "
+                      f"compacted {manager.count_tokens(prompt_history):4d} tokens, "
+                      f"summarizer calls so far {manager.summarizer_calls}")
+            history.append({"role": "Assistant", "content": f"For day {turn % 5 + 1}, visit the Temple of Literature, "
+                                                            f"eat bun cha in the Old Quarter and walk around Hoan Kiem Lake."})
+            # Time the user takes to read the answer and type the next message
+            time.sleep(0.25)
+        print(f"  Compaction overhead: {elapsed / 100 * 1000:.2f} ms/turn")
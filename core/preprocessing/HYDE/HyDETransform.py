@@ -1,67 +1,138 @@
+import asyncio
 import os
 import warnings
-from core.llm.CustomLLM import RagoonBot
+from concurrent.futures import ThreadPoolExecutor
+from core.llm.CustomLLM import RagoonBot, get_llm
 from llama_index.core.indices.query.query_transform import HyDEQueryTransform
 from llama_index.core.llms import LLM
-from snowflake.snowpark import Session
-from snowflake.cortex import Complete
-from dotenv import load_dotenv
-from typing import Any, Union, List
+from llama_index.core.schema import QueryBundle
+from typing import Any, Union, List, Optional
 
 warnings.filterwarnings("ignore")
-load_dotenv("../../.env")
-
-llm = RagoonBot()
 
 class HyDETransformer(HyDEQueryTransform):
     def __init__(self, 
-                 llm: LLM = llm,
+                 llm: Optional[Union[LLM, str]] = None,
                  hyde_prompt: str = None,
-                 include_original: bool = True):
+                 include_original: bool = True,
+                 max_workers: int = 4):
         """
         Initializes the Hypothetical Document Embeddings 
 
-        :param llm: str, default None. The LLM model to use.
+        :param llm: str, default None. The LLM model to use. If None, the shared RagoonBot is used.
         :param hyde_prompt: str, default None. The prompt to use for the HyDE model.
         :param include_original: bool, default True. Whether to include the original text in the output.
+        :param max_workers: int, default 4. The maximum number of hypothetical documents generated concurrently.
         """
-        if isinstance(llm, str):
+        if llm is None:
+            self.llm = get_llm()
+        elif isinstance(llm, str):
             self.llm = RagoonBot(model=llm)
         else:
             self.llm = llm
-            
+
         super().__init__(
             llm=self.llm,
             hyde_prompt=hyde_prompt,
             include_original=include_original
         )
+        self.max_workers = max(1, max_workers)
         
 
+    def _run_isolated(self, text: str) -> Optional[QueryBundle]:
+        """
+        Generate the hypothetical document for one query, returning None on failure
+        so that one failed query does not discard the others.
+        """
+        try:
+            response = self.run(text)
+        except Exception as e:
+            print(f"Error generating hypothetical document for '{text}': {str(e)}")
+            return None
+        # RagoonBot reports failed completions as "Error: ..." text
+        if response.custom_embedding_strs and response.custom_embedding_strs[0].startswith("Error:"):
+            print(f"Error generating hypothetical document for '{text}': {response.custom_embedding_strs[0]}")
+            return None
+        return response
+
+    async def _arun_isolated(self, text: str) -> Optional[QueryBundle]:
+        """
+        Async version of `_run_isolated`, awaiting the LLM's `apredict`.
+        """
+        try:
+            document = await self._llm.apredict(self._hyde_prompt, context_str=text)
+        except Exception as e:
+            print(f"Error generating hypothetical document for '{text}': {str(e)}")
+            return None
+        if document.startswith("Error:"):
+            print(f"Error generating hypothetical document for '{text}': {document}")
+            return None
+        embedding_strs = [document, text] if self._include_original else [document]
+        return QueryBundle(query_str=text, custom_embedding_strs=embedding_strs)
+
+    @staticmethod
+    def _flatten(text: Union[str, List[str], List[List[str]]]) -> List[str]:
+        if isinstance(text, str):
+            return [text]
+        if isinstance(text[0], list) and len(text) == 1:
+            return text[0]
+        if isinstance(text[0], list):
+            return [t for sublist in text for t in sublist]
+        return text
+
     def transform(
         self,
-        text: Union[str, List[str], List[List[str]]] = None
+        text: Union[str, List[str], List[List[str]]] = None,
+        **kwargs
     ):
         """
         Transforms the input text into hypothetical document embeddings.
+        The hypothetical documents of several queries are generated concurrently.
 
         :param text: str. The text to transform.
-        :return: str. The transformed text.
+        :return: List[List[str]]. The transformed text, one list per input query, in input order.
         """
         if text is None:
             return "Please provide a text to transform."
         
-        if isinstance(text, str):
-            _text = [text]
+        _text = self._flatten(text)
 
-        if isinstance(text[0], list) and len(text) == 1:
-            _text = text[0]
+        if len(_text) == 1 or self.max_workers == 1:
+            results = [self._run_isolated(t) for t in _text]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(_text)), thread_name_prefix="hyde") as executor:
+                results = list(executor.map(self._run_isolated, _text))
 
-        try:
-            response = [self.run(t) for t in _text]
-        except Exception as e:
-            raise Exception(f"Error transforming the input text: {str(e)}")
-        response = [r for r in response if r.custom_embedding_strs]
-        response = [r.custom_embedding_strs[:-1] for r in response]
+        return self._collect(_text, results)
+
+    async def atransform(
+        self,
+        text: Union[str, List[str], List[List[str]]] = None,
+        **kwargs
+    ):
+        """
+        Async version of `transform`. The hypothetical documents are awaited together;
+        the LLM's upstream limiter bounds how many are generated at once.
+
+        :param text: str. The text to transform.
+        :return: List[List[str]]. The transformed text, one list per input query, in input order.
+        """
+        if text is None:
+            return "Please provide a text to transform."
+
+        _text = self._flatten(text)
+        results = await asyncio.gather(*(self._arun_isolated(t) for t in _text))
+        return self._collect(_text, list(results))
+
+    @staticmethod
+    def _collect(_text: List[str], results: List[Optional[QueryBundle]]) -> List[List[str]]:
+        if _text and all(r is None for r in results):
+            raise Exception("Error transforming the input text: every hypothetical document failed.")
+
+        # A failed query falls back to its own text
+        response = [[t] if r is None else r for t, r in zip(_text, results)]
+        response = [r for r in response if isinstance(r, list) or r.custom_embedding_strs]
+        response = [r if isinstance(r, list) else r.custom_embedding_strs[:-1] for r in response]
         return response
     
 if __name__ == "__main__":
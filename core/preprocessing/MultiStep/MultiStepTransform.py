@@ -1,21 +1,19 @@
+import asyncio
 import os
-from core.llm.CustomLLM import RagoonBot
+from core.llm.CustomLLM import RagoonBot, get_llm, is_error
 from llama_index.core.llms import LLM
-from dotenv import load_dotenv
-from typing import Optional, List, Union, Callable
-
-load_dotenv('../../.env')
-
-llm = RagoonBot()
+from typing import AsyncIterator, Optional, List, Union, Callable, Iterator
 
 class MultiStepTransformer:
-    def __init__(self, llm: Union[LLM, str] = llm):
+    def __init__(self, llm: Optional[Union[LLM, str]] = None):
         """
         Initializes the MultiStepTransformer.
 
-        :param llm: LLM, default None. The LLM model to use.
+        :param llm: LLM, default None. The LLM model to use. If None, the shared RagoonBot is used.
         """
-        if isinstance(llm, str):
+        if llm is None:
+            self.llm = get_llm()
+        elif isinstance(llm, str):
             try:
                 self.llm = RagoonBot(model=llm)
             except Exception as e:
@@ -42,7 +40,7 @@ class MultiStepTransformer:
         if isinstance(text[0], list) and len(text) == 1:
             _text = text[0]
 
-        decomposition_prompts = [f"Please break down the question '{_t}' into smaller sub-queries that can be answered one by one. No more than {max_queries} sub-queries." for _t in _text]
+        decomposition_prompts = [self.decomposition_prompt(_t, max_queries) for _t in _text]
 
         try:
             decompositions = [self.llm.complete(decomposition_prompt, temperature=0.2) for decomposition_prompt in decomposition_prompts]
@@ -50,6 +48,40 @@ class MultiStepTransformer:
         except Exception as e:
             raise Exception(f"Error decomposing the input query: {str(e)}")
 
+        return self.parse_sub_queries(decompositions)
+
+    async def atransform(self, text: Union[str, List[str], List[List[str]]],
+                         max_queries: int = 3,
+                         **kwargs) -> List[str]:
+        """
+        Async version of `transform`, decomposing every input query concurrently.
+
+        :param text: str. The text to decompose.
+        :return: List of sub-queries.
+        """
+        if isinstance(text, str):
+            _text = [text]
+
+        if isinstance(text[0], list) and len(text) == 1:
+            _text = text[0]
+
+        decomposition_prompts = [self.decomposition_prompt(_t, max_queries) for _t in _text]
+
+        try:
+            decompositions = await asyncio.gather(
+                *(self.llm.acomplete(decomposition_prompt, temperature=0.2) for decomposition_prompt in decomposition_prompts)
+            )
+            decompositions = [decomposition.text for decomposition in decompositions]
+        except Exception as e:
+            raise Exception(f"Error decomposing the input query: {str(e)}")
+
+        return self.parse_sub_queries(decompositions)
+
+    @staticmethod
+    def parse_sub_queries(decompositions: List[str]) -> List[List[str]]:
+        """
+        Split every decomposition into its sub-queries, dropping the model's first line.
+        """
         try:
             sub_queries = [decomposition.split("\n")[1:] for decomposition in decompositions]
             sub_queries = [[sub_query for sub_query in sub_query_list if sub_query] for sub_query_list in sub_queries]
@@ -58,6 +90,77 @@ class MultiStepTransformer:
         
         return sub_queries
 
+    @staticmethod
+    def decomposition_prompt(text: str, max_queries: int = 3) -> str:
+        return f"Please break down the question '{text}' into smaller sub-queries that can be answered one by one. No more than {max_queries} sub-queries."
+
+    def stream_transform(self, text: str,
+                         max_queries: int = 3,
+                         **kwargs) -> Iterator[str]:
+        """
+        Decomposes the input query like `transform`, but yields each sub-query as soon
+        as its line of the streamed decomposition is complete.
+
+        :param text: str. The text to decompose.
+        :yield: The sub-queries, in order.
+        """
+        prompt = self.decomposition_prompt(text, max_queries)
+        buffer = ""
+        # The first line is the model's preamble, as in `transform`
+        skip_first = True
+        try:
+            for chunk in self.llm.stream_complete(prompt, temperature=0.2):
+                if is_error(chunk):
+                    # No sub-queries, as `transform` gets from an "Error: ..." decomposition
+                    print(f"Error decomposing the input query: {chunk.additional_kwargs.get('error', chunk.text)}")
+                    return
+                buffer += chunk.delta or ""
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    if skip_first:
+                        skip_first = False
+                    elif line:
+                        yield line
+        except Exception as e:
+            raise Exception(f"Error decomposing the input query: {str(e)}")
+
+        if buffer and not skip_first:
+            yield buffer
+
+    async def astream_transform(self, text: str,
+                                max_queries: int = 3,
+                                **kwargs) -> AsyncIterator[str]:
+        """
+        Async version of `stream_transform`, reading the LLM's `astream_complete`.
+
+        :param text: str. The text to decompose.
+        :yield: The sub-queries, in order.
+        """
+        prompt = self.decomposition_prompt(text, max_queries)
+        buffer = ""
+        skip_first = True
+        try:
+            chunks = await self.llm.astream_complete(prompt, temperature=0.2)
+            try:
+                async for chunk in chunks:
+                    if is_error(chunk):
+                        print(f"Error decomposing the input query: {chunk.additional_kwargs.get('error', chunk.text)}")
+                        return
+                    buffer += chunk.delta or ""
+                    *lines, buffer = buffer.split("\n")
+                    for line in lines:
+                        if skip_first:
+                            skip_first = False
+                        elif line:
+                            yield line
+            finally:
+                await chunks.aclose()
+        except Exception as e:
+            raise Exception(f"Error decomposing the input query: {str(e)}")
+
+        if buffer and not skip_first:
+            yield buffer
+
 
 if __name__ == "__main__":
     text = [["What are the effects of schizophrenia on memory?"]]
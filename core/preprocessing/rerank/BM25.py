@@ -0,0 +1,117 @@
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have how i in is it its of on or that the
+this to was what when where which who why will with you your me my should can do
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower-case word tokenization without stopwords.
+
+    :param text: The text to tokenize.
+    :return: The list of tokens.
+    """
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Scorer:
+    """
+    Okapi BM25 over an inverted index.
+
+    Every term maps to a NumPy array of document ids and term frequencies, so
+    scoring a query is one vectorized update per query term instead of a loop
+    over documents.
+
+    :param k1: float, default 1.5. Term frequency saturation.
+    :param b: float, default 0.75. Document length normalization.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = 0
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._idf: Dict[str, float] = {}
+        self._length_norm: Optional[np.ndarray] = None
+
+    def fit(self, documents: Iterable[str]) -> "BM25Scorer":
+        """
+        Build the inverted index.
+
+        :param documents: The corpus, indexed by position.
+        :return: self
+        """
+        postings = defaultdict(lambda: ([], []))
+        lengths = []
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                ids, tfs = postings[term]
+                ids.append(doc_id)
+                tfs.append(count)
+
+        self.num_docs = len(lengths)
+        lengths = np.asarray(lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if self.num_docs and lengths.mean() > 0 else 1.0
+        self._length_norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+        self._postings = {
+            term: (np.asarray(ids, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+            for term, (ids, tfs) in postings.items()
+        }
+        self._idf = {
+            term: float(np.log(1 + (self.num_docs - len(ids) + 0.5) / (len(ids) + 0.5)))
+            for term, (ids, _) in self._postings.items()
+        }
+        return self
+
+    def score(self, query: str) -> np.ndarray:
+        """
+        Score every document against a query.
+
+        :param query: The query text.
+        :return: A (num_docs,) array of BM25 scores.
+        """
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for term, query_count in Counter(tokenize(query)).items():
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting
+            scores[ids] += query_count * self._idf[term] * tfs * (self.k1 + 1) / (tfs + self._length_norm[ids])
+        return scores
+
+    def score_batch(self, queries: List[str]) -> np.ndarray:
+        """
+        Score every document against several queries.
+
+        :param queries: The query texts.
+        :return: A (len(queries), num_docs) array of BM25 scores.
+        """
+        if not queries:
+            return np.zeros((0, self.num_docs), dtype=np.float32)
+        return np.stack([self.score(query) for query in queries])
+
+    def top_k(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
+        """
+        Return the best matching documents.
+
+        :param query: The query text.
+        :param k: The number of documents to return.
+        :return: (document id, score) pairs with a positive score, best first.
+        """
+        scores = self.score(query)
+        k = min(k, self.num_docs)
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(i), float(scores[i])) for i in candidates if scores[i] > 0]
@@ -0,0 +1,79 @@
+from typing import List, Optional, Union
+
+
+class BaseReranker:
+    """
+    Interface shared by the reranker backends.
+
+    Subclasses implement `score`. `rerank` and `transform` then order passages by
+    that score, so every backend can be used both on retrieved contexts and as a
+    `Rag` transformer.
+    """
+
+    def score(self,
+              inputs: List[str],
+              reference_string: str) -> List[float]:
+        """
+        Score the relevance of every input string to the reference string.
+
+        :param inputs: The input strings to score.
+        :param reference_string: The reference string to score against.
+        :return: One relevance score per input, higher is more relevant.
+        """
+        raise NotImplementedError
+
+    def rerank(self,
+               inputs: List[str],
+               reference_string: str,
+               top_n: Optional[int] = None) -> List[str]:
+        """
+        Order the input strings from most to least relevant.
+
+        :param inputs: The input strings to rerank.
+        :param reference_string: The reference string to rerank against.
+        :param top_n: The number of strings to keep. Defaults to the reranker's `top_n`.
+        :return: The top ranked strings.
+        """
+        if not inputs:
+            return []
+        top_n = top_n or getattr(self, "top_n", None) or len(inputs)
+        scores = self.score(inputs, reference_string)
+        # sorted is stable, so ties keep their retrieval order
+        ranked = sorted(zip(inputs, scores), key=lambda x: x[1], reverse=True)
+        return [text for text, _ in ranked[:top_n]]
+
+    @staticmethod
+    def flatten_inputs(inputs: Union[str, List[str], List[List[str]]]) -> List[str]:
+        """
+        Normalize transformer inputs to a flat list of strings.
+        """
+        if isinstance(inputs, str):
+            return [inputs]
+        if isinstance(inputs, list):
+            if not inputs:
+                return []
+            if isinstance(inputs[0], str):
+                return inputs
+            if isinstance(inputs[0], list):
+                return [item for sublist in inputs for item in sublist]
+            raise ValueError("Invalid input format for reranking. Expected strings or list of strings.")
+        raise ValueError("Invalid input type for reranking. Expected string or list of strings.")
+
+    def transform(self,
+                  inputs: Union[str, List[str], List[List[str]]],
+                  original_string: Optional[str] = None,
+                  **kwargs) -> List[List[str]]:
+        """
+        Rerank the input strings against `original_string`.
+
+        :param inputs: A string or a list of strings to be reranked.
+        :param original_string: The reference string. Defaults to the one the reranker was built with.
+        :return: A list holding the strings ordered from highest to lowest relevance.
+        """
+        assert inputs is not None, "Please provide input strings to rerank."
+        _inputs = self.flatten_inputs(inputs)
+        if not _inputs:
+            return []
+        if original_string is None:
+            original_string = getattr(self, "_original_string", "")
+        return [self.rerank(_inputs, original_string)]
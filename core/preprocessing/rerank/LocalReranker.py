@@ -0,0 +1,155 @@
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from core.preprocessing.rerank.BaseReranker import BaseReranker
+from core.preprocessing.rerank.BM25 import BM25Scorer
+
+DEFAULT_CROSS_ENCODER = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class LocalReranker(BaseReranker):
+    """
+    CPU-only reranker that needs no LLM round trip.
+
+    Passages are scored with BM25 against the reference string. If a cross-encoder
+    model is given, its scores (loaded through sentence-transformers, which also
+    runs ONNX exports) are blended in with weight `alpha`.
+
+    :param original_string: str, default "". The reference string to rerank against.
+    :param top_n: int, default 10. The number of top-ranked strings to return.
+    :param cross_encoder: str, default None. Name or path of a cross-encoder model. BM25 only if None.
+    :param alpha: float, default 0.7. Weight of the cross-encoder score in the blend.
+    :param batch_size: int, default 32. Cross-encoder batch size.
+    :param cross_encoder_kwargs: dict, default None. Extra arguments for `CrossEncoder`, e.g. backend="onnx".
+    """
+
+    def __init__(self,
+                 original_string: str = "",
+                 top_n: int = 10,
+                 cross_encoder: Optional[str] = None,
+                 alpha: float = 0.7,
+                 batch_size: int = 32,
+                 k1: float = 1.5,
+                 b: float = 0.75,
+                 cross_encoder_kwargs: Optional[Dict[str, Any]] = None):
+        self._original_string = original_string
+        self.top_n = top_n
+        self.cross_encoder_name = cross_encoder
+        self.alpha = alpha if cross_encoder else 0.0
+        self.batch_size = batch_size
+        self.k1 = k1
+        self.b = b
+        self._cross_encoder_kwargs = cross_encoder_kwargs or {}
+        self._cross_encoder = None
+
+    @property
+    def cross_encoder(self):
+        if self._cross_encoder is None and self.cross_encoder_name:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError as e:
+                raise ImportError(
+                    "sentence-transformers is required for cross-encoder reranking: pip install sentence-transformers"
+                ) from e
+            self._cross_encoder = CrossEncoder(self.cross_encoder_name, device="cpu", **self._cross_encoder_kwargs)
+        return self._cross_encoder
+
+    def lexical_scores(self, queries: List[str], inputs: List[str]) -> np.ndarray:
+        """
+        BM25 scores of the inputs for every query, scaled to [0, 1] per query.
+
+        :return: A (len(queries), len(inputs)) array.
+        """
+        scores = BM25Scorer(k1=self.k1, b=self.b).fit(inputs).score_batch(queries)
+        peaks = scores.max(axis=1, keepdims=True)
+        peaks[peaks <= 0] = 1.0
+        return scores / peaks
+
+    def semantic_scores(self, queries: List[str], inputs: List[str]) -> np.ndarray:
+        """
+        Cross-encoder relevance probabilities of the inputs for every query.
+
+        :return: A (len(queries), len(inputs)) array.
+        """
+        pairs = [(query, text) for query in queries for text in inputs]
+        logits = np.asarray(self.cross_encoder.predict(pairs, batch_size=self.batch_size), dtype=np.float32)
+        return (1.0 / (1.0 + np.exp(-logits))).reshape(len(queries), len(inputs))
+
+    def score_batch(self, queries: List[str], inputs: List[str]) -> np.ndarray:
+        """
+        Score the inputs against several reference strings at once.
+
+        :param queries: The reference strings.
+        :param inputs: The passages to score.
+        :return: A (len(queries), len(inputs)) array of relevance scores in [0, 1].
+        """
+        if not queries or not inputs:
+            return np.zeros((len(queries), len(inputs)), dtype=np.float32)
+        scores = self.lexical_scores(queries, inputs)
+        if self.alpha > 0:
+            scores = self.alpha * self.semantic_scores(queries, inputs) + (1 - self.alpha) * scores
+        return scores
+
+    def score(self,
+              inputs: List[str],
+              reference_string: str) -> List[float]:
+        return self.score_batch([reference_string], inputs)[0].tolist()
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+    import time
+
+    # Fixed fixture: a query and passages listed from most to least relevant
+    query = "Where can I eat street food in Hanoi's Old Quarter?"
+    passages = [
+        "The Old Quarter of Hanoi is packed with street food stalls serving pho, bun cha and banh mi.",
+        "Ta Hien street in Hanoi's Old Quarter is famous for beer corners and grilled street food at night.",
+        "Dong Xuan market in Hanoi sells fresh produce and has a food court with local dishes.",
+        "Hoan Kiem Lake sits at the edge of the Old Quarter and is a popular walking spot.",
+        "Ho Chi Minh City's Ben Thanh market is known for its food stalls.",
+        "Ha Long Bay is a UNESCO World Heritage Site known for its limestone karsts.",
+        "The best time to visit Sapa for trekking is between September and November.",
+        "Da Nang has long sandy beaches and the Dragon Bridge.",
+    ]
+    # Rerankers get the passages shuffled, so keeping the input order does not score as agreement
+    shuffled = random.Random(7).sample(passages, len(passages))
+
+    def kendall_tau(a: List[str], b: List[str]) -> float:
+        position = {text: i for i, text in enumerate(b)}
+        ranks = [position[text] for text in a]
+        n = len(ranks)
+        concordant = sum(1 for i in range(n) for j in range(i + 1, n) if ranks[i] < ranks[j])
+        return 2 * concordant / (n * (n - 1) / 2) - 1
+
+    print(f"Shuffled input: tau vs fixture = {kendall_tau(shuffled, passages):.2f}")
+    local = LocalReranker(original_string=query, top_n=len(passages))
+    runs = 200
+    start = time.perf_counter()
+    for _ in range(runs):
+        local_ranking = local.rerank(shuffled, query)
+    elapsed = time.perf_counter() - start
+    print(f"BM25 reranker: {runs * len(passages) / elapsed:,.0f} passages/s, "
+          f"tau vs fixture = {kendall_tau(local_ranking, passages):.2f}")
+
+    from core.preprocessing.rerank.Reranker import NEUTRAL_SCORE, Reranker
+
+    llm_reranker = Reranker(original_string=query, top_n=len(passages))
+    try:
+        probe = llm_reranker.llm.complete("Reply with OK.").text
+    except Exception as e:
+        probe = f"Error: {e}"
+    if probe.startswith("Error:"):
+        sys.exit(f"LLM reranker not benchmarked, the LLM call failed: {probe[len('Error:'):].strip()}")
+
+    start = time.perf_counter()
+    llm_scores = llm_reranker.score(shuffled, query)
+    elapsed = time.perf_counter() - start
+    if all(score == NEUTRAL_SCORE for score in llm_scores):
+        sys.exit("LLM reranker not benchmarked, every passage got the neutral score of a failed call.")
+    llm_ranking = [text for text, _ in sorted(zip(shuffled, llm_scores), key=lambda x: x[1], reverse=True)]
+    print(f"LLM reranker: {len(passages) / elapsed:,.1f} passages/s, "
+          f"tau vs fixture = {kendall_tau(llm_ranking, passages):.2f}")
+    print(f"Ranking agreement (tau) BM25 vs LLM: {kendall_tau(local_ranking, llm_ranking):.2f}")
@@ -1,15 +1,13 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from llama_index.core.postprocessor import LLMRerank
 from llama_index.core.llms import LLM
-from core.llm.CustomLLM import RagoonBot
+from core.llm.CustomLLM import RagoonBot, get_llm
+from core.preprocessing.rerank.BaseReranker import BaseReranker
 from typing import List, Tuple, Union, Optional
 from pydantic import PrivateAttr
 
-from dotenv import load_dotenv
-
-load_dotenv('../../.env')
-
-llm = RagoonBot()
-
 RERANK_PROMPT = f"""
 Please rate the relevance of the following response to the given reference on a scale of 0 to 1. \n
 Reference: REFERENCE_STRING\n
@@ -17,28 +15,60 @@ Response: INPUT_STRING\n
 Return only the Relevance Score (0-1). Do not include any additional text.
 """
 
-class Reranker(LLMRerank):
+BATCH_RERANK_PROMPT = f"""
+Please rate the relevance of each of the following numbered responses to the given reference on a scale of 0 to 1. \n
+Reference: REFERENCE_STRING\n
+Responses:\n
+INPUT_STRINGS\n
+Return only a JSON array of exactly NUM_INPUTS Relevance Scores (0-1), one per response, in the order given. Do not include any additional text.
+"""
+
+SCORE_ARRAY_PATTERN = re.compile(r"\[[^\[\]]*\]", re.DOTALL)
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+# Passage labels the model may echo back: "[2]" anywhere, "2." or "2)" at the start of a line
+LABEL_PATTERN = re.compile(r"\[\s*\d+\s*\]|^\s*\d+[.):](?=\s)", re.MULTILINE)
+# Score given to every passage of a batch the LLM failed on, so ties keep the retrieval order
+NEUTRAL_SCORE = 0.5
+
+class Reranker(LLMRerank, BaseReranker):
     """Reranker class for RagoonBot."""
 
     _original_string: str = PrivateAttr()
+    _batch_size: int = PrivateAttr(default=8)
+    _max_batch_chars: int = PrivateAttr(default=8000)
+    _max_workers: int = PrivateAttr(default=4)
 
     def __init__(self, 
                  original_string: str,
-                 llm: Union[LLM, str] = llm, 
+                 llm: Optional[Union[LLM, str]] = None, 
                  top_n: int = 10, 
+                 batch_size: int = 8,
+                 max_batch_chars: int = 8000,
+                 max_workers: int = 4,
                  **kwargs):
         """
         Initialize the Reranker.
 
         :param original_string: The reference string to rerank against.
-        :param llm: The RagoonBot instance to use for scoring.
+        :param llm: The RagoonBot instance (or model name) to use for scoring. If None, the shared RagoonBot is used.
         :param top_n: The number of top-ranked strings to return.
+        :param batch_size: The number of passages scored in one listwise LLM call. 1 scores each passage separately.
+        :param max_batch_chars: The maximum number of passage characters in one call, to stay within the context window.
+        :param max_workers: The maximum number of batches scored concurrently.
         :param kwargs: Additional keyword arguments.
         """
+        if llm is None:
+            llm = get_llm()
+        elif isinstance(llm, str):
+            llm = RagoonBot(model=llm)
+
         super().__init__(llm=llm, top_n=top_n)
         self._original_string = original_string
         self.llm = llm
         self.top_n = top_n
+        self._batch_size = max(1, batch_size)
+        self._max_batch_chars = max_batch_chars
+        self._max_workers = max(1, max_workers)
 
     def get_relevant_score(self,
                            input_string: str,
@@ -48,7 +78,8 @@ class Reranker(LLMRerank):
 
         :param input_string: The input string to score.
         :param reference_string: The reference string to score against.
-        :return: The relevance score of the input string (0.0 to 1.0).
+        :return: The relevance score of the input string (0.0 to 1.0), NEUTRAL_SCORE if the
+                 response cannot be parsed.
         """
 
         assert input_string is not None, "Please provide an input string to score."
@@ -62,49 +93,118 @@ class Reranker(LLMRerank):
             score = float(score_str)
             score = max(0.0, min(1.0, score))
         except (ValueError, IndexError, AttributeError) as e:
-            print(f"Error parsing relevance score: {e}. Defaulting score to 0.0.")
-            score = 0.0
+            print(f"Error parsing relevance score: {e}. Defaulting score to {NEUTRAL_SCORE}.")
+            score = NEUTRAL_SCORE
 
         return score
 
-    def transform(self, 
-                  inputs: Union[str, List[str], List[List[str]]],
-                  **kwargs) -> List[str]:
+    @staticmethod
+    def parse_scores(text: str, expected: int) -> List[Optional[float]]:
+        """
+        Parse the score array returned for a listwise prompt.
+
+        Only a bracketed list of exactly `expected` numbers is taken as the scores, the
+        last one if there are several, so echoed "[1]" labels are not read as scores.
+        Without such a list, the numbers left once the labels are stripped are used if
+        there are exactly `expected` of them.
+
+        :param text: The raw LLM output.
+        :param expected: The number of passages in the prompt.
+        :return: One score per passage, clamped to [0, 1]. Entries that could not be parsed are None.
+        """
+        text = text or ""
+        values = []
+        for match in SCORE_ARRAY_PATTERN.finditer(text):
+            try:
+                candidate = json.loads(match.group(0))
+            except ValueError:
+                candidate = NUMBER_PATTERN.findall(match.group(0))
+            if len(candidate) == expected:
+                values = candidate
+        if not values:
+            # No score array, accept plain numbers next to the labels if there is one per passage
+            numbers = NUMBER_PATTERN.findall(LABEL_PATTERN.sub(" ", text))
+            values = numbers if len(numbers) == expected else []
+
+        scores: List[Optional[float]] = []
+        for i in range(expected):
+            try:
+                score = float(values[i])
+                scores.append(max(0.0, min(1.0, score)))
+            except (IndexError, TypeError, ValueError):
+                scores.append(None)
+        return scores
+
+    def _batches(self, inputs: List[str]) -> List[List[int]]:
+        batches, current, chars = [], [], 0
+        for i, text in enumerate(inputs):
+            if current and (len(current) >= self._batch_size or chars + len(text) > self._max_batch_chars):
+                batches.append(current)
+                current, chars = [], 0
+            current.append(i)
+            chars += len(text)
+        if current:
+            batches.append(current)
+        return batches
+
+    def score_batch(self,
+                    input_strings: List[str],
+                    reference_string: str) -> List[float]:
+        """
+        Score several input strings against the reference string with one listwise LLM call.
+        Passages whose score cannot be parsed are scored individually. If the call itself
+        fails, every passage gets NEUTRAL_SCORE rather than one more failing call each.
+
+        :param input_strings: The input strings to score.
+        :param reference_string: The reference string to score against.
+        :return: The relevance scores (0.0 to 1.0), in input order.
         """
-        Rerank the input strings based on their relevance scores from RagoonBot.
+        if len(input_strings) == 1:
+            return [self.get_relevant_score(input_strings[0], reference_string)]
 
-        :param inputs: A string or a list of strings to be reranked.
-        :return: A list of strings ordered from highest to lowest relevance.
+        numbered = "\n".join(f"[{i + 1}] {text}" for i, text in enumerate(input_strings))
+        prompt = (BATCH_RERANK_PROMPT
+                  .replace("REFERENCE_STRING", reference_string)
+                  .replace("NUM_INPUTS", str(len(input_strings)))
+                  .replace("INPUT_STRINGS", numbered))
+
+        try:
+            text = self.llm.complete(prompt).text
+        except Exception as e:
+            text = f"Error: {e}"
+        if text.startswith("Error:"):
+            print(f"Error scoring batch: {text[len('Error:'):].strip()}. Keeping the retrieval order.")
+            return [NEUTRAL_SCORE] * len(input_strings)
+
+        scores = self.parse_scores(text, len(input_strings))
+
+        return [
+            score if score is not None else self.get_relevant_score(text, reference_string)
+            for text, score in zip(input_strings, scores)
+        ]
+
+    def score(self,
+              inputs: List[str],
+              reference_string: str) -> List[float]:
+        """
+        Score all inputs, batching them and scoring the batches concurrently.
+
+        :param inputs: The input strings to score.
+        :param reference_string: The reference string to score against.
+        :return: The relevance scores, in input order.
         """
-        assert inputs is not None, "Please provide input strings to rerank."
-
-        # Normalize inputs to a flat list of strings
-        if isinstance(inputs, str):
-            _inputs = [inputs]
-        elif isinstance(inputs, list):
-            if not inputs:
-                return []
-            if isinstance(inputs[0], str):
-                _inputs = inputs
-            elif isinstance(inputs[0], list):
-                _inputs = [item for sublist in inputs for item in sublist]
-            else:
-                raise ValueError("Invalid input format for reranking. Expected strings or list of strings.")
-        else:
-            raise ValueError("Invalid input type for reranking. Expected string or list of strings.")
-
-        scores: List[Tuple[str, float]] = []
-
-        for input_str in _inputs:
-            score = self.get_relevant_score(input_str, self._original_string)
-            scores.append((input_str, score))
-
-        sorted_scores = sorted(scores, key=lambda x: x[1], reverse=True)
-
-        top_n = min(self.top_n, len(sorted_scores))
-        top_ranked = [s[0] for s in sorted_scores[:top_n]]
-
-        return [top_ranked]
+        if self._batch_size == 1:
+            return [self.get_relevant_score(text, reference_string) for text in inputs]
+
+        batches = self._batches(inputs)
+        scores: List[float] = [0.0] * len(inputs)
+        workers = min(self._max_workers, len(batches))
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rerank") as executor:
+            results = executor.map(lambda batch: self.score_batch([inputs[i] for i in batch], reference_string), batches)
+            for batch, batch_scores in zip(batches, results):
+                for i, batch_score in zip(batch, batch_scores):
+                    scores[i] = batch_score
+        return scores
 
 if __name__ == "__main__":
     ori = "What are the effects of schizophrenia on memory?"
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import re
+import threading
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """
+    64-bit SimHash of the word shingles of a text. Near-identical texts get
+    fingerprints that differ in only a few bits.
+
+    :param text: The text to fingerprint.
+    :param shingle_size: int, default 3. Words per shingle.
+    :return: The fingerprint.
+    """
+    words = TOKEN_PATTERN.findall(text.lower())
+    shingles = [" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))]
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+@dataclass
+class PackingReport:
+    passages_in: int = 0
+    passages_out: int = 0
+    exact_duplicates: int = 0
+    near_duplicates: int = 0
+    over_budget: int = 0
+    tokens_in: int = 0
+    tokens_out: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_in - self.tokens_out
+
+    def as_dict(self) -> Dict[str, int]:
+        return {**asdict(self), "tokens_saved": self.tokens_saved}
+
+
+class ContextPacker:
+    """
+    Removes duplicate passages and packs the rest under a token budget before generation.
+
+    Passages are expected in relevance order. Exact duplicates (after case and
+    whitespace normalization) and near duplicates (SimHash fingerprints within
+    `max_distance` bits) of an earlier passage are dropped. The remaining passages
+    are kept in order as long as they fit in `max_tokens`, counted with the same
+    tokenizer llama_index uses.
+
+    :param max_tokens: int, default 3000. Token budget of the packed contexts.
+    :param max_distance: int, default 3. Largest SimHash Hamming distance still counted as a near duplicate.
+    :param tokenizer: Callable returning the tokens of a text, default None. llama_index's tokenizer if None.
+    """
+
+    def __init__(self,
+                 max_tokens: int = 3000,
+                 max_distance: int = 3,
+                 tokenizer: Optional[Callable[[str], List]] = None):
+        self.max_tokens = max_tokens
+        self.max_distance = max_distance
+        self._tokenizer = tokenizer
+        self._lock = threading.Lock()
+        self.totals = PackingReport()
+
+    @property
+    def tokenizer(self) -> Callable[[str], List]:
+        if self._tokenizer is None:
+            from llama_index.core.utils import get_tokenizer
+
+            self._tokenizer = get_tokenizer()
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text))
+
+    def pack(self, contexts: List[str]) -> Tuple[List[str], PackingReport]:
+        """
+        Deduplicate and budget the contexts.
+
+        :param contexts: The passages, most relevant first.
+        :return: The packed passages and the report of what was dropped.
+        """
+        report = PackingReport(passages_in=len(contexts))
+        packed: List[str] = []
+        seen = set()
+        fingerprints: List[int] = []
+        budget = self.max_tokens
+
+        for passage in contexts:
+            tokens = self.count_tokens(passage)
+            report.tokens_in += tokens
+
+            normalized = " ".join(passage.lower().split())
+            if normalized in seen:
+                report.exact_duplicates += 1
+                continue
+            seen.add(normalized)
+
+            fingerprint = simhash(passage)
+            if any(bin(fingerprint ^ other).count("1") <= self.max_distance for other in fingerprints):
+                report.near_duplicates += 1
+                continue
+
+            if tokens > budget:
+                # Skip it, a later and shorter passage may still fit
+                report.over_budget += 1
+                continue
+
+            fingerprints.append(fingerprint)
+            packed.append(passage)
+            budget -= tokens
+            report.tokens_out += tokens
+
+        report.passages_out = len(packed)
+        with self._lock:
+            for field, value in asdict(report).items():
+                setattr(self.totals, field, getattr(self.totals, field) + value)
+        return packed, report
+
+
+def context_packer_from_env() -> ContextPacker:
+    """
+    Build a ContextPacker with the budget of the RAG_CONTEXT_MAX_TOKENS environment variable.
+    """
+    return ContextPacker(max_tokens=int(os.getenv("RAG_CONTEXT_MAX_TOKENS", 3000)))
+
+
+if __name__ == "__main__":
+    contexts = [
+        "The Old Quarter of Hanoi is packed with street food stalls serving pho, bun cha and banh mi.",
+        "Ta Hien street in Hanoi's Old Quarter is famous for beer corners and grilled street food at night.",
+        "The Old Quarter of Hanoi is packed with street food stalls serving pho, bun cha and banh mi.",
+        "The Old Quarter of Hanoi is packed with street-food stalls serving pho, bun cha, and banh mi!",
+        "Dong Xuan market in Hanoi sells fresh produce and has a food court with local dishes.",
+        "Ta Hien street in Hanoi's Old Quarter is famous for beer corners and grilled street food at night.",
+    ]
+    packed, report = ContextPacker(max_tokens=60).pack(contexts)
+    for passage in packed:
+        print(f"- {passage}")
+    print(report.as_dict())
@@ -0,0 +1,344 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from llama_index.core.llms import CompletionResponse, CompletionResponseAsyncGen, CompletionResponseGen
+
+from core.concurrency.Limiter import get_limiter
+
+from core.llm.CustomLLM import error_response, is_error
+from core.retrieval.HybridRetriever import reciprocal_rank_fusion
+
+
+class PipelineTimer:
+    """
+    Thread-safe per-stage timings of one pipeline run, relative to its start.
+
+    For every stage it records when the first call started, when the last call
+    ended, the number of calls and the summed busy time. Overlapping calls of
+    different stages are what the streaming pipeline buys.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self.marks: Dict[str, float] = {}
+
+    def _now_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = self._now_ms()
+        try:
+            yield
+        finally:
+            ended = self._now_ms()
+            with self._lock:
+                entry = self._stages.setdefault(name, {"start_ms": started, "end_ms": ended, "calls": 0, "busy_ms": 0.0})
+                entry["start_ms"] = min(entry["start_ms"], started)
+                entry["end_ms"] = max(entry["end_ms"], ended)
+                entry["calls"] += 1
+                entry["busy_ms"] += ended - started
+
+    def mark(self, name: str) -> None:
+        """Record a point in time, e.g. the first generated token. Only the first mark counts."""
+        with self._lock:
+            self.marks.setdefault(name, self._now_ms())
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {name: {k: round(v, 2) for k, v in entry.items()} for name, entry in self._stages.items()}
+            marks = {name: round(value, 2) for name, value in self.marks.items()}
+        return {"stages": stages, "marks": marks}
+
+
+class StreamingRagPipeline:
+    """
+    Streaming variant of `Rag.complete` in which every stage consumes items as soon
+    as the previous stage produces them.
+
+    MultiStep sub-queries are read line by line from the streamed decomposition.
+    Each sub-query is handed to a worker that writes its HyDE document and then
+    searches with it, so retrieval for the first sub-query runs while later ones
+    are still being generated. Generation starts as soon as `min_contexts`
+    passages are available (or every search has finished) and is streamed.
+
+    `stream` runs the stages on worker threads, `astream` runs them as tasks on the
+    event loop with every LLM call and search on the shared UpstreamLimiter.
+
+    :param rag: The Rag instance providing the LLM, transformers, retrieval and reranker.
+    :param min_contexts: int, default None. Number of passages after which generation may start
+                         without waiting for the remaining sub-queries. If None, wait for all of them.
+    :param max_workers: int, default 4. Maximum number of sub-query chains in flight.
+    :param reranker: str or BaseReranker, default None. Overrides the Rag instance's reranker.
+    """
+
+    def __init__(self, rag: Any, min_contexts: Optional[int] = None, max_workers: int = 4, reranker: Any = None):
+        self.rag = rag
+        self.reranker = rag.reranker if reranker is None else reranker
+        self.min_contexts = float("inf") if min_contexts is None else max(1, min_contexts)
+        self.max_workers = max(1, max_workers)
+        self.timer = PipelineTimer()
+        self._transform = False
+        self.packing: Dict[str, int] = {}
+
+    def _sub_queries(self, prompt: str) -> Iterator[str]:
+        from core.rag.RAG import get_transform
+
+        transformers = self.rag.transformers or []
+        with self.timer.stage("route"):
+            route = self.rag.route(prompt)
+        if route == "direct":
+            return
+        # Only the "transform" route uses the transformers, as in `Rag.complete`
+        self._transform = route == "transform"
+        if not self._transform or "MultiStep" not in transformers:
+            yield prompt
+            return
+
+        produced = False
+        sub_queries = get_transform("MultiStep").stream_transform(prompt)
+        while True:
+            with self.timer.stage("multistep"):
+                sub_query = next(sub_queries, None)
+            if sub_query is None:
+                break
+            produced = True
+            yield sub_query
+        if not produced:
+            yield prompt
+
+    def _chain(self, query: str, use_hyde: bool) -> List[str]:
+        from core.rag.RAG import get_transform
+
+        search_query = query
+        if use_hyde:
+            try:
+                with self.timer.stage("hyde"):
+                    documents = get_transform("HyDE").transform(query)
+                if documents and documents[0]:
+                    search_query = documents[0][0]
+            except Exception as e:
+                # Search with the sub-query itself rather than losing its contexts
+                print(f"Error writing the HyDE document, searching with the query: {e}")
+        with self.timer.stage("retrieve"):
+            return self.rag.retrieve(search_query)
+
+    def gather_contexts(self, prompt: str) -> List[str]:
+        """
+        Run the decomposition, HyDE and retrieval stages concurrently.
+
+        :param prompt: The user query.
+        :return: The contexts gathered once the budget is met, in sub-query order.
+        """
+        use_hyde = "HyDE" in (self.rag.transformers or [])
+        futures: List[Future] = []
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rag-pipeline")
+
+        def ready_contexts() -> int:
+            return sum(len(f.result()) for f in futures if f.done() and f.exception() is None)
+
+        try:
+            sub_queries = self._sub_queries(prompt)
+            for sub_query in sub_queries:
+                futures.append(executor.submit(self._chain, sub_query, use_hyde and self._transform))
+                if ready_contexts() >= self.min_contexts:
+                    # Enough context already, stop decomposing
+                    sub_queries.close()
+                    break
+
+            pending = {f for f in futures if not f.done()}
+            deadline = None if self.rag.retrieve_timeout is None else time.monotonic() + self.rag.retrieve_timeout
+            while pending and ready_contexts() < self.min_contexts:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    print(f"Streaming pipeline gave up on {len(pending)} sub-queries after {self.rag.retrieve_timeout}s.")
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        rankings: List[List[str]] = []
+        for future in futures:
+            if future.done() and not future.cancelled():
+                if future.exception() is not None:
+                    print(f"Error retrieving contexts: {future.exception()}")
+                    continue
+                rankings.append(future.result())
+        contexts = reciprocal_rank_fusion(rankings)
+
+        reranker = self.rag.get_reranker(self.reranker)
+        if reranker is not None and contexts:
+            with self.timer.stage("rerank"):
+                contexts = reranker.rerank(contexts, prompt)
+        contexts, report = self.rag.pack_contexts(contexts)
+        self.packing = report.as_dict()
+        return contexts
+
+    async def _asub_queries(self, prompt: str) -> AsyncIterator[str]:
+        from core.rag.RAG import get_transform
+
+        transformers = self.rag.transformers or []
+        with self.timer.stage("route"):
+            route = await self.rag.aroute(prompt)
+        if route == "direct":
+            return
+        self._transform = route == "transform"
+        if not self._transform or "MultiStep" not in transformers:
+            yield prompt
+            return
+
+        produced = False
+        sub_queries = get_transform("MultiStep").astream_transform(prompt)
+        try:
+            while True:
+                with self.timer.stage("multistep"):
+                    try:
+                        sub_query = await sub_queries.__anext__()
+                    except StopAsyncIteration:
+                        break
+                produced = True
+                yield sub_query
+        finally:
+            await sub_queries.aclose()
+        if not produced:
+            yield prompt
+
+    async def _achain(self, query: str, use_hyde: bool, slots: asyncio.Semaphore) -> List[str]:
+        from core.rag.RAG import get_transform
+
+        async with slots:
+            search_query = query
+            if use_hyde:
+                try:
+                    with self.timer.stage("hyde"):
+                        documents = await get_transform("HyDE").atransform(query)
+                    if documents and documents[0]:
+                        search_query = documents[0][0]
+                except Exception as e:
+                    print(f"Error writing the HyDE document, searching with the query: {e}")
+            with self.timer.stage("retrieve"):
+                return (await self.rag.aretrieve_many([search_query]))[0]
+
+    async def agather_contexts(self, prompt: str) -> List[str]:
+        """
+        Async version of `gather_contexts`.
+
+        :param prompt: The user query.
+        :return: The contexts gathered once the budget is met, in sub-query order.
+        """
+        use_hyde = "HyDE" in (self.rag.transformers or [])
+        slots = asyncio.Semaphore(self.max_workers)
+        tasks: List[asyncio.Future] = []
+
+        def ready_contexts() -> int:
+            return sum(len(t.result()) for t in tasks if t.done() and not t.cancelled() and t.exception() is None)
+
+        try:
+            sub_queries = self._asub_queries(prompt)
+            try:
+                async for sub_query in sub_queries:
+                    tasks.append(asyncio.ensure_future(self._achain(sub_query, use_hyde and self._transform, slots)))
+                    if ready_contexts() >= self.min_contexts:
+                        # Enough context already, stop decomposing
+                        break
+            finally:
+                await sub_queries.aclose()
+
+            pending = {t for t in tasks if not t.done()}
+            deadline = None if self.rag.retrieve_timeout is None else time.monotonic() + self.rag.retrieve_timeout
+            while pending and ready_contexts() < self.min_contexts:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    print(f"Streaming pipeline gave up on {len(pending)} sub-queries after {self.rag.retrieve_timeout}s.")
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        rankings: List[List[str]] = []
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                if task.exception() is not None:
+                    print(f"Error retrieving contexts: {task.exception()}")
+                    continue
+                rankings.append(task.result())
+        contexts = reciprocal_rank_fusion(rankings)
+
+        reranker = self.rag.get_reranker(self.reranker)
+        if reranker is not None and contexts:
+            with self.timer.stage("rerank"):
+                contexts = await get_limiter().run("rerank", reranker.rerank, contexts, prompt)
+        contexts, report = self.rag.pack_contexts(contexts)
+        self.packing = report.as_dict()
+        return contexts
+
+    def stream(self,
+               prompt: str,
+               history: Optional[List[dict]] = None) -> CompletionResponseGen:
+        """
+        Stream the answer to a query.
+
+        :param prompt: The user query.
+        :param history: Optional history of previous interactions.
+        :yield: Partial CompletionResponses carrying only the delta. A final response with an
+                empty delta carries the full text, the stage timings in `additional_kwargs["timings"]`
+                and the context packing report in `additional_kwargs["packing"]`. If generation fails,
+                it is an `error_response` instead.
+        """
+        contexts = self.gather_contexts(prompt)
+        generation_prompt = self.rag.build_prompt(contexts=contexts, query=prompt, history=history)
+
+        parts: List[str] = []
+        with self.timer.stage("generate"):
+            for response in self.rag.llm.stream_complete(generation_prompt):
+                if is_error(response):
+                    yield error_response(response.additional_kwargs.get("error", response.text),
+                                         timings=self.timer.as_dict())
+                    return
+                if not response.delta:
+                    # The LLM's closing response, replaced by ours below
+                    continue
+                self.timer.mark("first_token")
+                parts.append(response.delta)
+                yield CompletionResponse(text="", delta=response.delta)
+
+        yield CompletionResponse(text="".join(parts), delta="", additional_kwargs={"timings": self.timer.as_dict(), "packing": self.packing})
+
+    async def astream(self,
+                      prompt: str,
+                      history: Optional[List[dict]] = None) -> CompletionResponseAsyncGen:
+        """
+        Async version of `stream`.
+
+        :param prompt: The user query.
+        :param history: Optional history of previous interactions.
+        :yield: Partial CompletionResponses, closed by the same final response as `stream`.
+        """
+        contexts = await self.agather_contexts(prompt)
+        generation_prompt = self.rag.build_prompt(contexts=contexts, query=prompt, history=history)
+
+        parts: List[str] = []
+        with self.timer.stage("generate"):
+            responses = await self.rag.llm.astream_complete(generation_prompt)
+            try:
+                async for response in responses:
+                    if is_error(response):
+                        yield error_response(response.additional_kwargs.get("error", response.text),
+                                             timings=self.timer.as_dict())
+                        return
+                    if not response.delta:
+                        continue
+                    self.timer.mark("first_token")
+                    parts.append(response.delta)
+                    yield CompletionResponse(text="", delta=response.delta)
+            finally:
+                await responses.aclose()
+
+        yield CompletionResponse(text="".join(parts), delta="", additional_kwargs={"timings": self.timer.as_dict(), "packing": self.packing})
@@ -0,0 +1,98 @@
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from core.cache.SemanticCache import SemanticCache
+from core.llm.CustomLLM import RagoonBot, get_llm
+from core.rag.RAG import Rag
+
+DEFAULT_TRANSFORMERS = ("MultiStep", "HyDE")
+
+
+class PipelineRegistry:
+    """
+    App-level store of the LLMs and RAG pipelines shared by every request.
+
+    A `RagoonBot` is built once per model (through `get_llm`) and a `Rag` once per
+    (model, transformers). Both are stateless between calls, so the same instance
+    serves concurrent requests.
+
+    :param semantic_cache: SemanticCache, default None. Handed to every Rag built by the registry.
+    :param rag_kwargs: Extra arguments for every Rag, e.g. limit_to_retrieve or reranker.
+    """
+
+    def __init__(self, semantic_cache: Optional[SemanticCache] = None, **rag_kwargs):
+        self.semantic_cache = semantic_cache
+        self.rag_kwargs = rag_kwargs
+        self._rags: Dict[Tuple[str, Tuple[str, ...]], Rag] = {}
+        self._lock = threading.Lock()
+
+    def llm(self, model: str = "mistral-large2") -> RagoonBot:
+        """
+        Return the shared RagoonBot of a model.
+        """
+        return get_llm(model)
+
+    def rag(self,
+            model: str = "mistral-large2",
+            transformers: Optional[Union[str, Sequence[str]]] = None) -> Rag:
+        """
+        Return the shared Rag pipeline of a model and transformer set, building it on first use.
+
+        :param model: The model name.
+        :param transformers: The transformers to apply. Defaults to MultiStep and HyDE.
+        :return: The Rag instance.
+        """
+        if transformers is None:
+            transformers = DEFAULT_TRANSFORMERS
+        elif isinstance(transformers, str):
+            transformers = (transformers,)
+        key = (model, tuple(transformers))
+
+        rag = self._rags.get(key)
+        if rag is None:
+            with self._lock:
+                rag = self._rags.get(key)
+                if rag is None:
+                    rag = Rag(
+                        llm=self.llm(model),
+                        transformers=list(transformers),
+                        semantic_cache=self.semantic_cache,
+                        **self.rag_kwargs
+                    )
+                    self._rags[key] = rag
+        return rag
+
+    def warm(self, models: List[str], transformers: Optional[Sequence[str]] = None) -> None:
+        """
+        Build the pipelines of the given models ahead of the first request.
+        """
+        for model in models:
+            self.rag(model, transformers)
+
+    def __len__(self) -> int:
+        return len(self._rags)
+
+
+if __name__ == "__main__":
+    import io
+    import time
+    from contextlib import redirect_stdout
+
+    # Per-request construction, as the endpoints used to do, against registry lookups
+    requests = 2000
+    registry = PipelineRegistry()
+
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(requests):
+            Rag(llm=RagoonBot(model="mistral-large2"))
+        per_request = (time.perf_counter() - start) / requests
+
+        registry.warm(["mistral-large2"])
+        start = time.perf_counter()
+        for _ in range(requests):
+            registry.rag("mistral-large2")
+        shared = (time.perf_counter() - start) / requests
+
+    print(f"Per-request construction: {per_request * 1e6:,.1f} us/request")
+    print(f"Registry lookup: {shared * 1e6:,.2f} us/request ({per_request / shared:,.0f}x less overhead)")
@@ -1,65 +1,205 @@
+import asyncio
+import json
 import os
-import time
+import re
+import threading
 
-from dotenv import load_dotenv
 from snowflake.snowpark.session import Session
-from snowflake.core import Root
-from snowflake.cortex import Complete
 from llama_index.core.llms import LLM
 from typing import Any, List, Dict, Callable, Union, Optional, Tuple
-from llama_index.core.llms import CompletionResponse, CompletionResponseGen
-from core.llm.CustomLLM import RagoonBot
+from llama_index.core.llms import CompletionResponse, CompletionResponseAsyncGen, CompletionResponseGen
+from core.llm.CustomLLM import RagoonBot, error_response, get_llm, is_error
 from core.preprocessing.HYDE.HyDETransform import HyDETransformer
 from core.preprocessing.MultiStep.MultiStepTransform import MultiStepTransformer
 from core.preprocessing.rerank.Reranker import Reranker
-from geo.utils import *
-
-load_dotenv('../../.env')
-llm = RagoonBot()
-
-try:
-    connection_params = {
-        "account":  os.environ["SNOWFLAKE_ACCOUNT"],
-        "user": os.environ["SNOWFLAKE_USER"],
-        "password": os.environ["SNOWFLAKE_USER_PASSWORD"],
-        "role": os.environ["SNOWFLAKE_ROLE"],
-        "database": os.environ["SNOWFLAKE_DATABASE"],
-        "schema": os.environ["SNOWFLAKE_SCHEMA"],
-        "warehouse": os.environ["SNOWFLAKE_WAREHOUSE"],
-        "service": os.environ["SNOWFLAKE_CORTEX_SEARCH_SERVICE"],
-    }
-except KeyError as e:
-    print("Please set the environment variable: " + str(e))
-
-try:
-    snowpark_session = Session.builder.configs(connection_params).create()
-except Exception as e:
-    print("Error creating Snowpark session: " + str(e))
-
-transforms = {
-    'HyDE': HyDETransformer(),
-    'MultiStep': MultiStepTransformer(),
-    'Rerank': Reranker("")
+from core.preprocessing.rerank.BaseReranker import BaseReranker
+from core.preprocessing.rerank.LocalReranker import LocalReranker, DEFAULT_CROSS_ENCODER
+from core.connection.SessionPool import SessionPool, get_session_pool
+from core.retrieval.BaseRetriever import BaseRetriever
+from core.retrieval.CortexSearchRetriever import CortexSearchRetriever, search_params_from_env
+from core.retrieval.BM25Retriever import BM25Retriever
+from core.retrieval.HybridRetriever import HybridRetriever, reciprocal_rank_fusion
+from core.retrieval.LocalVectorRetriever import LocalVectorRetriever
+from core.cache.SemanticCache import SemanticCache
+from core.rag.Pipeline import StreamingRagPipeline
+from core.concurrency.Limiter import get_limiter
+from core.rag.Router import QueryRouter, RouteDecision, get_router
+from core.rag.ContextPacker import ContextPacker, PackingReport, context_packer_from_env
+from core.memory.HistoryManager import HistoryManager, get_history_manager
+from geo.spatial import PointIndex, get_poi_index
+
+# Transformers are built on first use, so importing this module needs no credentials
+transform_factories: Dict[str, Callable[[], Any]] = {
+    'HyDE': HyDETransformer,
+    'MultiStep': MultiStepTransformer,
+    'Rerank': lambda: Reranker(""),
+    'LocalRerank': LocalReranker
+}
+# Reranker backends applied to the retrieved contexts, selectable per request
+reranker_factories: Dict[str, Callable[[], BaseReranker]] = {
+    'llm': lambda: Reranker(""),
+    'bm25': LocalReranker,
+    'cross-encoder': lambda: LocalReranker(cross_encoder=DEFAULT_CROSS_ENCODER)
 }
+_transforms: Dict[str, Any] = {}
+_rerankers: Dict[str, BaseReranker] = {}
+_transforms_lock = threading.Lock()
+
+
+def _get_shared(name: str, factories: Dict[str, Callable[[], Any]], instances: Dict[str, Any]) -> Any:
+    instance = instances.get(name)
+    if instance is None and name in factories:
+        with _transforms_lock:
+            instance = instances.get(name)
+            if instance is None:
+                instance = factories[name]()
+                instances[name] = instance
+    return instance
+
+
+def get_transform(name: str) -> Any:
+    """
+    Return the shared transformer registered under `name`, building it on first use.
+
+    :param name: One of the keys of `transform_factories`.
+    :return: The transformer instance, or None if the name is unknown.
+    """
+    return _get_shared(name, transform_factories, _transforms)
+
+
+def get_reranker(name: str) -> Optional[BaseReranker]:
+    """
+    Return the shared reranker backend registered under `name`, building it on first use.
+
+    :param name: One of the keys of `reranker_factories`.
+    :return: The reranker instance, or None if the name is unknown.
+    """
+    return _get_shared(name, reranker_factories, _rerankers)
+
+
+def retriever_from_env(limit: int = 4,
+                       retrieve_column: str = "INFORMATION",
+                       name: Optional[str] = None,
+                       **cortex_kwargs: Any) -> BaseRetriever:
+    """
+    Build the retriever selected by RAG_RETRIEVER.
+
+    "cortex" (the default) searches the Cortex Search service. "local" opens the
+    LocalVectorRetriever index written to LOCAL_INDEX_DIR, searched with
+    LOCAL_INDEX_N_PROBE clusters (default 8) and queries embedded with the embedder
+    the index was built with, e.g. Cortex for an index built with CortexEmbedder. "bm25" searches an in-memory BM25
+    index of the rows of LOCAL_INDEX_DIR, or of the RAG_KNOWLEDGE_TABLE table.
+    "hybrid" (experimental) fuses that BM25 index, weighted below the dense
+    ranking, with the RAG_HYBRID_DENSE retriever, "cortex" by default.
+
+    :param limit: int, default 4. The number of passages per query.
+    :param retrieve_column: The column holding the passage text.
+    :param name: str, default None. The retriever to build instead of RAG_RETRIEVER.
+    :param cortex_kwargs: Further arguments of the CortexSearchRetriever.
+    :return: The retriever.
+    """
+    name = (name or os.getenv("RAG_RETRIEVER", "cortex")).lower()
+    if name == "cortex":
+        return CortexSearchRetriever(limit=limit, retrieve_column=retrieve_column, **cortex_kwargs)
+    if name == "local":
+        directory = os.getenv("LOCAL_INDEX_DIR")
+        if not directory:
+            raise ValueError("RAG_RETRIEVER=local needs LOCAL_INDEX_DIR, the directory of a LocalVectorRetriever index.")
+        return LocalVectorRetriever(
+            directory,
+            limit=limit,
+            n_probe=int(os.getenv("LOCAL_INDEX_N_PROBE", 8)),
+            retrieve_column=retrieve_column,
+            session_pool=cortex_kwargs.get("session_pool")
+        )
+    if name in ("bm25", "hybrid"):
+        directory, table = os.getenv("LOCAL_INDEX_DIR"), os.getenv("RAG_KNOWLEDGE_TABLE")
+        if directory:
+            with open(os.path.join(directory, "rows.jsonl"), encoding="utf-8") as f:
+                lexical = BM25Retriever.from_rows([json.loads(line) for line in f], column=retrieve_column, limit=limit)
+        elif table:
+            lexical = BM25Retriever.from_snowflake(
+                table, column=retrieve_column, session_pool=cortex_kwargs.get("session_pool"), limit=limit
+            )
+        else:
+            raise ValueError(f"RAG_RETRIEVER={name} needs LOCAL_INDEX_DIR or RAG_KNOWLEDGE_TABLE to index the passages.")
+        if name == "bm25":
+            return lexical
+        dense_name = os.getenv("RAG_HYBRID_DENSE", "cortex").lower()
+        if dense_name not in ("cortex", "local"):
+            raise ValueError(f"Unknown RAG_HYBRID_DENSE {dense_name!r}. Choose from 'cortex' and 'local'.")
+        dense = retriever_from_env(limit=limit, retrieve_column=retrieve_column, name=dense_name, **cortex_kwargs)
+        return HybridRetriever(dense, lexical, limit=limit)
+    raise ValueError(f"Unknown RAG_RETRIEVER {name!r}. Choose from 'cortex', 'local', 'bm25' and 'hybrid'.")
+
 
 class Rag:
     def __init__(
         self, 
-        llm: LLM = llm,
+        llm: Optional[Union[LLM, str]] = None,
         transformers: Union[str, List[str]] = ["MultiStep", "HyDE"],
-        snowpark_session: Session = snowpark_session,
+        session_pool: Optional[SessionPool] = None,
+        snowpark_session: Optional[Session] = None,
         limit_to_retrieve: int = 4,
-        snowflake_params: Dict[str, str] = connection_params,
+        snowflake_params: Optional[Dict[str, str]] = None,
         search_columns: List[str] = ["NAME", "INFORMATION"],
-        retrieve_column: str = "INFORMATION"
+        retrieve_column: str = "INFORMATION",
+        max_concurrent_retrievals: int = 4,
+        retrieve_timeout: Optional[float] = 30.0,
+        semantic_cache: Optional[SemanticCache] = None,
+        reranker: Optional[Union[str, BaseReranker]] = None,
+        stream_min_contexts: Optional[int] = None,
+        router: Optional[QueryRouter] = None,
+        retriever: Optional[BaseRetriever] = None,
+        context_packer: Optional[ContextPacker] = None,
+        history_manager: Optional[HistoryManager] = None,
+        poi_index: Optional[PointIndex] = None,
+        proximity_km: float = 5.0
     ):
         """
         Initialize the RAG instance.
 
-        TODO: param
+        :param llm: LLM or str, default None. The generation model, or a model name to build a RagoonBot for.
+                    If None, the shared default LLM is used.
+        :param transformers: str or list, default ["MultiStep", "HyDE"]. Keys of `transform_factories`
+                             applied to the query before retrieval.
+        :param session_pool: SessionPool, default None. The pool searches check sessions out of.
+                             If None, the process-wide pool is used.
+        :param snowpark_session: Session, default None. Pin every search to this session instead of the pool.
+        :param snowflake_params: dict, default None. The database, schema and service to search.
+                                 If None, they are read from the environment on first search.
+        :param limit_to_retrieve: int, default 4. The number of passages searched per query.
+        :param search_columns: The columns the search service returns.
+        :param retrieve_column: The column holding the passage text.
+        :param max_concurrent_retrievals: int, default 4. Maximum number of searches in flight per request.
+        :param retrieve_timeout: float, default 30. Seconds after which a search is given up.
+        :param semantic_cache: SemanticCache, default None. Serves stored answers to queries
+                               similar to ones answered before. Only used without history.
+        :param reranker: str or BaseReranker, default None. Reranks the retrieved contexts against the
+                         query, either a backend instance or a key of `reranker_factories`
+                         ("llm", "bm25", "cross-encoder"). Can be overridden per `complete` call.
+        :param stream_min_contexts: int, default None. In `stream_complete`, start generating once this many
+                                    passages are retrieved instead of waiting for every sub-query.
+        :param router: QueryRouter, default None. Decides per query whether to answer directly, retrieve
+                       or run the transformers. If None, the process-wide router is used.
+        :param retriever: BaseRetriever, default None. Where contexts are searched, e.g. a
+                          LocalVectorRetriever or a HybridRetriever. If None, the one selected by RAG_RETRIEVER
+                          (see `retriever_from_env`), by default a CortexSearchRetriever built from the
+                          session and search parameters above.
+        :param context_packer: ContextPacker, default None. Removes duplicate passages and enforces the
+                               context token budget. If None, one with the RAG_CONTEXT_MAX_TOKENS budget.
+        :param history_manager: HistoryManager, default None. Compacts long histories in the generation
+                                prompt. If None, the process-wide manager is used.
+        :param poi_index: PointIndex, default None. Places of the knowledge table with their coordinates,
+                          used to filter the contexts of requests that carry a `location`. If None, the
+                          process-wide index is used, if one is configured.
+        :param proximity_km: float, default 5.0. Radius around the request location whose places are kept.
         """
-        if isinstance(llm, str):
-            self.llm = RagoonBot(model=llm)
+        self._session_pool = session_pool
+        if llm is None:
+            self.llm = get_llm()
+        elif isinstance(llm, str):
+            self.llm = RagoonBot(model=llm, session_pool=session_pool)
         else:
             self.llm = llm
         
@@ -68,58 +208,186 @@ class Rag:
         else:
             self.transformers = transformers
 
-        self._snowpark_session = snowpark_session
-        self._limit_to_retrieve = limit_to_retrieve
-        self.snowflake_params = snowflake_params
-        self.search_columns = search_columns
-        self.retrieve_column = retrieve_column
+        self.max_concurrent_retrievals = max(1, max_concurrent_retrievals)
+        self.retrieve_timeout = retrieve_timeout
+        if retriever is None:
+            retriever = retriever_from_env(
+                limit=limit_to_retrieve,
+                retrieve_column=retrieve_column,
+                session_pool=session_pool,
+                snowpark_session=snowpark_session,
+                snowflake_params=snowflake_params,
+                search_columns=search_columns,
+                max_concurrent=self.max_concurrent_retrievals,
+                timeout=retrieve_timeout
+            )
+        self.retriever = retriever
+        self.context_packer = context_packer or context_packer_from_env()
+        self._history_manager = history_manager
+        self.semantic_cache = semantic_cache
+        self.reranker = reranker
+        self.stream_min_contexts = stream_min_contexts
+        self._router = router
+        self._poi_index = poi_index
+        self.proximity_km = proximity_km
+
+    route_prompt = """
+            Decide how the user query of a Vietnam travel assistant should be answered.
+            Answer DIRECT if it is small talk or general knowledge that needs no travel data,
+            RETRIEVE if it asks about one place, dish or fact that can be looked up,
+            TRANSFORM if it combines several questions, compares options or asks for a plan.
+            Do not include any other information, just DIRECT, RETRIEVE or TRANSFORM.
+
+            User Query: {}
+        """
+
+    @property
+    def router(self) -> QueryRouter:
+        return self._router or get_router()
+
+    def route(self, text: str) -> str:
+        """
+        Decide how to answer a query: "direct", "retrieve" or "transform".
+
+        The local router decides in microseconds; only queries it is unsure about
+        cost an LLM call. Retrieval is only skipped for confident "direct" decisions.
+
+        :param text: The user query.
+        :return: The route.
+        """
+        decision = self.router.classify(text)
+        if not self.router.is_confident(decision):
+            response = self.llm.complete(self.route_prompt.format(text))
+            decision = RouteDecision(self._parse_route(response.text), decision.confidence, source="llm")
+        self.router.log(text, decision)
+        return self.router.finalize(decision)
+
+    async def aroute(self, text: str) -> str:
+        decision = self.router.classify(text)
+        if not self.router.is_confident(decision):
+            response = await self.llm.acomplete(self.route_prompt.format(text))
+            decision = RouteDecision(self._parse_route(response.text), decision.confidence, source="llm")
+        self.router.log(text, decision)
+        return self.router.finalize(decision)
 
     def controller(self, text: str, **kwargs: Any) -> bool:
         # If the text is about basic information, return True
-        prompt = """
-            Return True if the user query is about basic information or general knowledge.
-            Otherwise, return False.
-            Do not include any other information, just True or False.
+        return self.route(text) != "transform"
 
-            User Query: {}
+    @staticmethod
+    def _parse_route(response: str) -> str:
+        # The first route named in the answer wins, anything unparseable gets the full pipeline
+        match = re.search(r"\b(direct|retrieve|transform)\b", response.lower())
+        if match is None:
+            print(f"Invalid response from the router: {response!r}, using the transformers.")
+            return "transform"
+        return match.group(1)
+
+    @property
+    def session_pool(self) -> SessionPool:
+        return self._session_pool or get_session_pool()
+
+    @property
+    def history_manager(self) -> HistoryManager:
+        return self._history_manager or get_history_manager()
+
+    @property
+    def poi_index(self) -> Optional[PointIndex]:
+        return self._poi_index or get_poi_index()
+
+    def filter_nearby(self,
+                      contexts: List[str],
+                      location: Optional[Tuple[float, float]],
+                      radius_km: Optional[float] = None) -> List[str]:
+        """
+        Drop the passages about places far from the user, without an LLM call.
+
+        :param contexts: The passages, most relevant first.
+        :param location: The user's (latitude, longitude), or None to keep every passage.
+        :param radius_km: float, default None. The instance's `proximity_km` if None.
+        :return: The passages about nearby places, then those about places the index does not know.
+                 All of them, unfiltered, if none is about a nearby place.
         """
-        response = self.llm.complete(prompt.format(text))
-        response = response.text
-        response = response.strip()
-        assert response in ["True", "False"], f"Invalid response from the controller: {response.text}"
-        return response == "True"
+        index = self.poi_index
+        if location is None or index is None or not contexts:
+            return contexts
+        return index.filter_passages(contexts, tuple(location), radius_km or self.proximity_km,
+                                     column=getattr(self.retriever, "retrieve_column", "INFORMATION"))
 
     def retrieve(self, query: str) -> List[str]:
-        root = Root(self._snowpark_session)
-        cortex_search_service = (
-            root.databases[self.snowflake_params.get("database")]
-            .schemas[self.snowflake_params.get("schema")]
-            .cortex_search_services[self.snowflake_params.get("service")]
-        )
-        resp = cortex_search_service.search(
-            query=query,
-            columns=self.search_columns,
-            limit=self._limit_to_retrieve,
-        )
+        return self.retriever.retrieve(query)
 
-        if resp.results:
-            return [curr[self.retrieve_column] for curr in resp.results]
-        else:
+    def get_reranker(self, reranker: Optional[Union[str, BaseReranker]]) -> Optional[BaseReranker]:
+        """
+        Resolve a reranker backend name to its shared instance.
+        """
+        if reranker is None or isinstance(reranker, BaseReranker):
+            return reranker
+        resolved = get_reranker(reranker)
+        if resolved is None:
+            raise ValueError(f"Unknown reranker backend: {reranker}. Choose from {list(reranker_factories)}.")
+        return resolved
+
+    def retrieve_many(self, queries: List[str]) -> List[List[str]]:
+        """
+        Retrieve contexts for several queries with the retriever's batch search.
+
+        Results are returned in the same order as `queries`. The Cortex retriever runs
+        at most `max_concurrent_retrievals` searches at once and gives up on a query
+        after `retrieve_timeout` seconds; a failed query contributes an empty list.
+
+        :param queries: List[str]. The queries to search for.
+        :return: List[List[str]]. The retrieved contexts, one list per query.
+        """
+        if not queries:
             return []
-    
+        try:
+            return self.retriever.retrieve_batch(queries)
+        except Exception as e:
+            print(f"Error retrieving contexts for {queries}: {e}")
+            return [[] for _ in queries]
 
-    def generate_response(
+    async def aretrieve_many(self, queries: List[str]) -> List[List[str]]:
+        """
+        Async version of `retrieve_many`. The searches share the retriever's upstream
+        slots of the limiter with every other request in the process.
+
+        :param queries: List[str]. The queries to search for.
+        :return: List[List[str]]. The retrieved contexts, one list per query.
+        """
+        limiter = get_limiter()
+        upstream = self.retriever.upstream
+
+        if self.retriever.vectorized:
+            # One call searches every query
+            return await limiter.run(upstream, self.retrieve_many, queries)
+
+        async def search(query: str) -> List[str]:
+            try:
+                return await asyncio.wait_for(limiter.run(upstream, self.retrieve, query), self.retrieve_timeout)
+            except asyncio.TimeoutError:
+                print(f"Retrieval for '{query}' timed out after {self.retrieve_timeout}s.")
+            except Exception as e:
+                print(f"Error retrieving contexts for '{query}': {e}")
+            return []
+
+        return list(await asyncio.gather(*(search(query) for query in queries)))
+
+
+    def build_prompt(
         self,
         contexts: List[str] = [],
         query: str = None,
-        history: Optional[List[dict]] = None,
-        **kwargs: Any
-    ):
+        history: Optional[List[dict]] = None
+    ) -> str:
+        """
+        Build the generation prompt from the retrieved contexts, the query and the history.
+        """
         assert query is not None, "Query cannot be None."
-        if not contexts:
-            context = "None"
+        context = "\n\n".join(contexts) if contexts else "None"
+        # Older turns of long chats are summarized
+        history = self.history_manager.compact(history)
 
-        context = "\n\n".join(contexts)
         # Combine history with the user prompt
         # start with assistant introducing itself
         history_text = "Assistant: Hello, I am Ragoon, an assistant for tourism and travel tasks."
@@ -134,11 +402,28 @@ class Rag:
             Keep the answer concise.
         """
         prompt += f"\n\nContext: {context} \n\nQuery: {query}"
+        return prompt
 
+    def generate_response(
+        self,
+        contexts: List[str] = [],
+        query: str = None,
+        history: Optional[List[dict]] = None,
+        **kwargs: Any
+    ):
+        prompt = self.build_prompt(contexts=contexts, query=query, history=history)
         response = self.llm.complete(prompt)
         # print(prompt)
         return response
 
+    def cache_namespace(self, reranker: Optional[Union[str, BaseReranker]] = None) -> str:
+        """
+        Semantic cache partition: answers from different models or pipelines are not shared.
+        """
+        model = getattr(self.llm, "model", type(self.llm).__name__)
+        reranker = reranker if reranker is None or isinstance(reranker, str) else type(reranker).__name__
+        return f"{model}|{','.join(self.transformers or [])}|{reranker}"
+
     def complete(
         self,
         prompts: Union[str, List[str]] = None,
@@ -149,10 +434,132 @@ class Rag:
         Completes the prompt using the RAG model.
 
         :param prompts: str. The prompts to complete.
+        :param reranker: str or BaseReranker, optional. Overrides the instance's reranker for this request.
+        :param location: (latitude, longitude), optional. Only use passages about places near it.
         :return: str. The completed prompts.
         """
         assert prompts is not None, "Prompt cannot be None."
+
+        # Answers depend on the conversation and the location, so only history-free global queries are cached
+        if self.semantic_cache is None or history or kwargs.get("location") is not None:
+            return self._complete(prompts, history=history, **kwargs)
+
+        query = prompts if isinstance(prompts, str) else prompts[0]
+        return self.semantic_cache.get_or_compute(
+            query,
+            lambda: self._complete(prompts, **kwargs),
+            namespace=self.cache_namespace(kwargs.get("reranker", self.reranker))
+        )
+
+    async def acomplete(
+        self,
+        prompts: Union[str, List[str]] = None,
+        history: Optional[List[dict]] = None,
+        **kwargs
+    ) -> str:
+        """
+        Async version of `complete`. Every LLM call, search and embedding is awaited,
+        so the event loop serves other requests in the meantime.
+
+        :param prompts: str. The prompts to complete.
+        :param reranker: str or BaseReranker, optional. Overrides the instance's reranker for this request.
+        :param location: (latitude, longitude), optional. Only use passages about places near it.
+        :return: str. The completed prompts.
+        """
+        assert prompts is not None, "Prompt cannot be None."
+        limiter = get_limiter()
+
+        query = prompts if isinstance(prompts, str) else prompts[0]
+        use_cache = self.semantic_cache is not None and not history and kwargs.get("location") is None
+        namespace = self.cache_namespace(kwargs.get("reranker", self.reranker))
+        if use_cache:
+            cached = await limiter.run("embed", self.semantic_cache.lookup, query, namespace=namespace)
+            if cached is not None:
+                return cached
+
+        original_prompt, retrieved_contexts = await self.agather_contexts(prompts, **kwargs)
+        try:
+            response = await self.llm.acomplete(
+                self.build_prompt(contexts=retrieved_contexts, query=original_prompt, history=history)
+            )
+        except Exception as e:
+            return f"Error: {e}"
+
+        if use_cache and not response.text.startswith("Error:"):
+            await limiter.run("embed", self.semantic_cache.store, query, response.text, namespace=namespace)
+        return response.text
+
+    async def agather_contexts(
+        self,
+        prompts: Union[str, List[str]],
+        **kwargs
+    ) -> Tuple[str, List[str]]:
+        """
+        Async version of `gather_contexts`. Transformers without an `atransform`
+        method run on the upstream limiter's "rerank" pool.
+
+        :param prompts: str or list. The user query, first if a list.
+        :return: The original query and the contexts to answer it with.
+        """
+        limiter = get_limiter()
+        original_prompt = prompts if isinstance(prompts, str) else prompts[0]
+        _prompt = [[prompts]] if isinstance(prompts, str) else [prompts]
+
+        route = await self.aroute(original_prompt)
+        if route == "direct":
+            return original_prompt, []
+        if route == "retrieve":
+            _prompt = [[original_prompt]]
+        elif self.transformers is not None:
+            for _transformer in self.transformers:
+                prime = get_transform(_transformer)
+                if hasattr(prime, "atransform"):
+                    _prompt = await prime.atransform(_prompt, original_string=original_prompt)
+                else:
+                    _prompt = await limiter.run("rerank", prime.transform, _prompt, original_string=original_prompt)
+
+        queries = [_p[0] for _p in _prompt if _p]
+        # Passages found by several sub-queries are kept once and ranked first
+        retrieved_contexts = reciprocal_rank_fusion(await self.aretrieve_many(queries))
+        retrieved_contexts = self.filter_nearby(retrieved_contexts, kwargs.get("location"))
+
+        reranker = self.get_reranker(kwargs.get("reranker", self.reranker))
+        if reranker is not None and retrieved_contexts:
+            retrieved_contexts = await limiter.run("rerank", reranker.rerank, retrieved_contexts, original_prompt)
+        retrieved_contexts, _ = self.pack_contexts(retrieved_contexts)
+        return original_prompt, retrieved_contexts
+
+    def _complete(
+        self,
+        prompts: Union[str, List[str]],
+        history: Optional[List[dict]] = None,
+        **kwargs
+    ):
+        original_prompt, retrieved_contexts = self.gather_contexts(prompts, **kwargs)
+        try:
+            response = self.generate_response(
+                contexts=retrieved_contexts,
+                query=original_prompt,
+                history=history
+            )
+        except Exception as e:
+            return f"Error: {e}"
         
+        return response.text
+
+    def gather_contexts(
+        self,
+        prompts: Union[str, List[str]],
+        **kwargs
+    ) -> Tuple[str, List[str]]:
+        """
+        Run the router, the transformers, retrieval and reranking.
+
+        :param prompts: str or list. The user query, first if a list.
+        :param reranker: str or BaseReranker, optional. Overrides the instance's reranker for this request.
+        :param location: (latitude, longitude), optional. Only keep passages about places near it.
+        :return: The original query and the contexts to answer it with.
+        """
         if isinstance(prompts, str):
             _prompt = [[prompts]]
             original_prompt = prompts
@@ -162,35 +569,48 @@ class Rag:
             original_prompt = prompts[0]
 
         # Reduce transforms for basic queries
-        if self.controller(original_prompt):
+        route = self.route(original_prompt)
+        if route == "direct":
+            return original_prompt, []
+        if route == "retrieve":
             # No need for transformers
             _prompt = [[original_prompt]]
         else:
-            transforms["Rerank"]._original_string = original_prompt
             if self.transformers is not None:
+                # The shared transformers get the query per call, so concurrent requests cannot mix it up
                 for _transformer in self.transformers:
-                    prime = transforms.get(_transformer)
-                    _prompt = prime.transform(_prompt)
+                    prime = get_transform(_transformer)
+                    _prompt = prime.transform(_prompt, original_string=original_prompt)
 
-        retrieved_contexts = []
-        for _p in _prompt:
-            retrieved_contexts.extend(self.retrieve(_p[0]))
-        
-        try:
-            response = self.generate_response(
-                contexts=retrieved_contexts,
-                query=original_prompt,
-                history=history
-            )
-        except Exception as e:
-            return f"Error: {e}"
-        
-        return response.text
+        queries = [_p[0] for _p in _prompt if _p]
+        # Passages found by several sub-queries are kept once and ranked first
+        retrieved_contexts = reciprocal_rank_fusion(self.retrieve_many(queries))
+        retrieved_contexts = self.filter_nearby(retrieved_contexts, kwargs.get("location"))
+
+        reranker = self.get_reranker(kwargs.get("reranker", self.reranker))
+        if reranker is not None and retrieved_contexts:
+            retrieved_contexts = reranker.rerank(retrieved_contexts, original_prompt)
+        retrieved_contexts, _ = self.pack_contexts(retrieved_contexts)
+        return original_prompt, retrieved_contexts
+
+    def pack_contexts(self, contexts: List[str]) -> Tuple[List[str], PackingReport]:
+        """
+        Drop duplicate passages and fit the rest into the context token budget.
+
+        :param contexts: The passages, most relevant first.
+        :return: The packed passages and the packing report.
+        """
+        packed, report = self.context_packer.pack(contexts)
+        if report.tokens_saved:
+            print(f"Context packing kept {report.passages_out}/{report.passages_in} passages, "
+                  f"saved {report.tokens_saved} of {report.tokens_in} tokens.")
+        return packed, report
 
     def stream_complete(
         self,
         prompts: str,
         history: Optional[List[dict]] = None,
+        pipeline: bool = True,
         **kwargs: Any
     ) -> CompletionResponseGen:
         """
@@ -198,27 +618,195 @@ class Rag:
 
         :param prompt: The input text prompt.
         :param history: Optional history of previous interactions.
-        :yield: Partial CompletionResponses as text is generated.
+        :param pipeline: If True, run the stages as a StreamingRagPipeline so that retrieval starts
+                         while sub-queries are still being written. The last response carries the
+                         per-stage timings. If False, run the stages one after the other and
+                         stream only the generation.
+        :param location: (latitude, longitude), optional. Only use passages about places near it.
+                         Runs the stages one after the other.
+        :yield: Partial CompletionResponses carrying only the delta. The last response has an
+                empty delta and the full text, or is an `error_response` if a stage failed.
+        """
+        # The pipeline retrieves as sub-queries arrive and cannot filter by location
+        if pipeline and kwargs.get("location") is None:
+            yield from self._stream_pipeline(prompts, history=history, reranker=kwargs.get("reranker"))
+            return
+
+        query = prompts if isinstance(prompts, str) else prompts[0]
+        use_cache = self.semantic_cache is not None and not history and kwargs.get("location") is None
+        namespace = self.cache_namespace(kwargs.get("reranker", self.reranker))
+
+        cached = self.semantic_cache.lookup(query, namespace=namespace) if use_cache else None
+        if cached is not None:
+            yield CompletionResponse(text=cached, delta=cached)
+            return
+
+        parts: List[str] = []
+        try:
+            original_prompt, contexts = self.gather_contexts(prompts, **kwargs)
+            generation_prompt = self.build_prompt(contexts=contexts, query=original_prompt, history=history)
+            for response in self.llm.stream_complete(generation_prompt):
+                if is_error(response):
+                    yield response
+                    return
+                if response.delta:
+                    parts.append(response.delta)
+                    yield CompletionResponse(text="", delta=response.delta)
+        except Exception as e:
+            yield error_response(e)
+            return
+
+        text = "".join(parts)
+        yield CompletionResponse(text=text, delta="")
+        if use_cache and text:
+            self.semantic_cache.store(query, text, namespace=namespace)
+
+    async def astream_complete(
+        self,
+        prompts: str,
+        history: Optional[List[dict]] = None,
+        pipeline: bool = True,
+        **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        """
+        Async version of `stream_complete`, every call on the upstream limiter.
+
+        :param prompts: str. The input text prompt.
+        :param history: Optional history of previous interactions.
+        :param pipeline: If True, run the stages overlapped with `StreamingRagPipeline.astream`.
+                         If False, run them one after the other as in `acomplete` and stream
+                         only the generation.
+        :param reranker: str or BaseReranker, optional. Overrides the instance's reranker for this request.
+        :param location: (latitude, longitude), optional. Only use passages about places near it.
+                         Runs the stages one after the other.
+        :yield: Partial CompletionResponses carrying only the delta. The last response has an
+                empty delta and the full text, or is an `error_response` if a stage failed.
         """
+        if pipeline and kwargs.get("location") is None:
+            async for response in self._astream_pipeline(prompts, history=history, reranker=kwargs.get("reranker")):
+                yield response
+            return
+
+        limiter = get_limiter()
+        query = prompts if isinstance(prompts, str) else prompts[0]
+        use_cache = self.semantic_cache is not None and not history and kwargs.get("location") is None
+        namespace = self.cache_namespace(kwargs.get("reranker", self.reranker))
+
+        cached = await limiter.run("embed", self.semantic_cache.lookup, query, namespace=namespace) if use_cache else None
+        if cached is not None:
+            yield CompletionResponse(text=cached, delta=cached)
+            return
+
+        parts: List[str] = []
+        try:
+            original_prompt, contexts = await self.agather_contexts(prompts, **kwargs)
+            generation_prompt = self.build_prompt(contexts=contexts, query=original_prompt, history=history)
+            responses = await self.llm.astream_complete(generation_prompt)
+            try:
+                async for response in responses:
+                    if is_error(response):
+                        yield response
+                        return
+                    if response.delta:
+                        parts.append(response.delta)
+                        yield CompletionResponse(text="", delta=response.delta)
+            finally:
+                # Returns the LLM's pooled session when the client goes away mid-stream
+                await responses.aclose()
+        except Exception as e:
+            yield error_response(e)
+            return
+
+        text = "".join(parts)
+        yield CompletionResponse(text=text, delta="")
+        if use_cache and text:
+            await limiter.run("embed", self.semantic_cache.store, query, text, namespace=namespace)
+
+    def _stream_pipeline(
+        self,
+        prompts: Union[str, List[str]],
+        history: Optional[List[dict]] = None,
+        reranker: Optional[Union[str, BaseReranker]] = None
+    ) -> CompletionResponseGen:
+        query = prompts if isinstance(prompts, str) else prompts[0]
+        reranker = self.reranker if reranker is None else reranker
+        use_cache = self.semantic_cache is not None and not history
+        namespace = self.cache_namespace(reranker)
+
+        cached = self.semantic_cache.lookup(query, namespace=namespace) if use_cache else None
+        if cached is not None:
+            yield CompletionResponse(text=cached, delta=cached)
+            return
+
+        pipeline = StreamingRagPipeline(
+            self,
+            min_contexts=self.stream_min_contexts,
+            max_workers=self.max_concurrent_retrievals,
+            reranker=reranker
+        )
+        text = ""
+        try:
+            for response in pipeline.stream(query, history=history):
+                if is_error(response):
+                    yield response
+                    return
+                text = response.text
+                yield response
+        except Exception as e:
+            yield error_response(e)
+            return
+
+        if use_cache and text:
+            self.semantic_cache.store(query, text, namespace=namespace)
+
+    async def _astream_pipeline(
+        self,
+        prompts: Union[str, List[str]],
+        history: Optional[List[dict]] = None,
+        reranker: Optional[Union[str, BaseReranker]] = None
+    ) -> CompletionResponseAsyncGen:
+        limiter = get_limiter()
+        query = prompts if isinstance(prompts, str) else prompts[0]
+        reranker = self.reranker if reranker is None else reranker
+        use_cache = self.semantic_cache is not None and not history
+        namespace = self.cache_namespace(reranker)
+
+        cached = await limiter.run("embed", self.semantic_cache.lookup, query, namespace=namespace) if use_cache else None
+        if cached is not None:
+            yield CompletionResponse(text=cached, delta=cached)
+            return
+
+        pipeline = StreamingRagPipeline(
+            self,
+            min_contexts=self.stream_min_contexts,
+            max_workers=self.max_concurrent_retrievals,
+            reranker=reranker
+        )
+        text = ""
+        responses = pipeline.astream(query, history=history)
         try:
-            full_response = self.complete(prompts=prompts, history=history)
+            async for response in responses:
+                if is_error(response):
+                    yield response
+                    return
+                text = response.text
+                yield response
         except Exception as e:
-            yield CompletionResponse(text="", delta=f"Error: {e}")
+            yield error_response(e)
             return
+        finally:
+            await responses.aclose()
 
-        accumulated_text = ""
-        for r in full_response:
-            accumulated_text += r
-            yield CompletionResponse(text=accumulated_text, delta=r)
+        if use_cache and text:
+            await limiter.run("embed", self.semantic_cache.store, query, text, namespace=namespace)
 
 if __name__ == "__main__":
     rag = Rag(
-        llm=llm
+        llm=get_llm()
     )
     
     response = rag.complete("Where should I eat in Hanoi?")
     print(response)
 
-    if snowpark_session:
-        # Close the Snowflake session
-        snowpark_session.close()
+    # Close the pooled Snowflake sessions
+    get_session_pool().close()
@@ -0,0 +1,321 @@
+import atexit
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# How a query is answered: without retrieval, by searching the query itself,
+# or by searching the MultiStep/HyDE transformed sub-queries
+ROUTES = ("direct", "retrieve", "transform")
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "router_fixture.jsonl")
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def featurize(text: str) -> List[str]:
+    """
+    Unigrams, bigrams and a coarse length bucket of a query.
+
+    Stopwords are kept on purpose: "how", "and" or "which" are what separate
+    a small-talk question from a trip-planning one.
+    """
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    features.append(f"__len_{min(len(tokens) // 5, 4)}")
+    return features
+
+
+@dataclass
+class RouteDecision:
+    route: str
+    confidence: float
+    source: str = "local"
+
+
+class QueryRouter:
+    """
+    Local classifier that decides how a query should be answered.
+
+    Queries are turned into TF-IDF vectors over word uni- and bigrams and scored
+    by a multinomial logistic regression trained with NumPy, so routing takes
+    microseconds instead of an LLM round trip. Decisions below `threshold`
+    confidence are left to the caller's LLM fallback, whose answers can be logged
+    to `log_path` and fed back into `fit`.
+
+    Skipping retrieval is the costly mistake, since the answer then has no travel
+    data at all, so a "direct" route is only taken at `direct_threshold` confidence;
+    below it the query is retrieved as the baseline pipeline did.
+
+    :param threshold: float, default 0.55. Minimum probability of the best route to trust it.
+    :param direct_threshold: float, default 0.8. Minimum probability of "direct" to skip retrieval.
+    :param l2: float, default 1e-3. L2 regularization strength.
+    :param epochs: int, default 300. Gradient descent steps.
+    :param learning_rate: float, default 1.0. Gradient descent step size.
+    :param log_path: str, default None. JSONL file routed queries are appended to.
+    """
+
+    def __init__(self,
+                 threshold: float = 0.55,
+                 direct_threshold: float = 0.8,
+                 l2: float = 1e-3,
+                 epochs: int = 300,
+                 learning_rate: float = 1.0,
+                 log_path: Optional[str] = None):
+        self.threshold = threshold
+        self.direct_threshold = direct_threshold
+        self.l2 = l2
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.log_path = log_path
+        self._vocabulary: Dict[str, int] = {}
+        self._idf: Optional[np.ndarray] = None
+        self._weights: Optional[np.ndarray] = None
+        self._bias: Optional[np.ndarray] = None
+        self._log_queue: "queue.Queue[dict]" = queue.Queue()
+        self._log_writer: Optional[threading.Thread] = None
+        self._log_lock = threading.Lock()
+
+    @property
+    def is_fitted(self) -> bool:
+        return self._weights is not None
+
+    def _vectorize(self, queries: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(queries), len(self._vocabulary)), dtype=np.float32)
+        for row, query in enumerate(queries):
+            for feature, count in Counter(featurize(query)).items():
+                column = self._vocabulary.get(feature)
+                if column is not None:
+                    matrix[row, column] = 1.0 + np.log(count)
+        matrix *= self._idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def fit(self, queries: List[str], routes: List[str]) -> "QueryRouter":
+        """
+        Train the classifier.
+
+        :param queries: The example queries.
+        :param routes: Their routes, each one of `ROUTES`.
+        :return: self
+        """
+        unknown = set(routes) - set(ROUTES)
+        if unknown:
+            raise ValueError(f"Unknown routes: {unknown}. Choose from {ROUTES}.")
+
+        document_frequency = Counter(feature for query in queries for feature in set(featurize(query)))
+        self._vocabulary = {feature: i for i, feature in enumerate(sorted(document_frequency))}
+        counts = np.array([document_frequency[f] for f in sorted(document_frequency)], dtype=np.float32)
+        self._idf = np.log((1 + len(queries)) / (1 + counts)) + 1.0
+
+        features = self._vectorize(queries)
+        targets = np.zeros((len(queries), len(ROUTES)), dtype=np.float32)
+        targets[np.arange(len(queries)), [ROUTES.index(r) for r in routes]] = 1.0
+
+        weights = np.zeros((features.shape[1], len(ROUTES)), dtype=np.float32)
+        bias = np.zeros(len(ROUTES), dtype=np.float32)
+        for _ in range(self.epochs):
+            error = (self._softmax(features @ weights + bias) - targets) / len(queries)
+            weights -= self.learning_rate * (features.T @ error + self.l2 * weights)
+            bias -= self.learning_rate * error.sum(axis=0)
+        self._weights, self._bias = weights, bias
+        return self
+
+    @staticmethod
+    def _softmax(logits: np.ndarray) -> np.ndarray:
+        logits = logits - logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict_proba(self, queries: List[str]) -> np.ndarray:
+        """
+        :return: A (len(queries), len(ROUTES)) array of route probabilities.
+        """
+        if not self.is_fitted:
+            raise RuntimeError("QueryRouter must be fitted before routing.")
+        return self._softmax(self._vectorize(queries) @ self._weights + self._bias)
+
+    def classify(self, query: str) -> RouteDecision:
+        """
+        Route one query with the local model.
+
+        :param query: The user query.
+        :return: The most likely route and its probability.
+        """
+        if not self.is_fitted:
+            raise RuntimeError("QueryRouter must be fitted before routing.")
+        # Sparse dot product over the query's own features, no dense vector needed
+        columns, values = [], []
+        for feature, count in Counter(featurize(query)).items():
+            column = self._vocabulary.get(feature)
+            if column is not None:
+                columns.append(column)
+                values.append((1.0 + np.log(count)) * self._idf[column])
+        logits = self._bias.copy()
+        if columns:
+            values = np.asarray(values, dtype=np.float32)
+            logits += (values / np.linalg.norm(values)) @ self._weights[columns]
+        probabilities = self._softmax(logits[None, :])[0]
+        best = int(probabilities.argmax())
+        if len(columns) <= 1:
+            # Nothing but the length bucket is known, leave the decision to the fallback
+            return RouteDecision(route=ROUTES[best], confidence=0.0)
+        return RouteDecision(route=ROUTES[best], confidence=float(probabilities[best]))
+
+    def is_confident(self, decision: RouteDecision) -> bool:
+        return decision.confidence >= self.threshold
+
+    def finalize(self, decision: RouteDecision) -> str:
+        """
+        The route to take for a decision: "retrieve" instead of a "direct" that is
+        below `direct_threshold`, whether the local model or the LLM chose it.
+        """
+        if decision.route == "direct" and decision.confidence < self.direct_threshold:
+            return "retrieve"
+        return decision.route
+
+    def log(self, query: str, decision: RouteDecision) -> None:
+        """
+        Queue a routed query for `log_path`, to retrain the router on real traffic later.
+        A background thread appends the queued records, so routing never waits on the disk.
+        """
+        if self.log_path is None:
+            return
+        record = {"query": query, "route": decision.route, "confidence": round(decision.confidence, 4),
+                  "source": decision.source, "timestamp": time.time()}
+        if self._log_writer is None:
+            with self._log_lock:
+                if self._log_writer is None:
+                    self._log_writer = threading.Thread(target=self._write_log, name="router-log", daemon=True)
+                    self._log_writer.start()
+                    atexit.register(self.flush)
+        self._log_queue.put(record)
+
+    def _write_log(self) -> None:
+        while True:
+            records = [self._log_queue.get()]
+            while True:
+                try:
+                    records.append(self._log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            except OSError as e:
+                print(f"Error writing the router log: {e}")
+            finally:
+                for _ in records:
+                    self._log_queue.task_done()
+
+    def flush(self) -> None:
+        """
+        Wait until every queued record is written to `log_path`.
+        """
+        if self._log_writer is not None:
+            self._log_queue.join()
+
+
+def load_examples(paths: Iterable[str], sources: Optional[Tuple[str, ...]] = None) -> Tuple[List[str], List[str]]:
+    """
+    Read labeled queries from JSONL files of {"query", "route"} records.
+
+    :param paths: The fixture and query log files. Missing files are skipped.
+    :param sources: If given, only log records decided by one of these sources are used,
+                    e.g. ("llm",) to learn only from the fallback's answers.
+    :return: The queries and their routes.
+    """
+    queries, routes = [], []
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if sources is not None and "source" in record and record["source"] not in sources:
+                    continue
+                queries.append(record["query"])
+                routes.append(record["route"])
+    return queries, routes
+
+
+_default_router: Optional[QueryRouter] = None
+_default_router_lock = threading.Lock()
+
+
+def get_router() -> QueryRouter:
+    """
+    Return the process-wide router, trained on first use from the labeled fixture
+    and the LLM-decided queries of ROUTER_LOG_PATH.
+
+    ROUTER_THRESHOLD sets the confidence below which the LLM decides; a value above 1
+    sends every query to the LLM. ROUTER_DIRECT_THRESHOLD sets the confidence needed
+    to skip retrieval; a value above 1 always retrieves.
+
+    :return: The shared QueryRouter.
+    """
+    global _default_router
+    if _default_router is None:
+        with _default_router_lock:
+            if _default_router is None:
+                log_path = os.getenv("ROUTER_LOG_PATH")
+                router = QueryRouter(
+                    threshold=float(os.getenv("ROUTER_THRESHOLD", 0.55)),
+                    direct_threshold=float(os.getenv("ROUTER_DIRECT_THRESHOLD", 0.8)),
+                    log_path=log_path
+                )
+                fixture_queries, fixture_routes = load_examples([DEFAULT_FIXTURE])
+                logged_queries, logged_routes = load_examples([log_path], sources=("llm",))
+                _default_router = router.fit(fixture_queries + logged_queries, fixture_routes + logged_routes)
+    return _default_router
+
+
+if __name__ == "__main__":
+    queries, routes = load_examples([DEFAULT_FIXTURE])
+    folds = 5
+    order = np.random.default_rng(0).permutation(len(queries))
+
+    # k-fold accuracy on the labeled fixture
+    correct, confident, confident_correct = 0, 0, 0
+    direct_taken, direct_wrong = 0, 0
+    confusion = np.zeros((len(ROUTES), len(ROUTES)), dtype=int)
+    for fold in range(folds):
+        test = set(order[fold::folds].tolist())
+        router = QueryRouter().fit(
+            [q for i, q in enumerate(queries) if i not in test],
+            [r for i, r in enumerate(routes) if i not in test]
+        )
+        for i in test:
+            decision = router.classify(queries[i])
+            confusion[ROUTES.index(routes[i]), ROUTES.index(decision.route)] += 1
+            correct += decision.route == routes[i]
+            if router.is_confident(decision):
+                confident += 1
+                confident_correct += decision.route == routes[i]
+            if router.finalize(decision) == "direct":
+                direct_taken += 1
+                direct_wrong += routes[i] != "direct"
+
+    print(f"{folds}-fold accuracy: {correct / len(queries):.1%} on {len(queries)} queries")
+    print(f"Confident decisions: {confident / len(queries):.1%} of queries, {confident_correct / max(confident, 1):.1%} correct "
+          f"(the rest go to the LLM)")
+    print(f"Retrieval skipped for {direct_taken} of {routes.count('direct')} direct queries, "
+          f"{direct_wrong} of them wrongly (the rest are retrieved)")
+    print("Confusion (rows = label, columns = prediction):", ROUTES)
+    print(confusion)
+
+    router = QueryRouter().fit(queries, routes)
+    runs = 2000
+    start = time.perf_counter()
+    for i in range(runs):
+        router.classify(queries[i % len(queries)])
+    print(f"Routing latency: {(time.perf_counter() - start) / runs * 1e6:,.1f} us/query")
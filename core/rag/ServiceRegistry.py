@@ -0,0 +1,125 @@
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from snowflake.snowpark.session import Session
+from core.connection.SessionPool import register_discard_listener
+
+
+class CortexSearchRegistry:
+    """
+    Process-wide registry of resolved Cortex Search service handles.
+
+    Building a `Root` refreshes account parameters over the network, so each
+    (session, database, schema, service) handle is resolved once and then shared
+    by every thread and every `Rag` instance in the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles: Dict[Tuple[int, str, str, str], Tuple[Session, Any]] = {}
+
+    def get(self,
+            session: Session,
+            database: str,
+            schema: str,
+            service: str) -> Any:
+        """
+        Return the Cortex Search service handle, resolving it on first use.
+
+        :param session: The Snowpark session the handle is bound to.
+        :param database: The database containing the service.
+        :param schema: The schema containing the service.
+        :param service: The Cortex Search service name.
+        :return: The resolved cortex search service handle.
+        """
+        key = (id(session), database, schema, service)
+        entry = self._handles.get(key)
+        if entry is not None and entry[0] is session:
+            return entry[1]
+
+        with self._lock:
+            # Another thread may have resolved it while we waited
+            entry = self._handles.get(key)
+            if entry is not None and entry[0] is session:
+                return entry[1]
+
+            handle = self._resolve(session, database, schema, service)
+            self._handles[key] = (session, handle)
+            return handle
+
+    def refresh(self,
+                session: Session,
+                database: str,
+                schema: str,
+                service: str) -> Any:
+        """
+        Drop the cached handle and resolve it again, e.g. after the session expired.
+
+        :return: The freshly resolved handle.
+        """
+        with self._lock:
+            self._handles.pop((id(session), database, schema, service), None)
+        return self.get(session, database, schema, service)
+
+    def invalidate(self, session: Optional[Session] = None) -> None:
+        """
+        Forget cached handles.
+
+        :param session: Only forget handles bound to this session. If None, forget all of them.
+        """
+        with self._lock:
+            if session is None:
+                self._handles.clear()
+                return
+            for key in [k for k, v in self._handles.items() if v[0] is session]:
+                del self._handles[key]
+
+    @staticmethod
+    def _resolve(session: Session, database: str, schema: str, service: str) -> Any:
+        # snowflake.core takes seconds to import, so only pay for it on first resolve
+        from snowflake.core import Root
+
+        root = Root(session)
+        return (
+            root.databases[database]
+            .schemas[schema]
+            .cortex_search_services[service]
+        )
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+
+search_registry = CortexSearchRegistry()
+# Handles bound to a session the pool closed can never be used again
+register_discard_listener(search_registry.invalidate)
+
+
+if __name__ == "__main__":
+    import os
+    from core.connection.SessionPool import get_session_pool
+
+    pool = get_session_pool()
+    session = pool.checkout()
+    params = pool.connection_params
+    target = (params["database"], params["schema"], os.environ["SNOWFLAKE_CORTEX_SEARCH_SERVICE"])
+
+    # Per-request setup cost before and after the registry
+    n = 20
+    start = time.perf_counter()
+    for _ in range(n):
+        CortexSearchRegistry._resolve(session, *target)
+    uncached = (time.perf_counter() - start) / n
+
+    search_registry.get(session, *target)
+    start = time.perf_counter()
+    for _ in range(n):
+        search_registry.get(session, *target)
+    cached = (time.perf_counter() - start) / n
+
+    print(f"Root + handle per request: {uncached * 1000:.2f} ms")
+    print(f"Registry lookup per request: {cached * 1000:.4f} ms")
+    print(f"Setup time removed per request: {(uncached - cached) * 1000:.2f} ms")
+    pool.checkin(session)
+    pool.close()
@@ -0,0 +1,52 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+from core.preprocessing.rerank.BM25 import BM25Scorer
+from core.retrieval.BaseRetriever import BaseRetriever
+
+
+class BM25Retriever(BaseRetriever):
+    """
+    Lexical retrieval over an in-memory BM25 inverted index of the passages.
+
+    :param passages: The passages to index, e.g. the INFORMATION column.
+    :param limit: int, default 4. The number of passages to return per query.
+    :param k1: float, default 1.5. BM25 term frequency saturation.
+    :param b: float, default 0.75. BM25 document length normalization.
+    """
+
+    upstream = "local_search"
+
+    def __init__(self, passages: Sequence[str], limit: int = 4, k1: float = 1.5, b: float = 0.75):
+        self.passages = list(passages)
+        self.limit = limit
+        self.scorer = BM25Scorer(k1=k1, b=b).fit(self.passages)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Dict[str, str]], column: str = "INFORMATION", **kwargs) -> "BM25Retriever":
+        """
+        Index one column of the NAME/INFORMATION rows.
+        """
+        return cls([row[column] for row in rows], **kwargs)
+
+    @classmethod
+    def from_snowflake(cls,
+                       table: str,
+                       column: str = "INFORMATION",
+                       session_pool: Optional[Any] = None,
+                       **kwargs) -> "BM25Retriever":
+        """
+        Index one column of a Snowflake table, read once into memory.
+
+        :param table: The fully qualified table name the Cortex Search service is built on.
+        :param column: The column holding the passage text.
+        :param session_pool: SessionPool, default None. The process-wide pool if None.
+        """
+        from core.connection.SessionPool import get_session_pool
+
+        pool = session_pool or get_session_pool()
+        with pool.session() as session:
+            passages = [row[0] for row in session.table(table).select(column).collect()]
+        return cls(passages, **kwargs)
+
+    def retrieve(self, query: str, limit: Optional[int] = None) -> List[str]:
+        return [self.passages[i] for i, _ in self.scorer.top_k(query, k=limit or self.limit)]
@@ -0,0 +1,37 @@
+from typing import List, Optional
+
+
+class BaseRetriever:
+    """
+    Interface shared by the retrieval backends.
+
+    Subclasses implement `retrieve`. Backends that can search several queries in
+    one call (e.g. a local vector index) also override `retrieve_batch`.
+
+    :attr upstream: Name of the UpstreamLimiter pool async callers run searches on.
+    :attr vectorized: Whether `retrieve_batch` searches every query in one call, so that
+                      callers should not split a batch into concurrent single searches.
+    """
+
+    upstream = "search"
+    vectorized = False
+
+    def retrieve(self, query: str, limit: Optional[int] = None) -> List[str]:
+        """
+        Search for the passages relevant to a query.
+
+        :param query: The query text.
+        :param limit: The number of passages to return. Defaults to the retriever's own limit.
+        :return: The passages, most relevant first.
+        """
+        raise NotImplementedError
+
+    def retrieve_batch(self, queries: List[str], limit: Optional[int] = None) -> List[List[str]]:
+        """
+        Search for several queries.
+
+        :param queries: The query texts.
+        :param limit: The number of passages to return per query.
+        :return: One list of passages per query, in the same order as `queries`.
+        """
+        return [self.retrieve(query, limit=limit) for query in queries]
@@ -0,0 +1,184 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+
+from snowflake.snowpark.session import Session
+
+from core.connection.SessionPool import (
+    SessionPool,
+    connection_params_from_env,
+    get_session_pool,
+    is_session_expired,
+)
+from core.rag.ServiceRegistry import search_registry
+from core.retrieval.BaseRetriever import BaseRetriever
+
+
+def search_params_from_env() -> Dict[str, str]:
+    """
+    Read the Cortex Search location (database, schema, service) from the environment.
+
+    :return: The connection parameters plus the `service` name.
+    """
+    params = dict(connection_params_from_env())
+    params["service"] = os.environ["SNOWFLAKE_CORTEX_SEARCH_SERVICE"]
+    return params
+
+
+class CortexSearchRetriever(BaseRetriever):
+    """
+    Retrieves passages from a Snowflake Cortex Search service.
+
+    :param session_pool: SessionPool, default None. The pool searches check sessions out of.
+                         If None, the process-wide pool is used.
+    :param snowpark_session: Session, default None. Pin every search to this session instead of the pool.
+    :param limit: int, default 4. The number of passages to return per query.
+    :param snowflake_params: dict, default None. The database, schema and service to search.
+                             If None, they are read from the environment on first search.
+    :param search_columns: The columns the service returns.
+    :param retrieve_column: The column holding the passage text.
+    :param max_concurrent: int, default 4. Maximum number of searches in flight in `retrieve_batch`.
+    :param timeout: float, default 30. Seconds after which a search in `retrieve_batch` is given up.
+    """
+
+    upstream = "cortex_search"
+
+    def __init__(self,
+                 session_pool: Optional[SessionPool] = None,
+                 snowpark_session: Optional[Session] = None,
+                 limit: int = 4,
+                 snowflake_params: Optional[Dict[str, str]] = None,
+                 search_columns: List[str] = ["NAME", "INFORMATION"],
+                 retrieve_column: str = "INFORMATION",
+                 max_concurrent: int = 4,
+                 timeout: Optional[float] = 30.0):
+        self._session_pool = session_pool
+        self._snowpark_session = snowpark_session
+        self.limit = limit
+        self._snowflake_params = snowflake_params
+        self.search_columns = search_columns
+        self.retrieve_column = retrieve_column
+        self.max_concurrent = max(1, max_concurrent)
+        self.timeout = timeout
+
+    @property
+    def snowflake_params(self) -> Dict[str, str]:
+        if self._snowflake_params is None:
+            self._snowflake_params = search_params_from_env()
+        return self._snowflake_params
+
+    def _search_target(self) -> Tuple[str, str, str]:
+        return (
+            self.snowflake_params.get("database"),
+            self.snowflake_params.get("schema"),
+            self.snowflake_params.get("service"),
+        )
+
+    @property
+    def session_pool(self) -> SessionPool:
+        return self._session_pool or get_session_pool()
+
+    def retrieve(self, query: str, limit: Optional[int] = None) -> List[str]:
+        if self._snowpark_session is not None:
+            return self._search(self._snowpark_session, query, limit or self.limit)
+
+        with self.session_pool.session() as session:
+            return self._search(session, query, limit or self.limit)
+
+    def _search(self, session: Session, query: str, limit: int) -> List[str]:
+        cortex_search_service = search_registry.get(session, *self._search_target())
+        try:
+            resp = cortex_search_service.search(
+                query=query,
+                columns=self.search_columns,
+                limit=limit,
+            )
+        except Exception as e:
+            if not is_session_expired(e):
+                raise
+            # The cached handle is bound to an expired token, resolve it again and retry once
+            cortex_search_service = search_registry.refresh(session, *self._search_target())
+            resp = cortex_search_service.search(
+                query=query,
+                columns=self.search_columns,
+                limit=limit,
+            )
+
+        if resp.results:
+            return [curr[self.retrieve_column] for curr in resp.results]
+        else:
+            return []
+
+    def retrieve_batch(self, queries: List[str], limit: Optional[int] = None) -> List[List[str]]:
+        """
+        Search for several queries concurrently.
+
+        At most `max_concurrent` searches are in flight at once. A query whose search
+        fails or takes longer than `timeout` seconds contributes an empty list.
+        """
+        if not queries:
+            return []
+
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.max_concurrent, len(queries)),
+            thread_name_prefix="rag-retrieve"
+        )
+        try:
+            futures = [executor.submit(self.retrieve, query, limit) for query in queries]
+            results = []
+            for query, future in zip(queries, futures):
+                try:
+                    results.append(future.result(timeout=self.timeout))
+                except FutureTimeoutError:
+                    print(f"Retrieval for '{query}' timed out after {self.timeout}s.")
+                    future.cancel()
+                    results.append([])
+                except Exception as e:
+                    print(f"Error retrieving contexts for '{query}': {e}")
+                    results.append([])
+        finally:
+            # Do not block on searches that already timed out
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results
+
+
+if __name__ == "__main__":
+    import time
+
+    class DelayedSearchRetriever(CortexSearchRetriever):
+        # Stands in for Cortex Search: every search takes `delays[query]` seconds
+        def __init__(self, delays: Dict[str, float], **kwargs):
+            super().__init__(snowpark_session=object(), snowflake_params={}, **kwargs)
+            self.delays = delays
+
+        def _search(self, session: Session, query: str, limit: int) -> List[str]:
+            time.sleep(self.delays[query])
+            return [f"passage about {query}"]
+
+    from core.rag.RAG import Rag
+
+    delays = {"pho in Hanoi": 0.3, "bun cha in Hanoi": 0.2, "egg coffee in Hanoi": 0.25, "banh mi in Hoi An": 0.15}
+    queries = list(delays)
+    rag = Rag(retriever=DelayedSearchRetriever(delays, max_concurrent=4, timeout=1.0))
+
+    start = time.perf_counter()
+    sequential = [rag.retrieve(query) for query in queries]
+    sequential_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    concurrent = rag.retrieve_many(queries)
+    concurrent_time = time.perf_counter() - start
+
+    assert concurrent == sequential, "Fan-out must keep the sub-query order"
+    assert concurrent_time < sequential_time / 2
+    print(f"Sequential: {sequential_time:.2f} s (sum of the delays, {sum(delays.values()):.2f} s)")
+    print(f"Fan-out:    {concurrent_time:.2f} s (slowest search, {max(delays.values()):.2f} s)")
+
+    # A search slower than the timeout contributes no contexts instead of failing the request
+    delays["pho in Hanoi"] = 2.0
+    rag = Rag(retriever=DelayedSearchRetriever(delays, max_concurrent=4, timeout=0.5))
+    start = time.perf_counter()
+    results = rag.retrieve_many(queries)
+    assert results[0] == [] and all(results[1:])
+    print(f"With a 2 s search and a 0.5 s timeout: {time.perf_counter() - start:.2f} s, results {[len(r) for r in results]}")
@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+from core.retrieval.BaseRetriever import BaseRetriever
+from core.retrieval.BM25Retriever import BM25Retriever
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]],
+                           k: int = 60,
+                           limit: Optional[int] = None,
+                           weights: Optional[Sequence[float]] = None) -> List[str]:
+    """
+    Merge ranked lists by summing weight / (k + rank) over the lists a passage appears in.
+
+    Passages ranked well by several lists (several retrievers, or several
+    sub-queries) come first; duplicates collapse into one entry.
+
+    :param rankings: The ranked passage lists, best first.
+    :param k: int, default 60. Damping constant, higher values flatten the rank differences.
+    :param limit: int, default None. The number of passages to keep. All if None.
+    :param weights: Sequence[float], default None. One weight per ranking, all 1.0 if None.
+    :return: The fused ranking.
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, passage in enumerate(dict.fromkeys(ranking)):
+            scores[passage] = scores.get(passage, 0.0) + weight / (k + rank + 1)
+    # sorted is stable, so ties keep their first-seen order
+    fused = sorted(scores, key=scores.get, reverse=True)
+    return fused if limit is None else fused[:limit]
+
+
+_lexical_executor: Optional[ThreadPoolExecutor] = None
+_lexical_executor_lock = threading.Lock()
+
+
+def get_lexical_executor() -> ThreadPoolExecutor:
+    """
+    Return the process-wide pool BM25 searches run on next to the dense search,
+    shared by every HybridRetriever instead of one pool per instance.
+    """
+    global _lexical_executor
+    if _lexical_executor is None:
+        with _lexical_executor_lock:
+            if _lexical_executor is None:
+                _lexical_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-retrieve")
+    return _lexical_executor
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Runs a dense retriever (Cortex Search or a local vector index) and a BM25
+    retriever in parallel and fuses their rankings with reciprocal rank fusion.
+
+    Exact names and rare words are found by BM25 even when the embedding misses
+    them, without an extra LLM rerank round trip.
+
+    The dense ranking leads: BM25 is weighted down and a small fusion constant
+    keeps the dense top hits on top unless BM25 agrees with a lower one. With
+    plain RRF (k=60, equal weights) BM25 pushed relevant passages out of the
+    top 3. On the retrieval fixture, with the HashingEmbedder index as the dense
+    side, the defaults give recall@1/3/5 of 88.6/94.7/97.0% against
+    85.6/94.7/97.0% for dense alone, and every k from 5 to 20 with a BM25 weight
+    of 0.2 to 0.3 is at least as good as dense. Cortex embeddings and sentence
+    embedders could not be measured here, so it stays opt-in with RAG_RETRIEVER=hybrid.
+
+    :param dense: The dense BaseRetriever.
+    :param lexical: The BM25Retriever over the same passages.
+    :param limit: int, default 4. The number of passages to return per query.
+    :param candidates: int, default 20. The number of passages fetched from each retriever before fusion.
+    :param k: int, default 10. The reciprocal rank fusion constant.
+    :param lexical_weight: float, default 0.3. The weight of the BM25 ranking, the dense one weighs 1.
+    """
+
+    def __init__(self,
+                 dense: BaseRetriever,
+                 lexical: BM25Retriever,
+                 limit: int = 4,
+                 candidates: int = 20,
+                 k: int = 10,
+                 lexical_weight: float = 0.3):
+        self.dense = dense
+        self.lexical = lexical
+        self.limit = limit
+        self.candidates = max(candidates, limit)
+        self.k = k
+        self.lexical_weight = lexical_weight
+        self.upstream = dense.upstream
+        self.vectorized = dense.vectorized
+
+    def retrieve(self, query: str, limit: Optional[int] = None) -> List[str]:
+        return self.retrieve_batch([query], limit=limit)[0]
+
+    def retrieve_batch(self, queries: List[str], limit: Optional[int] = None) -> List[List[str]]:
+        if not queries:
+            return []
+        # BM25 runs on CPU while the dense search waits on its upstream
+        lexical = get_lexical_executor().submit(self.lexical.retrieve_batch, queries, self.candidates)
+        dense = self.dense.retrieve_batch(queries, limit=self.candidates)
+        return [
+            reciprocal_rank_fusion(
+                [dense_ranking, lexical_ranking], k=self.k, limit=limit or self.limit, weights=[1.0, self.lexical_weight]
+            )
+            for dense_ranking, lexical_ranking in zip(dense, lexical.result())
+        ]
+
+
+if __name__ == "__main__":
+    import json
+    import os
+    import tempfile
+
+    from core.retrieval.LocalVectorRetriever import LocalVectorRetriever
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "retrieval_fixture.json"), encoding="utf-8") as f:
+        fixture = json.load(f)
+    rows = fixture["rows"]
+
+    def recall_at(retriever: BaseRetriever, k: int) -> float:
+        results = retriever.retrieve_batch([case["query"] for case in fixture["queries"]], limit=k)
+        hits = [
+            len({rows[i]["INFORMATION"] for i in case["relevant"]} & set(passages)) / len(case["relevant"])
+            for case, passages in zip(fixture["queries"], results)
+        ]
+        return sum(hits) / len(hits)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The HashingEmbedder is itself word based, so this understates what BM25 adds to Cortex embeddings
+        dense = LocalVectorRetriever.build(rows, directory, n_lists=1)
+        lexical = BM25Retriever.from_rows(rows)
+        hybrid = HybridRetriever(dense, lexical)
+        plain = HybridRetriever(dense, lexical, k=60, lexical_weight=1.0)
+        for k in (1, 3, 5):
+            print(f"recall@{k}: dense {recall_at(dense, k):.1%}, BM25 {recall_at(lexical, k):.1%}, "
+                  f"plain RRF {recall_at(plain, k):.1%}, hybrid {recall_at(hybrid, k):.1%}")
+
+        # How far the defaults sit from the settings that lose recall to dense alone
+        baseline = [recall_at(dense, k) for k in (1, 3, 5)]
+        for fusion_k in (5, 10, 20, 60):
+            cells = []
+            for weight in (0.2, 0.3, 0.4, 0.6, 1.0):
+                recalls = [recall_at(HybridRetriever(dense, lexical, k=fusion_k, lexical_weight=weight), k) for k in (1, 3, 5)]
+                mark = "" if all(r >= b for r, b in zip(recalls, baseline)) else " (worse)"
+                cells.append(f"w={weight}: {'/'.join(f'{r:.1%}' for r in recalls)}{mark}")
+            print(f"k={fusion_k}: " + ", ".join(cells))
@@ -0,0 +1,296 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from core.embedding.Embedder import HashingEmbedder, embedder_from_meta, normalize_rows
+from core.retrieval.BaseRetriever import BaseRetriever
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index over unit-length vectors.
+
+    The vectors are clustered with spherical k-means; a query is only compared
+    with the vectors of its `n_probe` closest clusters. Vectors are stored sorted
+    by cluster, so each cluster is a contiguous slice of the (memory-mapped)
+    embedding matrix.
+
+    :param embeddings: (n, dimension) array of unit-length vectors, sorted by cluster.
+    :param centroids: (n_lists, dimension) array of unit-length cluster centroids.
+    :param offsets: (n_lists + 1,) array, cluster i spans rows offsets[i]:offsets[i + 1].
+    :param ids: (n,) array mapping sorted rows back to the original row ids.
+    """
+
+    def __init__(self, embeddings: np.ndarray, centroids: np.ndarray, offsets: np.ndarray, ids: np.ndarray):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        # Cluster of every sorted row, used to mask candidates per query
+        self._row_lists = np.repeat(np.arange(len(centroids)), np.diff(offsets))
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls,
+              embeddings: np.ndarray,
+              n_lists: Optional[int] = None,
+              iterations: int = 10,
+              seed: int = 0) -> "IVFIndex":
+        """
+        Cluster the vectors and lay them out by cluster.
+
+        :param embeddings: (n, dimension) array of vectors.
+        :param n_lists: int, default None. Number of clusters, about sqrt(n) if None.
+        :param iterations: int, default 10. k-means iterations.
+        :return: The index, holding the embeddings in memory.
+        """
+        embeddings = normalize_rows(embeddings)
+        n = len(embeddings)
+        n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        centroids = embeddings[rng.choice(n, size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = (embeddings @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, embeddings)
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            # Re-seed empty clusters on random vectors
+            sums[empty] = embeddings[rng.choice(n, size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        assignments = (embeddings @ centroids.T).argmax(axis=1)
+
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(embeddings[order], centroids, offsets, order)
+
+    def search(self, queries: np.ndarray, k: int = 4, n_probe: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest vectors of several queries in one vectorized pass.
+
+        The rows of every cluster probed by any query are scored with one matrix
+        product; rows outside a query's own probed clusters are masked out.
+
+        :param queries: (m, dimension) array of unit-length query vectors.
+        :param k: The number of neighbours per query.
+        :param n_probe: The number of clusters searched per query.
+        :return: (m, k) arrays of original row ids and cosine similarities, best first.
+                 Missing neighbours have id -1.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32)
+        n_probe = min(n_probe, self.n_lists)
+        if n_probe < self.n_lists:
+            probed = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probed = np.tile(np.arange(self.n_lists), (len(queries), 1))
+
+        lists = np.unique(probed)
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists]).astype(np.int64)
+        scores = queries @ np.asarray(self.embeddings[rows]).T
+        if n_probe < self.n_lists:
+            probe_mask = np.zeros((len(queries), self.n_lists), dtype=bool)
+            probe_mask[np.arange(len(queries))[:, None], probed] = True
+            scores[~probe_mask[:, self._row_lists[rows]]] = -np.inf
+
+        k = min(k, len(rows))
+        if k <= 0:
+            # The probed clusters hold no rows
+            return np.full((len(queries), 0), -1, dtype=self.ids.dtype), np.zeros((len(queries), 0), dtype=np.float32)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        ids = self.ids[rows[top]]
+        ids[np.isinf(top_scores)] = -1
+        return ids, top_scores
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "embeddings.npy"), np.asarray(self.embeddings, dtype=np.float32))
+        np.save(os.path.join(directory, "centroids.npy"), self.centroids)
+        np.save(os.path.join(directory, "offsets.npy"), self.offsets)
+        np.save(os.path.join(directory, "ids.npy"), self.ids)
+
+    @classmethod
+    def load(cls, directory: str) -> "IVFIndex":
+        """
+        Open a saved index. The embedding matrix is memory-mapped, not read into memory.
+        """
+        return cls(
+            np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r"),
+            np.load(os.path.join(directory, "centroids.npy")),
+            np.load(os.path.join(directory, "offsets.npy")),
+            np.load(os.path.join(directory, "ids.npy")),
+        )
+
+
+class LocalVectorRetriever(BaseRetriever):
+    """
+    Retrieves passages from an on-disk vector index of the NAME/INFORMATION rows,
+    without a warehouse round trip.
+
+    Build the index once with `build` (or `from_snowflake`), then open it with
+    `LocalVectorRetriever(directory)`. The queries must be embedded with the same
+    kind of embedder the index was built with, which is rebuilt from `meta.json`
+    when none is given.
+
+    :param directory: str. The index directory written by `build`.
+    :param embedder: Callable with an `embed_batch` method, default None. If None, the embedder
+                     recorded in the index's `meta.json`.
+    :param limit: int, default 4. The number of passages to return per query.
+    :param n_probe: int, default 8. The number of IVF clusters searched per query.
+    :param retrieve_column: The column returned as the passage text.
+    :param session_pool: SessionPool, default None. The pool a CortexEmbedder built from
+                         `meta.json` embeds queries on. If None, the process-wide pool is used.
+    """
+
+    upstream = "local_search"
+    vectorized = True
+
+    def __init__(self,
+                 directory: str,
+                 embedder: Optional[Any] = None,
+                 limit: int = 4,
+                 n_probe: int = 8,
+                 retrieve_column: str = "INFORMATION",
+                 session_pool: Optional[Any] = None):
+        self.directory = directory
+        self.limit = limit
+        self.n_probe = n_probe
+        self.retrieve_column = retrieve_column
+
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.embedder = embedder or embedder_from_meta(self.meta, session_pool=session_pool)
+        if self.meta["embedder"] != type(self.embedder).__name__:
+            raise ValueError(f"The index at {directory} was built with {self.meta['embedder']}, "
+                             f"not {type(self.embedder).__name__}.")
+        with open(os.path.join(directory, "rows.jsonl"), encoding="utf-8") as f:
+            self.rows: List[Dict[str, str]] = [json.loads(line) for line in f]
+        self.index = IVFIndex.load(directory)
+
+    @staticmethod
+    def row_text(row: Dict[str, str]) -> str:
+        """
+        The text a row is embedded from.
+        """
+        return f"{row.get('NAME', '')}: {row.get('INFORMATION', '')}"
+
+    @classmethod
+    def build(cls,
+              rows: Sequence[Dict[str, str]],
+              directory: str,
+              embedder: Optional[Any] = None,
+              n_lists: Optional[int] = None,
+              batch_size: int = 256,
+              **kwargs) -> "LocalVectorRetriever":
+        """
+        Embed the rows and write the index to `directory`.
+
+        :param rows: dicts with the NAME and INFORMATION columns.
+        :param directory: The index directory.
+        :param embedder: default None. HashingEmbedder if None.
+        :param n_lists: int, default None. Number of IVF clusters, about sqrt(len(rows)) if None.
+        :param batch_size: int, default 256. Rows embedded per `embed_batch` call.
+        :return: The retriever over the new index.
+        """
+        embedder = embedder or HashingEmbedder()
+        texts = [cls.row_text(row) for row in rows]
+        embeddings = np.concatenate([
+            embedder.embed_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)
+        ])
+        IVFIndex.build(embeddings, n_lists=n_lists).save(directory)
+
+        with open(os.path.join(directory, "rows.jsonl"), "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(dict(row), ensure_ascii=False) + "\n")
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            meta = {"embedder": type(embedder).__name__, "dimension": int(embeddings.shape[1]), "rows": len(rows)}
+            if getattr(embedder, "model", None):
+                meta["model"] = embedder.model
+            json.dump(meta, f)
+        return cls(directory, embedder=embedder, **kwargs)
+
+    @classmethod
+    def from_snowflake(cls,
+                       table: str,
+                       directory: str,
+                       embedder: Optional[Any] = None,
+                       session_pool: Optional[Any] = None,
+                       **kwargs) -> "LocalVectorRetriever":
+        """
+        Build the index from the NAME/INFORMATION columns of a Snowflake table.
+
+        :param table: The fully qualified table name the Cortex Search service is built on.
+        :param directory: The index directory.
+        """
+        from core.connection.SessionPool import get_session_pool
+
+        pool = session_pool or get_session_pool()
+        with pool.session() as session:
+            rows = [row.as_dict() for row in session.table(table).select("NAME", "INFORMATION").collect()]
+        return cls.build(rows, directory, embedder=embedder, **kwargs)
+
+    def search(self, queries: List[str], limit: Optional[int] = None) -> List[List[Tuple[Dict[str, str], float]]]:
+        """
+        Search for several queries in one vectorized call.
+
+        :return: One list of (row, cosine similarity) pairs per query, best first.
+        """
+        if not queries:
+            return []
+        ids, scores = self.index.search(self.embedder.embed_batch(queries), k=limit or self.limit, n_probe=self.n_probe)
+        return [
+            [(self.rows[i], float(score)) for i, score in zip(row_ids, row_scores) if i >= 0]
+            for row_ids, row_scores in zip(ids, scores)
+        ]
+
+    def retrieve(self, query: str, limit: Optional[int] = None) -> List[str]:
+        return self.retrieve_batch([query], limit=limit)[0]
+
+    def retrieve_batch(self, queries: List[str], limit: Optional[int] = None) -> List[List[str]]:
+        return [[row[self.retrieve_column] for row, _ in hits] for hits in self.search(queries, limit=limit)]
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    # Synthetic corpus the size of a country-wide POI table
+    rng = np.random.default_rng(0)
+    places = ["Hanoi", "Hue", "Hoi An", "Da Nang", "Da Lat", "Sapa", "Ha Long", "Nha Trang", "Can Tho", "Saigon"]
+    topics = ["street food", "pagoda", "museum", "market", "beach", "trekking", "night life", "coffee", "boat tour", "hotel"]
+    rows = [
+        {"NAME": f"{places[i % 10]} {topics[(i // 10) % 10]} #{i}",
+         "INFORMATION": f"A {topics[(i // 10) % 10]} spot in {places[i % 10]}, entry {i}, rated {rng.integers(1, 6)} stars."}
+        for i in range(20000)
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        retriever = LocalVectorRetriever.build(rows, directory)
+        print(f"Built an index of {len(rows):,} rows in {time.perf_counter() - start:.1f}s")
+
+        queries = ["street food in Hanoi", "pagoda in Hue", "beach near Nha Trang", "coffee in Da Lat"]
+        retriever.retrieve_batch(queries)
+        runs = 50
+        start = time.perf_counter()
+        for _ in range(runs):
+            results = retriever.retrieve_batch(queries)
+        batched = (time.perf_counter() - start) / runs
+        print(f"Batched search of {len(queries)} queries: {batched * 1000:.2f} ms")
+        for query, passages in zip(queries, results):
+            print(f"  {query} -> {passages[0]}")
+
+        # Recall of the IVF search against exact search on the same embeddings
+        exact = LocalVectorRetriever(directory, n_probe=retriever.index.n_lists)
+        sample = [rows[i]["NAME"] for i in rng.choice(len(rows), 200, replace=False)]
+        approximate_ids, _ = retriever.index.search(retriever.embedder.embed_batch(sample), k=10, n_probe=8)
+        exact_ids, _ = exact.index.search(exact.embedder.embed_batch(sample), k=10, n_probe=exact.index.n_lists)
+        recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approximate_ids, exact_ids)])
+        print(f"IVF recall@10 vs exact search: {recall:.1%}")
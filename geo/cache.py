@@ -0,0 +1,467 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+Coordinates = Tuple[float, float]
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalize an address so trivially different spellings share a cache key.
+
+    :param address: The raw address or landmark name.
+    :return: The case-folded address with collapsed whitespace and punctuation.
+    """
+    address = unicodedata.normalize("NFC", address).casefold()
+    address = re.sub(r"[\s,;.]+", " ", address)
+    return address.strip()
+
+
+def nominatim_geocoder(user_agent: str = "route_planner", timeout: float = 10) -> Callable[[str], Optional[Coordinates]]:
+    """
+    Geocode addresses with one shared Nominatim client.
+
+    :param user_agent: str, default "route_planner". The user agent Nominatim requires.
+    :param timeout: float, default 10. Seconds before a lookup fails.
+    :return: A function returning the coordinates of an address, or None if it is unknown.
+    """
+    from geopy.geocoders import Nominatim
+
+    geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def geocode(address: str) -> Optional[Coordinates]:
+        location = geolocator.geocode(address)
+        if location is None:
+            return None
+        print(f"Destination location: {location.address}")
+        return (location.latitude, location.longitude)
+
+    return geocode
+
+
+class GeocodeCache:
+    """
+    Cache of geocoded addresses in front of a rate-limited geocoder.
+
+    Keys are normalized addresses. Results live in an in-memory LRU of at most
+    `max_entries` items, optionally backed by a SQLite file that is read through
+    on a memory miss. Addresses the geocoder does not know are cached too, for
+    the shorter `negative_ttl`. Concurrent lookups of the same address wait for
+    one upstream call, and upstream calls are spaced by `min_interval` seconds
+    (Nominatim allows about one request per second).
+
+    :param geocoder: Callable returning the coordinates of an address or None, default None. Nominatim if None.
+    :param max_entries: int, default 4096. Maximum number of addresses kept in memory.
+    :param ttl: float, default 30 days. Seconds a found address stays valid. None disables expiry.
+    :param negative_ttl: float, default 3600. Seconds an unknown address stays cached.
+    :param path: str, default None. SQLite file for persistence. In-memory only if None.
+    :param min_interval: float, default 1.0. Minimum seconds between two upstream calls.
+    """
+
+    def __init__(self,
+                 geocoder: Optional[Callable[[str], Optional[Coordinates]]] = None,
+                 max_entries: int = 4096,
+                 ttl: Optional[float] = 30 * 24 * 3600.0,
+                 negative_ttl: float = 3600.0,
+                 path: Optional[str] = None,
+                 min_interval: float = 1.0):
+        self._geocoder = geocoder
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self.min_interval = min_interval
+        self.stats: Dict[str, int] = {"hits": 0, "negative_hits": 0, "misses": 0, "coalesced": 0, "upstream_calls": 0}
+        self._lock = threading.Lock()
+        self._upstream_lock = threading.Lock()
+        self._last_call = 0.0
+        # key -> (coordinates or None, created_at)
+        self._entries: "OrderedDict[str, Tuple[Optional[Coordinates], float]]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocode_cache (key TEXT PRIMARY KEY, latitude REAL, longitude REAL, created_at REAL)"
+            )
+            self._conn.commit()
+
+    @property
+    def geocoder(self) -> Callable[[str], Optional[Coordinates]]:
+        if self._geocoder is None:
+            self._geocoder = nominatim_geocoder()
+        return self._geocoder
+
+    def _is_expired(self, coordinates: Optional[Coordinates], created_at: float) -> bool:
+        ttl = self.negative_ttl if coordinates is None else self.ttl
+        return ttl is not None and time.time() - created_at > ttl
+
+    def _get(self, key: str) -> Optional[Tuple[Optional[Coordinates], float]]:
+        # Caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None and self._conn is not None:
+            row = self._conn.execute(
+                "SELECT latitude, longitude, created_at FROM geocode_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                entry = (None if row[0] is None else (row[0], row[1]), row[2])
+        if entry is None or self._is_expired(*entry):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key: str, entry: Tuple[Optional[Coordinates], float]) -> None:
+        # Caller holds the lock. The SQLite copy is only bounded by the TTL.
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _put(self, key: str, coordinates: Optional[Coordinates]) -> None:
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, (coordinates, created_at))
+            if self._conn is not None:
+                latitude, longitude = coordinates if coordinates is not None else (None, None)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?)", (key, latitude, longitude, created_at)
+                )
+                self._conn.commit()
+
+    def _call_upstream(self, address: str) -> Optional[Coordinates]:
+        with self._upstream_lock:
+            wait = self._last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return self.geocoder(address)
+            finally:
+                self._last_call = time.monotonic()
+                self.stats["upstream_calls"] += 1
+
+    def lookup(self, address: str) -> Optional[Coordinates]:
+        """
+        Return the coordinates of an address, or None if the geocoder does not know it.
+
+        Errors of the geocoder are raised to every caller waiting on the lookup and are not cached.
+
+        :param address: The address or landmark name.
+        :return: (latitude, longitude) or None.
+        """
+        key = normalize_address(address)
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                self.stats["hits" if entry[0] is not None else "negative_hits"] += 1
+                return entry[0]
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                leader = True
+                self.stats["misses"] += 1
+            else:
+                leader = False
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            return pending.result()
+
+        try:
+            coordinates = self._call_upstream(address)
+            self._put(key, coordinates)
+            pending.set_result(coordinates)
+            return coordinates
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_cache: Optional[GeocodeCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_geocode_cache() -> GeocodeCache:
+    """
+    Return the process-wide geocoding cache in front of Nominatim.
+
+    GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL and GEOCODE_CACHE_MAX_ENTRIES configure it.
+    """
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = GeocodeCache(
+                    max_entries=int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", 4096)),
+                    ttl=float(os.getenv("GEOCODE_CACHE_TTL", 30 * 24 * 3600)),
+                    negative_ttl=float(os.getenv("GEOCODE_NEGATIVE_TTL", 3600)),
+                    path=os.getenv("GEOCODE_CACHE_PATH"),
+                )
+    return _default_cache
+
+
+def encode_polyline(points: List[Coordinates], precision: int = 5) -> str:
+    """
+    Encode (latitude, longitude) points with Google's polyline algorithm.
+
+    :param points: The points of a route.
+    :param precision: int, default 5. Decimal digits kept, 5 is about one meter.
+    :return: The encoded polyline, about 4 to 8 characters per point.
+    """
+    factor = 10 ** precision
+    encoded = []
+    previous = (0, 0)
+    for point in points:
+        current = (round(point[0] * factor), round(point[1] * factor))
+        for value in (current[0] - previous[0], current[1] - previous[1]):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous = current
+    return "".join(encoded)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[Coordinates]:
+    """
+    Decode a polyline produced by `encode_polyline`.
+
+    Vectorized with numpy, as route cache hits decode on every read.
+
+    :param encoded: The encoded polyline.
+    :param precision: int, default 5. Decimal digits used when encoding.
+    :return: The (latitude, longitude) points.
+    """
+    chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if chunks.size == 0:
+        return []
+    # Every value is a run of 5-bit chunks, the last one without the 0x20 continuation bit
+    ends = np.flatnonzero(chunks < 0x20)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 5 * (np.arange(chunks.size) - np.repeat(starts, ends - starts + 1))
+    values = np.add.reduceat((chunks & 0x1f) << shifts, starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    points = np.cumsum(values.reshape(-1, 2), axis=0) / 10 ** precision
+    return list(zip(points[:, 0].tolist(), points[:, 1].tolist()))
+
+
+class RouteCache:
+    """
+    Cache of computed routes keyed on snapped endpoints and the vehicle profile.
+
+    Start and end coordinates are snapped to a grid of `grid` degrees (0.001 is
+    about 110 m of latitude), so tourists routing from neighbouring hotels to the
+    same attraction share an entry; the cached route starts and ends where the
+    first request of the cell did. Routes are kept as encoded polylines, about 6
+    bytes per point instead of a tuple of two floats, both in the in-memory LRU
+    and in the optional SQLite file read through on a memory miss, and decoded on
+    a hit, which is rounded to `encode_polyline`'s precision of about a meter.
+    Entries expire after `ttl` seconds as traffic and closures change.
+
+    :param max_entries: int, default 2048. Maximum number of routes kept in memory.
+    :param ttl: float, default 86400. Seconds a route stays valid. None disables expiry.
+    :param grid: float, default 0.001. Size of a grid cell in degrees.
+    :param path: str, default None. SQLite file for persistence. In-memory only if None.
+    """
+
+    def __init__(self,
+                 max_entries: int = 2048,
+                 ttl: Optional[float] = 24 * 3600.0,
+                 grid: float = 0.001,
+                 path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.grid = grid
+        self.path = path
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0}
+        self._lock = threading.Lock()
+        # key -> (encoded route polyline, distance in km, eta in hours, created_at)
+        self._entries: "OrderedDict[str, Tuple[str, float, float, float]]" = OrderedDict()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS route_cache (key TEXT PRIMARY KEY, polyline TEXT, distance REAL, eta REAL, created_at REAL)"
+            )
+            self._conn.commit()
+
+    def make_key(self, start_coords: Coordinates, end_coords: Coordinates, vehicle: str) -> str:
+        """
+        The grid cells of both endpoints and the vehicle profile.
+        """
+        cells = [math.floor(value / self.grid) for value in (*start_coords, *end_coords)]
+        return f"{vehicle}:{cells[0]}:{cells[1]}:{cells[2]}:{cells[3]}"
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def get(self,
+            start_coords: Coordinates,
+            end_coords: Coordinates,
+            vehicle: str) -> Optional[Tuple[List[Coordinates], float, float]]:
+        """
+        Return the cached (route, distance, eta) between two points, or None on a miss.
+        """
+        key = self.make_key(start_coords, end_coords, vehicle)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT polyline, distance, eta, created_at FROM route_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1], row[2], row[3])
+            if entry is None or self._is_expired(entry[3]):
+                self._entries.pop(key, None)
+                self.stats["misses"] += 1
+                return None
+            self._remember(key, entry)
+            self.stats["hits"] += 1
+        return decode_polyline(entry[0]), entry[1], entry[2]
+
+    def put(self,
+            start_coords: Coordinates,
+            end_coords: Coordinates,
+            vehicle: str,
+            route: List[Coordinates],
+            distance: float,
+            eta: float) -> None:
+        """
+        Store a computed route.
+        """
+        key = self.make_key(start_coords, end_coords, vehicle)
+        created_at = time.time()
+        polyline = encode_polyline(route)
+        with self._lock:
+            self._remember(key, (polyline, distance, eta, created_at))
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO route_cache VALUES (?, ?, ?, ?, ?)",
+                    (key, polyline, distance, eta, created_at)
+                )
+                if self.ttl is not None:
+                    self._conn.execute("DELETE FROM route_cache WHERE created_at < ?", (created_at - self.ttl,))
+                self._conn.commit()
+            self.stats["stores"] += 1
+
+    def _remember(self, key: str, entry: Tuple[str, float, float, float]) -> None:
+        # Caller holds the lock. The SQLite copy is only bounded by the TTL.
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_route_cache: Optional[RouteCache] = None
+_default_route_cache_lock = threading.Lock()
+
+
+def get_route_cache() -> RouteCache:
+    """
+    Return the process-wide route cache.
+
+    ROUTE_CACHE_GRID, ROUTE_CACHE_TTL, ROUTE_CACHE_PATH and ROUTE_CACHE_MAX_ENTRIES configure it.
+    """
+    global _default_route_cache
+    if _default_route_cache is None:
+        with _default_route_cache_lock:
+            if _default_route_cache is None:
+                _default_route_cache = RouteCache(
+                    max_entries=int(os.getenv("ROUTE_CACHE_MAX_ENTRIES", 2048)),
+                    ttl=float(os.getenv("ROUTE_CACHE_TTL", 24 * 3600)),
+                    grid=float(os.getenv("ROUTE_CACHE_GRID", 0.001)),
+                    path=os.getenv("ROUTE_CACHE_PATH"),
+                )
+    return _default_route_cache
+
+
+if __name__ == "__main__":
+    import json
+    import random
+    import sys
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    landmarks = {
+        "hoan kiem lake": (21.0288, 105.8525),
+        "temple of literature": (21.0293, 105.8355),
+        "ho chi minh mausoleum": (21.0368, 105.8346),
+        "dong xuan market": (21.0381, 105.8497),
+        "west lake": (21.0580, 105.8190),
+        "hanoi opera house": (21.0245, 105.8575),
+    }
+    latency = 0.05
+
+    def stub_geocoder(address: str) -> Optional[Coordinates]:
+        # Stands in for Nominatim: a network round trip, and unknown places return None
+        time.sleep(latency)
+        return landmarks.get(normalize_address(address))
+
+    rng = random.Random(0)
+    names = list(landmarks) + ["atlantis"]
+    spellings = [lambda n: n, str.title, str.upper, lambda n: f"  {n.title()}, "]
+    requests = [rng.choice(spellings)(rng.choice(names)) for _ in range(400)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "geocode.db")
+
+        start = time.perf_counter()
+        for address in requests[:40]:
+            stub_geocoder(address)
+        uncached = (time.perf_counter() - start) / 40 * len(requests)
+        print(f"Uncached, sequential: {uncached:.2f} s for {len(requests)} lookups "
+              f"(at least {len(requests)} s against Nominatim's 1 request/s)")
+
+        cache = GeocodeCache(geocoder=stub_geocoder, path=path, min_interval=0.0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(cache.lookup, requests))
+        elapsed = time.perf_counter() - start
+        assert all(r == landmarks.get(normalize_address(a)) for a, r in zip(requests, results))
+        print(f"Cached, 16 threads:   {elapsed:.2f} s, {cache.stats}")
+
+        # A restarted process reads the SQLite store instead of calling the geocoder
+        reopened = GeocodeCache(geocoder=stub_geocoder, path=path, min_interval=0.0)
+        start = time.perf_counter()
+        for address in requests:
+            reopened.lookup(address)
+        print(f"Warm restart:         {(time.perf_counter() - start) * 1000:.1f} ms, {reopened.stats}")
+
+    # Route cache: a 600-point route between two hotels of the same block and one attraction
+    rng = random.Random(1)
+    route = [(21.0288 + i * 1e-4 + rng.uniform(-2e-5, 2e-5), 105.8525 - i * 5e-5) for i in range(600)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "routes.db")
+        RouteCache(path=path).put((21.02881, 105.85251), (21.0293, 105.8355), "foot-walking", route, 2.4, 0.48)
+        # Another hotel of the same block, read back from SQLite by a fresh process
+        route_cache = RouteCache(path=path)
+        cached, distance, eta = route_cache.get((21.02889, 105.85257), (21.0293, 105.8355), "foot-walking")
+        assert max(abs(a - b) for p, q in zip(route, cached) for a, b in zip(p, q)) < 1e-5
+        assert route_cache.get((21.02889, 105.85257), (21.0293, 105.8355), "driving-car") is None
+
+    runs = 2000
+    start = time.perf_counter()
+    for _ in range(runs):
+        route_cache.get((21.02889, 105.85257), (21.0293, 105.8355), "foot-walking")
+    decoded_bytes = sys.getsizeof(route) + sum(sys.getsizeof(p) + 2 * sys.getsizeof(p[0]) for p in route)
+    print(f"Route cache hit: {(time.perf_counter() - start) / runs * 1e6:,.0f} us for {len(route)} points, "
+          f"held in {sys.getsizeof(encode_polyline(route)):,} bytes encoded vs {decoded_bytes:,} bytes as float tuples "
+          f"({len(json.dumps(route)):,} as JSON)")
@@ -0,0 +1,214 @@
+import asyncio
+import os
+import threading
+from typing import Any, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session with keep-alive connection pools, retries and a default timeout.
+
+    Connections are reused per host, so only the first call to a host pays the
+    TCP and TLS handshakes. Connection errors and 429/5xx responses are retried
+    with exponential backoff, honouring Retry-After. Calls without an explicit
+    timeout get `timeout`.
+
+    :param timeout: float or (connect, read) tuple, default (3.05, 30). Default timeout in seconds.
+    :param retries: int, default 3. Retries after the first attempt.
+    :param backoff_factor: float, default 0.5. Backoff before retry n is backoff_factor * 2 ** (n - 1) seconds.
+    :param pool_maxsize: int, default 16. Connections kept open per host.
+    """
+
+    def __init__(self,
+                 timeout: Timeout = (3.05, 30),
+                 retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 pool_maxsize: int = 16):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            # Geocoding, routing and transcription requests have no side effects
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+class AsyncHTTPClient:
+    """
+    Async counterpart of `PooledSession` on top of httpx, for callers on the event loop.
+    Transport errors and 429/5xx responses are retried `retries` times with exponential
+    backoff, honouring Retry-After.
+
+    :param timeout: float, default 30. Timeout in seconds.
+    :param retries: int, default 3. Retries after the first attempt.
+    :param backoff_factor: float, default 0.5. Backoff before retry n is backoff_factor * 2 ** (n - 1) seconds.
+    :param pool_maxsize: int, default 16. Connections kept open per host.
+    """
+
+    def __init__(self,
+                 timeout: float = 30,
+                 retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 pool_maxsize: int = 16):
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("httpx is required for the async HTTP client: pip install httpx") from e
+        self._httpx = httpx
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        # No custom transport: httpx would then ignore `limits` and the proxy environment variables.
+        # request() is the only retry mechanism, for transport errors and retryable statuses alike.
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=pool_maxsize),
+        )
+
+    async def request(self, method: str, url: str, **kwargs: Any):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self._client.request(method, url, **kwargs)
+            except self._httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+                response = None
+            if response is not None and (response.status_code not in RETRY_STATUSES or attempt == self.retries):
+                return response
+            delay = self.backoff_factor * 2 ** attempt
+            if response is not None and response.headers.get("retry-after", "").isdigit():
+                delay = max(delay, float(response.headers["retry-after"]))
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, **kwargs: Any):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any):
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+def _settings() -> dict:
+    return {
+        "retries": int(os.getenv("HTTP_RETRIES", 3)),
+        "backoff_factor": float(os.getenv("HTTP_BACKOFF", 0.5)),
+        "pool_maxsize": int(os.getenv("HTTP_POOL_SIZE", 16)),
+    }
+
+
+_default_session: Optional[PooledSession] = None
+_default_session_lock = threading.Lock()
+
+
+def get_http_session() -> PooledSession:
+    """
+    Return the process-wide HTTP session used for every geo and ASR call.
+
+    HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF and HTTP_POOL_SIZE configure it.
+    """
+    global _default_session
+    if _default_session is None:
+        with _default_session_lock:
+            if _default_session is None:
+                timeout = (float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05)), float(os.getenv("HTTP_TIMEOUT", 30)))
+                _default_session = PooledSession(timeout=timeout, **_settings())
+    return _default_session
+
+
+def get_async_http_client() -> AsyncHTTPClient:
+    """
+    Build an async HTTP client with the same settings as `get_http_session`.
+
+    httpx pools are bound to the event loop they were first used on, so the caller
+    owns the client and closes it with `aclose`.
+    """
+    return AsyncHTTPClient(timeout=float(os.getenv("HTTP_TIMEOUT", 30)), **_settings())
+
+
+if __name__ == "__main__":
+    import json
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    failures = {"left": 0}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        # Keep-alive needs HTTP/1.1 and a Content-Length, and Nagle off like any production server
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if failures["left"] > 0:
+                failures["left"] -= 1
+                status, body = 503, b"{}"
+            else:
+                status, body = 200, json.dumps({"loc": "21.0288,105.8525"}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/json"
+    runs = 500
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        requests.get(url, timeout=5).json()
+    bare = (time.perf_counter() - start) / runs
+
+    session = PooledSession(backoff_factor=0.01)
+    session.get(url).json()
+    start = time.perf_counter()
+    for _ in range(runs):
+        session.get(url).json()
+    pooled = (time.perf_counter() - start) / runs
+
+    print(f"Bare requests.get: {bare * 1000:.2f} ms/call (new connection per call)")
+    print(f"Pooled session:    {pooled * 1000:.2f} ms/call ({bare / pooled:.1f}x faster, "
+          f"before any TLS handshake is saved)")
+
+    failures["left"] = 2
+    response = session.get(url)
+    print(f"Two 503s then 200: status {response.status_code} after retries")
+
+    async def run_async():
+        client = get_async_http_client()
+        client.backoff_factor = 0.01
+        await client.get(url)
+        start = time.perf_counter()
+        await asyncio.gather(*[client.get(url) for _ in range(runs)])
+        elapsed = (time.perf_counter() - start) / runs
+        failures["left"] = 2
+        status = (await client.get(url)).status_code
+        await client.aclose()
+        return elapsed, status
+
+    elapsed, status = asyncio.run(run_async())
+    print(f"Async client:      {elapsed * 1000:.2f} ms/call amortized over {runs} concurrent calls, "
+          f"retried 503s to status {status}")
+    server.shutdown()
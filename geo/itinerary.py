@@ -0,0 +1,242 @@
+from typing import List, Literal, Optional, Sequence, Tuple
+
+import numpy as np
+
+from geo.http_client import get_http_session
+from geo.spatial import DETOUR_FACTOR, SPEED_KMH, haversine_matrix
+
+Vehicle = Literal["driving-car", "foot-walking", "cycling-regular"]
+
+
+def ors_matrix(points: Sequence[Tuple[float, float]],
+               vehicle: Vehicle = "foot-walking",
+               api_key: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Road distances and durations between every pair of points, in one OpenRouteService matrix call.
+
+    :param points: The (latitude, longitude) points.
+    :param vehicle: The OpenRouteService profile.
+    :param api_key: str, default None. Read from ORS_TOKEN if None.
+    :return: The distances in kilometers and the durations in seconds, both (n, n).
+    """
+    from geo.utils import get_token
+
+    if api_key is None:
+        api_key = get_token("ORS_TOKEN", "OpenRouteService")
+    response = get_http_session().post(
+        f"https://api.openrouteservice.org/v2/matrix/{vehicle}",
+        headers={"Authorization": api_key, "Content-Type": "application/json"},
+        json={"locations": [[lng, lat] for lat, lng in points], "metrics": ["distance", "duration"], "units": "km"}
+    )
+    response.raise_for_status()
+    data = response.json()
+    # Unreachable pairs come back as null
+    distances = np.array(data["distances"], dtype=np.float64)
+    durations = np.array(data["durations"], dtype=np.float64)
+    return np.nan_to_num(distances, nan=np.inf), np.nan_to_num(durations, nan=np.inf)
+
+
+def haversine_estimate(points: Sequence[Tuple[float, float]],
+                       vehicle: Vehicle = "foot-walking") -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Offline estimate of the road distances and durations between every pair of points.
+
+    :return: The distances in kilometers and the durations in seconds, both (n, n).
+    """
+    distances = haversine_matrix(points) * DETOUR_FACTOR
+    return distances, distances / SPEED_KMH[vehicle] * 3600
+
+
+def distance_matrix(points: Sequence[Tuple[float, float]],
+                    vehicle: Vehicle = "foot-walking",
+                    api_key: Optional[str] = None,
+                    offline: bool = False) -> Tuple[np.ndarray, np.ndarray, str]:
+    """
+    Distance and duration matrices from OpenRouteService, or the haversine estimate
+    when offline or when the matrix call fails.
+
+    :return: The distances in kilometers, the durations in seconds and the source, "ors" or "haversine".
+    """
+    if not offline:
+        try:
+            distances, durations = ors_matrix(points, vehicle=vehicle, api_key=api_key)
+            return distances, durations, "ors"
+        except Exception as e:
+            print(f"Error fetching the route matrix, falling back to haversine estimates: {e}")
+    distances, durations = haversine_estimate(points, vehicle=vehicle)
+    return distances, durations, "haversine"
+
+
+def nearest_neighbor(cost: np.ndarray, start: int = 0) -> List[int]:
+    """
+    Greedy tour: always go to the closest stop not visited yet. Unreachable (infinite)
+    legs are taken last, so every stop is visited exactly once.
+
+    :param cost: (n, n) cost matrix.
+    :param start: int, default 0. The first stop.
+    :return: The visit order.
+    """
+    n = len(cost)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        # Only unvisited stops compete, even when every remaining leg is infinite
+        candidates = np.flatnonzero(~visited)
+        order.append(int(candidates[cost[order[-1], candidates].argmin()]))
+        visited[order[-1]] = True
+    return order
+
+
+def two_opt(order: List[int], cost: np.ndarray, round_trip: bool = False, max_iterations: int = 1000) -> List[int]:
+    """
+    Improve a tour by reversing the segment that shortens it most, until no reversal helps.
+
+    Every candidate reversal is scored at once with NumPy, so one iteration costs a
+    few vectorized operations over the n^2 / 2 segment pairs. The first stop stays first.
+    Costs are symmetrized, since reversing a segment walks its legs backwards.
+    Unreachable (infinite) legs cost more than any tour of reachable legs, so they
+    are avoided where possible without breaking the arithmetic.
+
+    :param order: The initial visit order, e.g. from `nearest_neighbor`.
+    :param cost: (n, n) cost matrix.
+    :param round_trip: bool, default False. Whether the tour returns to the first stop.
+    :param max_iterations: int, default 1000. Maximum number of reversals.
+    :return: The improved visit order.
+    """
+    cost = (cost + cost.T) / 2
+    n = len(cost)
+    finite = cost[np.isfinite(cost)]
+    unreachable = (finite.max() if finite.size else 1.0) * n + 1.0
+    cost = np.where(np.isfinite(cost), cost, unreachable)
+    if not round_trip:
+        # An open path is a cycle through a dummy node tied to the first stop: it costs
+        # nothing to reach the first stop and `big` to reach any other, so the first
+        # stop stays first and the path may end anywhere.
+        big = unreachable * (n + 1) + 1.0
+        padded = np.zeros((n + 1, n + 1))
+        padded[:n, :n] = cost
+        padded[n, :n] = padded[:n, n] = big
+        padded[n, order[0]] = padded[order[0], n] = 0.0
+        cost = padded
+        tour = np.array([n] + list(order))
+    else:
+        tour = np.array(order)
+
+    m = len(tour)
+    if m < 4:
+        return list(order)
+    # Segments tour[i..j] with 1 <= i < j <= m - 1, tour[0] never moves
+    i, j = np.triu_indices(m - 1, 1)
+    i, j = i + 1, j + 1
+    for _ in range(max_iterations):
+        prev, a, b, nxt = tour[i - 1], tour[i], tour[j], tour[(j + 1) % m]
+        delta = cost[prev, b] + cost[a, nxt] - cost[prev, a] - cost[b, nxt]
+        best = int(delta.argmin())
+        if not delta[best] < -1e-9:
+            break
+        tour[i[best]:j[best] + 1] = tour[i[best]:j[best] + 1][::-1].copy()
+
+    tour = tour.tolist()
+    return tour[1:] if not round_trip else tour
+
+
+def tour_cost(order: List[int], cost: np.ndarray, round_trip: bool = False) -> float:
+    legs = list(zip(order, order[1:] + ([order[0]] if round_trip else [])))
+    return float(sum(cost[a, b] for a, b in legs))
+
+
+def plan_itinerary(stops: Sequence[Tuple[float, float]],
+                   vehicle: Vehicle = "foot-walking",
+                   round_trip: bool = False,
+                   api_key: Optional[str] = None,
+                   offline: bool = False,
+                   with_geometry: bool = True,
+                   matrix: Optional[Tuple[np.ndarray, np.ndarray, str]] = None) -> dict:
+    """
+    Order a list of stops into the shortest tour starting at the first one.
+
+    The distance matrix is fetched once and reused for the nearest-neighbor tour,
+    its 2-opt improvement and the per-leg figures. Leg geometries come from
+    `calculate_route`, and so from the route cache when the leg was routed before.
+
+    :param stops: The (latitude, longitude) stops, the first one being the starting point.
+    :param vehicle: The OpenRouteService profile.
+    :param round_trip: bool, default False. Whether to come back to the starting point.
+    :param api_key: str, default None. OpenRouteService token, read from ORS_TOKEN if None.
+    :param offline: bool, default False. Use haversine estimates and straight legs instead of OpenRouteService.
+    :param with_geometry: bool, default True. Whether to fetch the geometry of every leg.
+    :param matrix: (distances, durations, source), default None. A matrix from `distance_matrix` to reuse.
+    :return: The visit order, the legs and the totals.
+    """
+    assert len(stops) >= 2, "An itinerary needs at least two stops."
+    distances, durations, source = matrix if matrix is not None else distance_matrix(
+        stops, vehicle=vehicle, api_key=api_key, offline=offline
+    )
+
+    order = two_opt(nearest_neighbor(distances), distances, round_trip=round_trip)
+    assert sorted(order) == list(range(len(stops))), f"The visit order {order} is not a permutation of the stops."
+    pairs = list(zip(order, order[1:] + ([order[0]] if round_trip else [])))
+
+    legs = []
+    for a, b in pairs:
+        geometry = [tuple(stops[a]), tuple(stops[b])]
+        if with_geometry and not offline:
+            from geo.utils import calculate_route
+
+            route, _, _ = calculate_route(stops[a], stops[b], vehicle=vehicle, api_key=api_key)
+            if route:
+                geometry = route
+        legs.append({
+            "from": a,
+            "to": b,
+            "distance": float(distances[a, b]),
+            "duration": float(durations[a, b]),
+            "geometry": geometry,
+        })
+
+    return {
+        "order": order,
+        "legs": legs,
+        "total_distance": sum(leg["distance"] for leg in legs),
+        "total_duration": sum(leg["duration"] for leg in legs),
+        "matrix_source": source,
+    }
+
+
+if __name__ == "__main__":
+    import itertools
+    import time
+
+    rng = np.random.default_rng(0)
+    # Random stops within about 5 km of Hoan Kiem lake
+    for n in (8, 25, 60):
+        stops = [tuple(p) for p in np.array([21.0288, 105.8525]) + rng.uniform(-0.045, 0.045, size=(n, 2))]
+        distances, _ = haversine_estimate(stops)
+
+        start = time.perf_counter()
+        greedy = nearest_neighbor(distances)
+        improved = two_opt(greedy, distances)
+        elapsed = time.perf_counter() - start
+
+        given = tour_cost(list(range(n)), distances)
+        line = (f"{n} stops: given order {given:.1f} km, nearest neighbor {tour_cost(greedy, distances):.1f} km, "
+                f"+ 2-opt {tour_cost(improved, distances):.1f} km in {elapsed * 1000:.1f} ms")
+        if n <= 8:
+            optimum = min(tour_cost([0] + list(p), distances) for p in itertools.permutations(range(1, n)))
+            line += f", optimum {optimum:.1f} km"
+        print(line)
+
+    # Unreachable legs (null in the ORS matrix) must not make the tour revisit a stop
+    blocked = haversine_estimate(stops[:5])[0]
+    blocked[1:, 1:] = np.inf
+    np.fill_diagonal(blocked, 0.0)
+    greedy = nearest_neighbor(blocked)
+    assert sorted(greedy) == list(range(5)), greedy
+    improved = two_opt(greedy, blocked)
+    assert improved[0] == 0 and sorted(improved) == list(range(5)), improved
+    print(f"With unreachable legs: nearest neighbor order {greedy}, + 2-opt {improved}")
+
+    plan = plan_itinerary(stops[:6], offline=True)
+    print(f"Offline plan: order {plan['order']}, {plan['total_distance']:.1f} km, "
+          f"{plan['total_duration'] / 3600:.1f} h on foot")
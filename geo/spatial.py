@@ -0,0 +1,299 @@
+import json
+import math
+import os
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Average speeds used to estimate travel times, in km/h
+SPEED_KMH = {
+    "driving-car": 30,
+    "foot-walking": 5,
+    "cycling-regular": 10
+}
+
+# Road distance over straight-line distance in a dense city
+DETOUR_FACTOR = 1.3
+
+
+def haversine(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """
+    Great-circle distance between two (latitude, longitude) points, in kilometers.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(h, 1.0)))
+
+
+def haversine_matrix(points: Sequence[Tuple[float, float]], others: Sequence[Tuple[float, float]] = None) -> np.ndarray:
+    """
+    Pairwise great-circle distances, in kilometers.
+
+    :param points: The (latitude, longitude) points.
+    :param others: The points to measure against, default None. `points` itself if None.
+    :return: A (len(points), len(others)) array.
+    """
+    a = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    b = a if others is None else np.radians(np.asarray(others, dtype=np.float64).reshape(-1, 2))
+    lat1, lng1 = a[:, 0:1], a[:, 1:2]
+    lat2, lng2 = b[:, 0], b[:, 1]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def estimate_eta(start: Tuple[float, float],
+                 end: Tuple[float, float],
+                 vehicle: str = "foot-walking") -> Tuple[float, float]:
+    """
+    Instant offline estimate of the road distance and travel time between two points.
+
+    :param start: The (latitude, longitude) starting point.
+    :param end: The (latitude, longitude) destination.
+    :param vehicle: str, default "foot-walking". A key of `SPEED_KMH`.
+    :return: The distance in kilometers and the travel time in hours.
+    """
+    distance = haversine(start, end) * DETOUR_FACTOR
+    return distance, distance / SPEED_KMH[vehicle]
+
+
+class PointIndex:
+    """
+    Grid index over points of interest for k-nearest and radius queries.
+
+    Points are bucketed into cells of about `cell_km` kilometers. A radius query
+    only measures the points of the cells overlapping the circle's bounding box,
+    with one vectorized haversine call; a k-nearest query widens the radius until
+    k points are inside it, so both are exact.
+
+    :param points: The (latitude, longitude) of every point.
+    :param rows: dicts describing the points, e.g. the NAME/INFORMATION rows of the knowledge table, default None.
+    :param cell_km: float, default 0.5. Size of a grid cell in kilometers.
+    """
+
+    def __init__(self,
+                 points: Sequence[Tuple[float, float]],
+                 rows: Optional[Sequence[Dict[str, Any]]] = None,
+                 cell_km: float = 0.5):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.rows = list(rows) if rows is not None else [{} for _ in range(len(self.points))]
+        self.cell_km = cell_km
+        self.cell_degrees = np.degrees(cell_km / EARTH_RADIUS_KM)
+        keys = np.floor(self.points / self.cell_degrees).astype(np.int64)
+        buckets: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for i, (row, column) in enumerate(keys.tolist()):
+            buckets[(row, column)].append(i)
+        self._cells = {key: np.array(ids, dtype=np.int64) for key, ids in buckets.items()}
+        # column -> passage text -> point index, built on first use
+        self._passages: Dict[str, Dict[str, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def _candidates(self, location: Tuple[float, float], radius_km: float) -> np.ndarray:
+        # Exact bounding box of the spherical cap around the location
+        angle = radius_km / EARTH_RADIUS_KM
+        dlat = np.degrees(angle)
+        cos_lat = np.cos(np.radians(location[0]))
+        dlng = 180.0 if angle >= np.pi / 2 or np.sin(angle) >= cos_lat else np.degrees(np.arcsin(np.sin(angle) / cos_lat))
+        rows = range(int(np.floor((location[0] - dlat) / self.cell_degrees)),
+                     int(np.floor((location[0] + dlat) / self.cell_degrees)) + 1)
+        columns = range(int(np.floor((location[1] - dlng) / self.cell_degrees)),
+                        int(np.floor((location[1] + dlng) / self.cell_degrees)) + 1)
+        if len(rows) * len(columns) > len(self._cells):
+            return np.arange(len(self.points))
+        found = [self._cells[(row, column)] for row in rows for column in columns if (row, column) in self._cells]
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def within(self, location: Tuple[float, float], radius_km: float) -> List[Tuple[int, float]]:
+        """
+        Points within `radius_km` of a location.
+
+        :return: (point index, distance in km) pairs, closest first.
+        """
+        candidates = self._candidates(location, radius_km)
+        if not len(candidates):
+            return []
+        distances = haversine_matrix([location], self.points[candidates])[0]
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+        return [(int(candidates[i]), float(distances[i])) for i in order]
+
+    def nearest(self, location: Tuple[float, float], k: int = 5) -> List[Tuple[int, float]]:
+        """
+        The k points closest to a location.
+
+        :return: (point index, distance in km) pairs, closest first.
+        """
+        radius = self.cell_km
+        while True:
+            hits = self.within(location, radius)
+            if len(hits) >= k or radius >= np.pi * EARTH_RADIUS_KM:
+                return hits[:k]
+            radius *= 2
+
+    def filter_passages(self,
+                        passages: List[str],
+                        location: Tuple[float, float],
+                        radius_km: float,
+                        column: str = "INFORMATION") -> List[str]:
+        """
+        Keep the passages about places within `radius_km` of a location.
+
+        Passages about indexed places farther away are dropped; passages the index
+        knows nothing about are kept, after the nearby ones. If no passage is about a
+        nearby place, e.g. the user asks about a trip elsewhere, every passage is kept
+        in its original order.
+
+        :param passages: The retrieved passages, most relevant first.
+        :param column: The row column holding the passage text.
+        :return: The filtered passages.
+        """
+        if column not in self._passages:
+            self._passages[column] = {row[column]: i for i, row in enumerate(self.rows) if row.get(column)}
+        indexed = self._passages[column]
+        nearby = {i for i, _ in self.within(location, radius_km)}
+        close = [p for p in passages if p in indexed and indexed[p] in nearby]
+        if not close:
+            return passages
+        unknown = [p for p in passages if p not in indexed]
+        return close + unknown
+
+    @classmethod
+    def from_rows(cls,
+                  rows: Sequence[Dict[str, Any]],
+                  latitude_column: str = "LATITUDE",
+                  longitude_column: str = "LONGITUDE",
+                  name_column: str = "NAME",
+                  geocode: bool = True,
+                  **kwargs) -> "PointIndex":
+        """
+        Index the rows of the knowledge table.
+
+        Rows without coordinates are geocoded by name through the shared geocoding
+        cache if `geocode`, and skipped otherwise or when the name is unknown.
+
+        :param rows: dicts with the NAME/INFORMATION columns and optionally the coordinates.
+        :return: The index, whose rows carry their coordinates.
+        """
+        points, kept = [], []
+        for row in rows:
+            row = dict(row)
+            if row.get(latitude_column) is None or row.get(longitude_column) is None:
+                if not geocode or not row.get(name_column):
+                    continue
+                from geo.cache import get_geocode_cache
+
+                try:
+                    coordinates = get_geocode_cache().lookup(row[name_column])
+                except Exception as e:
+                    print(f"Could not geocode {row[name_column]}: {e}")
+                    coordinates = None
+                if coordinates is None:
+                    continue
+                row[latitude_column], row[longitude_column] = coordinates
+            points.append((float(row[latitude_column]), float(row[longitude_column])))
+            kept.append(row)
+        return cls(points, rows=kept, **kwargs)
+
+    @classmethod
+    def from_snowflake(cls, table: str, session_pool: Optional[Any] = None, **kwargs) -> "PointIndex":
+        """
+        Index the places of a Snowflake table, e.g. the one the Cortex Search service is built on.
+
+        :param table: The fully qualified table name.
+        """
+        from core.connection.SessionPool import get_session_pool
+
+        pool = session_pool or get_session_pool()
+        with pool.session() as session:
+            rows = [row.as_dict() for row in session.table(table).collect()]
+        return cls.from_rows(rows, **kwargs)
+
+    def save(self, path: str) -> None:
+        """
+        Write the rows with their coordinates as JSONL, to be reopened with `load`.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for row, (latitude, longitude) in zip(self.rows, self.points.tolist()):
+                f.write(json.dumps({**row, "LATITUDE": latitude, "LONGITUDE": longitude}, ensure_ascii=False) + "\n")
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "PointIndex":
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return cls.from_rows(rows, geocode=False, **kwargs)
+
+
+_default_index: Optional[PointIndex] = None
+_default_index_loaded = False
+_default_index_lock = threading.Lock()
+
+
+def get_poi_index() -> Optional[PointIndex]:
+    """
+    Return the process-wide index of points of interest, or None if none is configured.
+
+    POI_INDEX_PATH names a JSONL file written by `PointIndex.save`; otherwise POI_TABLE
+    names the Snowflake table to index, geocoding the rows without coordinates.
+    If the table is given too, a missing POI_INDEX_PATH file is built from it once.
+    """
+    global _default_index, _default_index_loaded
+    if not _default_index_loaded:
+        with _default_index_lock:
+            if not _default_index_loaded:
+                path, table = os.getenv("POI_INDEX_PATH"), os.getenv("POI_TABLE")
+                if path and os.path.exists(path):
+                    _default_index = PointIndex.load(path)
+                elif table:
+                    _default_index = PointIndex.from_snowflake(table)
+                    if path:
+                        _default_index.save(path)
+                _default_index_loaded = True
+    return _default_index
+
+
+if __name__ == "__main__":
+    import time
+
+    rng = np.random.default_rng(0)
+    # Points spread over Vietnam's bounding box, denser around Hanoi
+    n = 50_000
+    points = np.concatenate([
+        rng.uniform([8.5, 102.1], [23.4, 109.5], size=(n // 2, 2)),
+        np.array([21.0288, 105.8525]) + rng.normal(scale=0.05, size=(n - n // 2, 2)),
+    ])
+    start = time.perf_counter()
+    index = PointIndex(points)
+    print(f"Indexed {n:,} points in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    queries = np.array([21.0288, 105.8525]) + rng.normal(scale=0.05, size=(200, 2))
+    for name, search, brute in [
+        ("5 nearest", lambda q: index.nearest(q, k=5),
+         lambda d: np.argsort(d, kind="stable")[:5]),
+        ("within 1 km", lambda q: index.within(q, 1.0),
+         lambda d: np.flatnonzero(d <= 1.0)[np.argsort(d[d <= 1.0], kind="stable")]),
+    ]:
+        start = time.perf_counter()
+        results = [search(tuple(q)) for q in queries]
+        indexed = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        expected = [brute(haversine_matrix([q], points)[0]) for q in queries]
+        scan = (time.perf_counter() - start) / len(queries)
+
+        assert all(sorted(i for i, _ in r) == sorted(e.tolist()) for r, e in zip(results, expected))
+        print(f"{name}: {indexed * 1e6:,.0f} us indexed vs {scan * 1e6:,.0f} us full scan, "
+              f"{np.mean([len(r) for r in results]):.0f} results on average, identical")
+
+    distance, hours = estimate_eta((21.0288, 105.8525), (21.0293, 105.8355), "foot-walking")
+    runs = 10_000
+    start = time.perf_counter()
+    for _ in range(runs):
+        estimate_eta((21.0288, 105.8525), (21.0293, 105.8355), "foot-walking")
+    print(f"ETA Hoan Kiem -> Temple of Literature: {distance:.1f} km, {hours * 60:.0f} min on foot, "
+          f"{(time.perf_counter() - start) / runs * 1e6:.1f} us per estimate")
@@ -2,18 +2,24 @@ import requests
 import folium
 import json
 import os
-from geopy.geocoders import Nominatim
+from pathlib import Path
 from dotenv import load_dotenv
-from typing import Literal
+from typing import Literal, Optional
 
-load_dotenv("../.env")
-os.chdir("../")
+from geo.cache import get_geocode_cache, get_route_cache
+from geo.http_client import get_http_session
+from geo.spatial import SPEED_KMH
 
 API_URL = "https://api-inference.huggingface.co/models/openai/whisper-large-v3-turbo"
-headers = {"Authorization": f"Bearer {os.environ['HF_TOKEN']}"}
 
-assert os.getenv("HF_TOKEN") is not None, "Hugging Face API token must be provided."
-assert os.getenv("ORS_TOKEN") is not None, "OpenRouteService API token must be provided."
+def get_token(name: str, description: str) -> str:
+    """
+    Read an API token from the environment, loading the repo's .env file on first use.
+    """
+    if os.getenv(name) is None:
+        load_dotenv(Path(__file__).resolve().parents[1] / ".env")
+    assert os.getenv(name) is not None, f"{description} API token must be provided."
+    return os.environ[name]
 
 def get_current_location():
     """
@@ -21,7 +27,7 @@ def get_current_location():
     Falls back to manual input if automatic detection fails.
     """
     try:
-        response = requests.get('https://ipinfo.io/json')
+        response = get_http_session().get('https://ipinfo.io/json')
         data = response.json()
         loc = data['loc'].split(',')
         latitude = float(loc[0])
@@ -36,27 +42,35 @@ def get_current_location():
     
 def get_destination(destination: str = None, **kwargs):
     """
-    Prompts the user to enter the destination address and returns its coordinates.
+    Returns the coordinates of the destination address, geocoded through the shared cache.
     """
     assert destination is not None, "Destination address must be provided."
 
-    geolocator = Nominatim(user_agent="route_planner")
     try:
-        location = geolocator.geocode(destination)
-        print(f"Destination location: {location.address}")
-        return (location.latitude, location.longitude)
+        coordinates = get_geocode_cache().lookup(destination)
     except Exception as e:
-        print("Could not find the destination address.")
+        print(f"Could not geocode the destination address: {e}")
         return None
+    if coordinates is None:
+        print("Could not find the destination address.")
+    return coordinates
     
 def calculate_route(start_coords, end_coords, 
                     vehicle: Literal["driving-car", "foot-walking", "cycling-regular"] = "driving-car",
-                    api_key = os.getenv("ORS_TOKEN")):
+                    api_key: Optional[str] = None,
+                    use_cache: bool = True):
     """
     Uses OpenRouteService API to calculate the route between two coordinates.
-    Returns the route geometry and the distance in kilometers.
+    Returns the route geometry, the distance in kilometers and the estimated travel time in hours,
+    or three Nones on failure. Routes between nearby points are answered from the shared route cache.
     """
     assert vehicle in ["driving-car", "foot-walking", "cycling-regular"], "Invalid vehicle type."
+    if use_cache:
+        cached = get_route_cache().get(start_coords, end_coords, vehicle)
+        if cached is not None:
+            return cached
+    if api_key is None:
+        api_key = get_token("ORS_TOKEN", "OpenRouteService")
     url = f"https://api.openrouteservice.org/v2/directions/{vehicle}/geojson"
     headers = {
         'Authorization': api_key,
@@ -68,23 +82,19 @@ def calculate_route(start_coords, end_coords,
             [end_coords[1], end_coords[0]]
         ]
     }
-    speed = {
-        "driving-car": 30,
-        "foot-walking": 5,
-        "cycling-regular": 10
-    }
-
-    response = requests.post(url, headers=headers, json=body)
+    response = get_http_session().post(url, headers=headers, json=body)
     if response.status_code == 200:
         data = response.json()
         distance = data['features'][0]['properties']['segments'][0]['distance'] / 1000
         geometry = data['features'][0]['geometry']['coordinates']
         route = [(coord[1], coord[0]) for coord in geometry]
-        eta_time = distance / speed[vehicle]
+        eta_time = distance / SPEED_KMH[vehicle]
+        if use_cache:
+            get_route_cache().put(start_coords, end_coords, vehicle, route, distance, eta_time)
         return route, distance, eta_time
     else:
         print(f"Error fetching route: {response.status_code} - {response.text}")
-        return None, None
+        return None, None, None
     
 def plot_route(route, start_coords, end_coords, **kwargs):
     """
@@ -115,9 +125,10 @@ def query(filename):
     assert os.path.exists(filename)
     with open(filename, "rb") as f:
         data = f.read()
+    headers = {"Authorization": f"Bearer {get_token('HF_TOKEN', 'Hugging Face')}"}
     print("Sending request...")
     try:
-        response = requests.post(API_URL, headers=headers, data=data)
+        response = get_http_session().post(API_URL, headers=headers, data=data)
         response.raise_for_status()
     except requests.exceptions.HTTPError as err:
         raise SystemExit(err)